@@ -1,30 +1,52 @@
 # app.py - SISTEMA COMPLETO DE RUTAS ÓPTIMAS PARA MÉXICO
 import os
 import json
+import bisect
 import math
 import random
 import hashlib
 import secrets
 import base64
+import contextvars
+import bz2
+import gzip
+import heapq
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlsplit
 import time
 import io
+import re
+import csv
+import mmap
+import queue
 import pathlib
+import threading
+import unicodedata
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime, timedelta
 from functools import wraps
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from pathlib import Path
+from xml.etree import ElementTree
 
 import jwt
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session, send_file, make_response
+import click
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, session, send_file, make_response, Response, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
+import sqlalchemy
 from flask_bcrypt import Bcrypt
 from dotenv import load_dotenv
 from geopy.geocoders import Nominatim
-from geopy.distance import geodesic
+from geopy.exc import GeocoderTimedOut
 import polyline as pl
+import msgpack
+import numpy as np
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import padding, rsa
 from cryptography.hazmat.primitives.serialization import (
@@ -68,6 +90,136 @@ GEOCODING_API_KEY = os.environ.get('GEOCODING_API_KEY', '')
 GRAPHHOPPER_API_KEY = os.environ.get('GRAPHHOPPER_API_KEY', '')
 ORS_API_KEY = os.environ.get('ORS_API_KEY', '')
 NOMINATIM_USER_AGENT = "rutas_optimas_app_v1"
+NOMINATIM_HOST = 'nominatim.openstreetmap.org'
+# User-Agent del resto de servicios externos (OSRM, Mapbox, GraphHopper, ORS, reCAPTCHA)
+UPSTREAM_USER_AGENT = os.environ.get('UPSTREAM_USER_AGENT', f'rutas_optimas_app/1.0 {requests.utils.default_user_agent()}')
+
+# Configuración de cache de geocodificación
+GEOCODE_CACHE_MAX_ENTRIES = int(os.environ.get('GEOCODE_CACHE_MAX_ENTRIES', '20000'))
+GEOCODE_CACHE_SHARDS = int(os.environ.get('GEOCODE_CACHE_SHARDS', '16'))
+GEOCODE_TTL_NOMINATIM = int(os.environ.get('GEOCODE_TTL_NOMINATIM', str(7 * 24 * 3600)))
+GEOCODE_TTL_GAZETTEER = int(os.environ.get('GEOCODE_TTL_GAZETTEER', str(24 * 3600)))
+GEOCODE_TTL_FALLBACK = int(os.environ.get('GEOCODE_TTL_FALLBACK', '300'))
+GEOCODE_NEGATIVE_TTL = int(os.environ.get('GEOCODE_NEGATIVE_TTL', '600'))
+GEOCODE_ERROR_TTL = int(os.environ.get('GEOCODE_ERROR_TTL', '60'))
+
+# Cache de geocodificación inversa por celdas (tamaño de celda en metros)
+REVERSE_GEOCODE_CELL_M = float(os.environ.get('REVERSE_GEOCODE_CELL_M', '100'))
+REVERSE_GEOCODE_CACHE_MAX_ENTRIES = int(os.environ.get('REVERSE_GEOCODE_CACHE_MAX_ENTRIES', '50000'))
+REVERSE_GEOCODE_TTL = int(os.environ.get('REVERSE_GEOCODE_TTL', str(24 * 3600)))
+
+# Límite de uso de Nominatim (política pública: máximo 1 petición por segundo).
+# El límite es por proceso: con varios workers de gunicorn dividir la tasa entre ellos.
+NOMINATIM_RATE_PER_SEC = float(os.environ.get('NOMINATIM_RATE_PER_SEC', '1.0'))
+NOMINATIM_RATE_BURST = int(os.environ.get('NOMINATIM_RATE_BURST', '1'))
+NOMINATIM_RATE_WAIT = float(os.environ.get('NOMINATIM_RATE_WAIT', '5'))
+NOMINATIM_FAILURE_THRESHOLD = int(os.environ.get('NOMINATIM_FAILURE_THRESHOLD', '3'))
+NOMINATIM_BACKOFF_BASE = float(os.environ.get('NOMINATIM_BACKOFF_BASE', '30'))
+NOMINATIM_BACKOFF_MAX = float(os.environ.get('NOMINATIM_BACKOFF_MAX', '600'))
+GEOCODE_BATCH_MAX = int(os.environ.get('GEOCODE_BATCH_MAX', '2000'))
+GEOCODE_BATCH_WORKERS = int(os.environ.get('GEOCODE_BATCH_WORKERS', '4'))
+# Espera máxima de un turno de Nominatim para cada dirección de un lote (luego usa el fallback)
+GEOCODE_BATCH_RATE_WAIT = float(os.environ.get('GEOCODE_BATCH_RATE_WAIT', '60'))
+
+# Persistencia de la cache de geocodificación en la base de datos
+GEOCODE_PERSIST_ENABLED = os.environ.get('GEOCODE_PERSIST_ENABLED', 'True').lower() == 'true'
+GEOCODE_WARMUP_ENTRIES = int(os.environ.get('GEOCODE_WARMUP_ENTRIES', '2000'))
+GEOCODE_PERSIST_FLUSH_SECONDS = float(os.environ.get('GEOCODE_PERSIST_FLUSH_SECONDS', '5'))
+GEOCODE_PERSIST_BATCH = int(os.environ.get('GEOCODE_PERSIST_BATCH', '200'))
+# Si la base no responde, la persistencia se salta durante una pausa creciente
+GEOCODE_PERSIST_FAILURE_THRESHOLD = int(os.environ.get('GEOCODE_PERSIST_FAILURE_THRESHOLD', '2'))
+GEOCODE_PERSIST_BACKOFF_BASE = float(os.environ.get('GEOCODE_PERSIST_BACKOFF_BASE', '30'))
+GEOCODE_PERSIST_BACKOFF_MAX = float(os.environ.get('GEOCODE_PERSIST_BACKOFF_MAX', '600'))
+
+# Gazetteer offline de localidades (compilar con: flask --app app compile-gazetteer localidades.csv)
+GAZETTEER_PATH = os.environ.get('GAZETTEER_PATH', 'data/localidades_mx.bin')
+GAZETTEER_MAX_NGRAM = int(os.environ.get('GAZETTEER_MAX_NGRAM', '5'))
+
+# Red vial offline para el proveedor 'local' (compilar con: flask --app app compile-road-graph extracto.osm)
+ROAD_GRAPH_PATH = os.environ.get('ROAD_GRAPH_PATH', 'data/red_vial_mx.bin')
+ROAD_GRAPH_MAX_SNAP_KM = float(os.environ.get('ROAD_GRAPH_MAX_SNAP_KM', '5'))
+
+# Índice de casetas (CSV con tarifa de automóvil) y tramos de cuota (vías toll=yes de un extracto OSM)
+# (compilar con: flask --app app compile-toll-index casetas.csv --osm extracto.osm). Una caseta cuenta
+# como cruzada a menos de TOLL_PLAZA_RADIUS_M de la ruta; los tramos se muestrean cada TOLL_SAMPLE_M.
+# TOLL_CELL_DEG (celda de la rejilla) debe cubrir el mayor de los radios de captura
+TOLL_INDEX_PATH = os.environ.get('TOLL_INDEX_PATH', 'data/cuotas_mx.bin')
+TOLL_PLAZA_RADIUS_M = float(os.environ.get('TOLL_PLAZA_RADIUS_M', '150'))
+TOLL_SEGMENT_RADIUS_M = float(os.environ.get('TOLL_SEGMENT_RADIUS_M', '40'))
+TOLL_SAMPLE_M = float(os.environ.get('TOLL_SAMPLE_M', '250'))
+TOLL_MIN_KM = float(os.environ.get('TOLL_MIN_KM', '1.0'))
+TOLL_CELL_DEG = float(os.environ.get('TOLL_CELL_DEG', '0.002'))
+
+# Cache de rutas: origen/destino ajustados a una malla de ROUTE_CACHE_CELL_M metros
+ROUTE_CACHE_CELL_M = float(os.environ.get('ROUTE_CACHE_CELL_M', '250'))
+ROUTE_CACHE_MAX_ENTRIES = int(os.environ.get('ROUTE_CACHE_MAX_ENTRIES', '5000'))
+ROUTE_CACHE_TTL = int(os.environ.get('ROUTE_CACHE_TTL', '900'))
+
+# Proveedores de rutas en orden de preferencia (se omiten los que no tienen clave).
+# Carrera con cobertura: el siguiente proveedor arranca tras ROUTE_HEDGE_DELAY_MS sin
+# respuesta (0 = todos a la vez); el orden se ajusta por latencia promedio (EWMA).
+ROUTE_PROVIDERS = os.environ.get('ROUTE_PROVIDERS', 'osrm,mapbox,graphhopper,ors,local')
+ROUTE_HEDGE_DELAY_MS = float(os.environ.get('ROUTE_HEDGE_DELAY_MS', '1500'))
+ROUTE_HEDGE_WORKERS = int(os.environ.get('ROUTE_HEDGE_WORKERS', '16'))
+ROUTE_PROVIDER_TIMEOUT = float(os.environ.get('ROUTE_PROVIDER_TIMEOUT', '30'))
+ROUTE_LATENCY_ALPHA = float(os.environ.get('ROUTE_LATENCY_ALPHA', '0.3'))
+
+# Circuit breakers y timeouts adaptativos de servicios externos (Nominatim usa NOMINATIM_*).
+# El timeout es el percentil observado por el multiplicador, sin pasar del máximo de cada servicio.
+UPSTREAM_FAILURE_THRESHOLD = int(os.environ.get('UPSTREAM_FAILURE_THRESHOLD', '5'))
+UPSTREAM_OPEN_SECONDS = float(os.environ.get('UPSTREAM_OPEN_SECONDS', '15'))
+UPSTREAM_OPEN_MAX = float(os.environ.get('UPSTREAM_OPEN_MAX', '300'))
+UPSTREAM_TIMEOUT_PERCENTILE = float(os.environ.get('UPSTREAM_TIMEOUT_PERCENTILE', '99'))
+UPSTREAM_TIMEOUT_MULTIPLIER = float(os.environ.get('UPSTREAM_TIMEOUT_MULTIPLIER', '2.0'))
+UPSTREAM_TIMEOUT_MIN = float(os.environ.get('UPSTREAM_TIMEOUT_MIN', '1.0'))
+SMTP_TIMEOUT = float(os.environ.get('SMTP_TIMEOUT', '15'))
+
+# Optimización de rutas con varias paradas (OSRM /table admite hasta 100 coordenadas)
+ROUTE_OPTIMIZE_MAX_STOPS = int(os.environ.get('ROUTE_OPTIMIZE_MAX_STOPS', '100'))
+ROUTE_OPTIMIZE_TIME_BUDGET_MS = float(os.environ.get('ROUTE_OPTIMIZE_TIME_BUDGET_MS', '500'))
+ROUTE_FALLBACK_ROAD_FACTOR = float(os.environ.get('ROUTE_FALLBACK_ROAD_FACTOR', '1.3'))
+ROUTE_FALLBACK_SPEED_KMH = float(os.environ.get('ROUTE_FALLBACK_SPEED_KMH', '60'))
+
+# Matrices de distancia N×M: teselas de ROUTE_MATRIX_TILE orígenes × destinos por llamada
+# (el OSRM público admite 100 coordenadas por consulta /table)
+ROUTE_MATRIX_MAX = int(os.environ.get('ROUTE_MATRIX_MAX', '2000'))
+ROUTE_MATRIX_TILE = int(os.environ.get('ROUTE_MATRIX_TILE', '50'))
+ROUTE_MATRIX_WORKERS = int(os.environ.get('ROUTE_MATRIX_WORKERS', '8'))
+ROUTE_MATRIX_CACHE_TILES = int(os.environ.get('ROUTE_MATRIX_CACHE_TILES', '2000'))
+ROUTE_MATRIX_CACHE_TTL = int(os.environ.get('ROUTE_MATRIX_CACHE_TTL', str(6 * 3600)))
+
+# Servidor OSRM. El demo público admite ~1 petición/s: ahí las consultas /table se limitan a
+# OSRM_TABLE_RATE_PER_SEC y cada matriz a ROUTE_MATRIX_MAX_TILES teselas (0 = sin límite,
+# el valor por omisión con un servidor propio)
+OSRM_URL = os.environ.get('OSRM_URL', 'http://router.project-osrm.org').rstrip('/')
+OSRM_PUBLIC = urlsplit(OSRM_URL).hostname == 'router.project-osrm.org'
+OSRM_TABLE_RATE_PER_SEC = float(os.environ.get('OSRM_TABLE_RATE_PER_SEC', '1.0' if OSRM_PUBLIC else '0'))
+OSRM_TABLE_RATE_WAIT = float(os.environ.get('OSRM_TABLE_RATE_WAIT', '10'))
+ROUTE_MATRIX_MAX_TILES = int(os.environ.get('ROUTE_MATRIX_MAX_TILES', '4' if OSRM_PUBLIC else '0'))
+
+# Formatos de geometría de las rutas: GeoJSON o polilínea codificada (precisión 5 o 6)
+GEOMETRY_FORMATS = ('geojson', 'polyline5', 'polyline6')
+OSRM_GEOMETRY_PARAMS = {'geojson': 'geojson', 'polyline5': 'polyline', 'polyline6': 'polyline6'}
+
+# Niveles de detalle (LOD) de la geometría por zoom del mapa: tolerancia de
+# ROUTE_LOD_PIXEL_TOLERANCE píxeles a cada zoom; por encima del último se usa la geometría completa
+ROUTE_LOD_ZOOMS = tuple(sorted(int(z) for z in os.environ.get('ROUTE_LOD_ZOOMS', '6,9,12,15').split(',')))
+ROUTE_LOD_PIXEL_TOLERANCE = float(os.environ.get('ROUTE_LOD_PIXEL_TOLERANCE', '1.0'))
+
+# Rutas simuladas: ciudades intermedias a menos de SIM_CORRIDOR_KM del trayecto; del
+# gazetteer offline solo se consideran localidades con al menos SIM_CORRIDOR_MIN_POPULATION habitantes
+SIM_CORRIDOR_KM = float(os.environ.get('SIM_CORRIDOR_KM', '50'))
+SIM_CORRIDOR_MIN_POPULATION = int(os.environ.get('SIM_CORRIDOR_MIN_POPULATION', '20000'))
+
+# Simulación determinista: los atributos pseudoaleatorios de las rutas (retrasos, % de
+# carreteras principales, cuotas, ciudades) se derivan de un hash de la solicitud y de ROUTE_RANDOM_SEED
+ROUTE_DETERMINISTIC = os.environ.get('ROUTE_DETERMINISTIC', 'True').lower() == 'true'
+ROUTE_RANDOM_SEED = os.environ.get('ROUTE_RANDOM_SEED', '')
+
+# Pools de conexiones HTTP hacia servicios externos
+UPSTREAM_POOL_MAXSIZE = int(os.environ.get('UPSTREAM_POOL_MAXSIZE', '20'))
+UPSTREAM_RETRIES = int(os.environ.get('UPSTREAM_RETRIES', '2'))
+UPSTREAM_RETRY_BACKOFF = float(os.environ.get('UPSTREAM_RETRY_BACKOFF', '0.3'))
 
 # Configuración para firma digital
 SIGNATURE_MARKER = b"---SIGNATURE_METADATA_START---\n"
@@ -78,12 +230,1786 @@ PUBLIC_KEY_PATH = pathlib.Path("public_key.pem")
 # Inicializar geocodificador
 geolocator = Nominatim(user_agent=NOMINATIM_USER_AGENT, timeout=10)
 
+# ============================================
+# LIMITADOR DE TASA (TOKEN BUCKET)
+# ============================================
+class TokenBucket:
+    """
+    Limitador token-bucket compartido por todos los hilos del proceso. Los tokens
+    se reparten por turno: primero la prioridad más baja (0 = interactiva) y,
+    dentro de la misma prioridad, en orden de llegada, así nadie pierde su turno
+    frente a hilos que despiertan al mismo tiempo.
+    """
+    
+    def __init__(self, rate_per_sec, capacity=1):
+        self.rate = max(float(rate_per_sec), 1e-6)
+        self.capacity = max(1, int(capacity))
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self.condition = threading.Condition(threading.Lock())
+        self.waiters = []
+        self.next_ticket = 0
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        return now
+    
+    def acquire(self, timeout=None, priority=0):
+        """Espera un token; devuelve False si no se obtiene dentro de `timeout` segundos"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            ticket = (priority, self.next_ticket)
+            self.next_ticket += 1
+            heapq.heappush(self.waiters, ticket)
+            try:
+                while True:
+                    now = self._refill()
+                    # Solo el primero de la fila puede tomar el token; el resto espera su turno
+                    wait = None
+                    if self.waiters[0] == ticket:
+                        if self.tokens >= 1:
+                            self.tokens -= 1
+                            return True
+                        wait = (1 - self.tokens) / self.rate
+                    
+                    if deadline is not None:
+                        remaining = deadline - now
+                        if remaining <= 0 or (wait is not None and wait > remaining):
+                            return False
+                        wait = remaining if wait is None else wait
+                    self.condition.wait(wait)
+            finally:
+                self.waiters.remove(ticket)
+                heapq.heapify(self.waiters)
+                self.condition.notify_all()
+
+# Prioridades del limitador de Nominatim: las consultas interactivas pasan antes que los lotes
+NOMINATIM_PRIORITY_INTERACTIVE = 0
+NOMINATIM_PRIORITY_BATCH = 1
+nominatim_rate_limiter = TokenBucket(NOMINATIM_RATE_PER_SEC, NOMINATIM_RATE_BURST)
+osrm_table_rate_limiter = TokenBucket(OSRM_TABLE_RATE_PER_SEC) if OSRM_TABLE_RATE_PER_SEC > 0 else None
+
+# ============================================
+# CIRCUIT BREAKERS Y TIMEOUTS ADAPTATIVOS PARA SERVICIOS EXTERNOS
+# ============================================
+class CircuitBreaker:
+    """
+    Circuito cerrado/abierto/semiabierto: tras fallos consecutivos se abre y las
+    llamadas van directo al fallback; al vencer la pausa deja pasar una sola
+    prueba. La pausa crece exponencialmente con cada reapertura.
+    """
+    
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+    
+    def __init__(self, name, failure_threshold=5, base_delay=15, max_delay=300):
+        self.name = name
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.state_name = self.CLOSED
+        self.consecutive_failures = 0
+        self.trips = 0
+        self.total_failures = 0
+        self.skipped_calls = 0
+        self.open_until = 0.0
+        self.probe_started = 0.0
+        self.last_error = None
+    
+    def allow(self):
+        """Indica si se puede llamar al servicio (False con el circuito abierto)"""
+        with self.lock:
+            now = time.monotonic()
+            if self.state_name == self.CLOSED:
+                return True
+            
+            # Una sola prueba en semiabierto; si la prueba no reporta, se permite otra tras la pausa
+            probe_expired = now - self.probe_started >= self.current_delay()
+            if now >= self.open_until and (self.state_name == self.OPEN or probe_expired):
+                self.state_name = self.HALF_OPEN
+                self.probe_started = now
+                return True
+            
+            self.skipped_calls += 1
+            return False
+    
+    def current_delay(self):
+        return min(self.max_delay, self.base_delay * (2 ** max(0, self.trips - 1)))
+    
+    def record_success(self):
+        with self.lock:
+            if self.state_name != self.CLOSED:
+                print(f"✅ {self.name}: circuito cerrado de nuevo")
+            self.state_name = self.CLOSED
+            self.consecutive_failures = 0
+            self.trips = 0
+            self.open_until = 0.0
+    
+    def record_failure(self, error=None):
+        with self.lock:
+            self.consecutive_failures += 1
+            self.total_failures += 1
+            self.last_error = str(error) if error else None
+            
+            if self.state_name == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                self.trips += 1
+                delay = self.current_delay()
+                self.state_name = self.OPEN
+                self.open_until = time.monotonic() + delay
+                print(f"⏸️  {self.name}: circuito abierto tras {self.consecutive_failures} fallos, pausa de {delay:.0f}s")
+    
+    def state(self):
+        """Estado actual para monitoreo"""
+        with self.lock:
+            retry_in = max(0.0, self.open_until - time.monotonic())
+            return {
+                'name': self.name,
+                'state': self.state_name,
+                'retry_in_s': round(retry_in, 1),
+                'consecutive_failures': self.consecutive_failures,
+                'total_failures': self.total_failures,
+                'skipped_calls': self.skipped_calls,
+                'last_error': self.last_error
+            }
+
+class AdaptiveTimeout:
+    """Timeout derivado de un percentil de las latencias recientes, acotado entre mínimo y máximo"""
+    
+    def __init__(self, initial, minimum=1.0, maximum=30.0, percentile=99, multiplier=2.0, window=200, min_samples=20):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.percentile = percentile
+        self.multiplier = multiplier
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+        self.samples = deque(maxlen=window)
+        self.cached = None
+    
+    def observe(self, elapsed):
+        with self.lock:
+            self.samples.append(elapsed)
+            self.cached = None
+    
+    def current(self):
+        """Timeout en segundos para la próxima llamada"""
+        with self.lock:
+            if self.cached is None:
+                if len(self.samples) < self.min_samples:
+                    self.cached = self.initial
+                else:
+                    observed = float(np.percentile(np.fromiter(self.samples, dtype=np.float64), self.percentile))
+                    self.cached = min(self.maximum, max(self.minimum, observed * self.multiplier))
+            return self.cached
+    
+    def state(self):
+        with self.lock:
+            samples = np.fromiter(self.samples, dtype=np.float64)
+        return {
+            'timeout_s': round(self.current(), 2),
+            'samples': int(samples.size),
+            'p50_ms': round(float(np.percentile(samples, 50)) * 1000, 1) if samples.size else None,
+            'p99_ms': round(float(np.percentile(samples, 99)) * 1000, 1) if samples.size else None
+        }
+
+class UpstreamGuard:
+    """Circuit breaker y timeout adaptativo de un servicio externo"""
+    
+    def __init__(self, name, max_timeout, failure_threshold=5, base_delay=15, max_delay=300):
+        self.breaker = CircuitBreaker(name, failure_threshold, base_delay, max_delay)
+        self.timeouts = AdaptiveTimeout(
+            initial=max_timeout,
+            minimum=min(UPSTREAM_TIMEOUT_MIN, max_timeout),
+            maximum=max_timeout,
+            percentile=UPSTREAM_TIMEOUT_PERCENTILE,
+            multiplier=UPSTREAM_TIMEOUT_MULTIPLIER
+        )
+    
+    # Excepciones que indican que se agotó el timeout de la llamada
+    TIMEOUT_ERRORS = (requests.exceptions.Timeout, TimeoutError, GeocoderTimedOut)
+    
+    def allow(self):
+        return self.breaker.allow()
+    
+    def timeout(self):
+        # La prueba en semiabierto usa el máximo: el timeout adaptado puede haber quedado corto
+        if self.breaker.state_name == CircuitBreaker.HALF_OPEN:
+            return self.timeouts.maximum
+        return self.timeouts.current()
+    
+    def record_success(self, started):
+        self.timeouts.observe(time.monotonic() - started)
+        self.breaker.record_success()
+    
+    def record_failure(self, error=None):
+        # Un timeout cuenta como muestra al valor usado, para que el timeout pueda crecer
+        if isinstance(error, self.TIMEOUT_ERRORS):
+            self.timeouts.observe(self.timeout())
+        self.breaker.record_failure(error)
+    
+    def record_response(self, response, started):
+        """Los 5xx y 429 cuentan como fallo del servicio; el resto como respuesta válida"""
+        if response.status_code >= 500 or response.status_code == 429:
+            self.record_failure(f"HTTP {response.status_code}")
+        else:
+            self.record_success(started)
+    
+    def state(self):
+        return dict(self.breaker.state(), **self.timeouts.state())
+
+upstream_guards = {
+    'osrm': UpstreamGuard('OSRM', ROUTE_PROVIDER_TIMEOUT, UPSTREAM_FAILURE_THRESHOLD, UPSTREAM_OPEN_SECONDS, UPSTREAM_OPEN_MAX),
+    'mapbox': UpstreamGuard('Mapbox', ROUTE_PROVIDER_TIMEOUT, UPSTREAM_FAILURE_THRESHOLD, UPSTREAM_OPEN_SECONDS, UPSTREAM_OPEN_MAX),
+    'graphhopper': UpstreamGuard('GraphHopper', ROUTE_PROVIDER_TIMEOUT, UPSTREAM_FAILURE_THRESHOLD, UPSTREAM_OPEN_SECONDS, UPSTREAM_OPEN_MAX),
+    'ors': UpstreamGuard('ORS', ROUTE_PROVIDER_TIMEOUT, UPSTREAM_FAILURE_THRESHOLD, UPSTREAM_OPEN_SECONDS, UPSTREAM_OPEN_MAX),
+    'nominatim': UpstreamGuard('Nominatim', 10, NOMINATIM_FAILURE_THRESHOLD, NOMINATIM_BACKOFF_BASE, NOMINATIM_BACKOFF_MAX),
+    'recaptcha': UpstreamGuard('reCAPTCHA', 10, UPSTREAM_FAILURE_THRESHOLD, UPSTREAM_OPEN_SECONDS, UPSTREAM_OPEN_MAX),
+    'smtp': UpstreamGuard('SMTP', SMTP_TIMEOUT, UPSTREAM_FAILURE_THRESHOLD, UPSTREAM_OPEN_SECONDS, UPSTREAM_OPEN_MAX)
+}
+
+# ============================================
+# CLIENTE HTTP COMPARTIDO PARA SERVICIOS EXTERNOS
+# ============================================
+class UpstreamHTTPClient:
+    """Sesiones keep-alive por host con pool de conexiones acotado y reintentos de transporte"""
+    
+    def __init__(self, pool_maxsize=20, retries=2, backoff_factor=0.3):
+        self.pool_maxsize = pool_maxsize
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.pid = os.getpid()
+    
+    def _build_session(self, base_url):
+        # Reintentar solo fallos de conexión y 502/503/504 en GET (los POST no son idempotentes)
+        retry = Retry(
+            total=self.retries,
+            connect=self.retries,
+            read=0,
+            status=self.retries,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset(['GET', 'HEAD']),
+            backoff_factor=self.backoff_factor,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize, max_retries=retry)
+        
+        session = requests.Session()
+        # La identidad registrada ante Nominatim solo se usa con Nominatim
+        hostname = urlsplit(base_url).hostname
+        session.headers['User-Agent'] = NOMINATIM_USER_AGENT if hostname == NOMINATIM_HOST else UPSTREAM_USER_AGENT
+        session.mount(base_url, adapter)
+        return session
+    
+    def session_for(self, url):
+        """Sesión reutilizable para el host de la URL (segura entre hilos del worker)"""
+        parts = urlsplit(url)
+        base_url = f"{parts.scheme}://{parts.netloc}"
+        
+        with self.lock:
+            # Tras un fork (gunicorn --preload) no compartir sockets con el proceso padre
+            if self.pid != os.getpid():
+                self.sessions = {}
+                self.pid = os.getpid()
+            
+            session = self.sessions.get(base_url)
+            if session is None:
+                session = self._build_session(base_url)
+                self.sessions[base_url] = session
+            return session
+    
+    def get(self, url, **kwargs):
+        return self.session_for(url).get(url, **kwargs)
+    
+    def post(self, url, **kwargs):
+        return self.session_for(url).post(url, **kwargs)
+
+upstream_http = UpstreamHTTPClient(
+    pool_maxsize=UPSTREAM_POOL_MAXSIZE,
+    retries=UPSTREAM_RETRIES,
+    backoff_factor=UPSTREAM_RETRY_BACKOFF
+)
+
+# ============================================
+# COALESCENCIA DE PETICIONES (SINGLE-FLIGHT)
+# ============================================
+class InFlightCall:
+    """Llamada en curso compartida por todos los hilos que piden la misma clave"""
+    
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """Ejecuta una sola vez las llamadas concurrentes con la misma clave y reparte el resultado"""
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.executed = 0
+        self.shared = 0
+        self.expired = 0
+    
+    def do(self, key, fn, *args, wait_timeout=None, **kwargs):
+        """
+        Ejecuta fn o espera a la llamada en curso con la misma clave. Quien espera
+        lo hace como máximo `wait_timeout` segundos y luego recibe TimeoutError.
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = InFlightCall()
+                self.calls[key] = call
+                self.executed += 1
+            else:
+                self.shared += 1
+        
+        if not leader:
+            # Esperar a la llamada en curso en vez de repetirla (sin heredar la espera del líder)
+            if not call.done.wait(wait_timeout):
+                with self.lock:
+                    self.expired += 1
+                raise TimeoutError(f"Llamada compartida {key!r} sin respuesta tras {wait_timeout}s")
+            if call.error is not None:
+                raise call.error
+            return call.result
+        
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                self.calls.pop(key, None)
+            call.done.set()
+    
+    def stats(self):
+        with self.lock:
+            return {
+                'executed': self.executed,
+                'saved_calls': self.shared,
+                'expired_waits': self.expired,
+                'in_flight': len(self.calls)
+            }
+
+# ============================================
+# CACHE LRU CON TTL (SEGURA ENTRE HILOS)
+# ============================================
+class ShardedLRUCache:
+    """Cache LRU acotada, dividida en shards con lock propio y TTL por entrada"""
+    
+    def __init__(self, max_entries=10000, shards=16, default_ttl=3600):
+        self.num_shards = max(1, int(shards))
+        self.max_entries = max(self.num_shards, int(max_entries))
+        self.max_per_shard = self.max_entries // self.num_shards
+        self.default_ttl = default_ttl
+        self._shards = [OrderedDict() for _ in range(self.num_shards)]
+        self._locks = [threading.Lock() for _ in range(self.num_shards)]
+        
+        # Contadores por shard (se actualizan bajo el lock del shard)
+        self._hits = [0] * self.num_shards
+        self._misses = [0] * self.num_shards
+        self._evictions = [0] * self.num_shards
+        self._expirations = [0] * self.num_shards
+    
+    def _shard_index(self, key):
+        return hash(key) % self.num_shards
+    
+    def get(self, key, default=None):
+        """Obtiene un valor vigente; las entradas expiradas cuentan como fallo"""
+        idx = self._shard_index(key)
+        shard = self._shards[idx]
+        
+        with self._locks[idx]:
+            entry = shard.get(key)
+            if entry is None:
+                self._misses[idx] += 1
+                return default
+            
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del shard[key]
+                self._expirations[idx] += 1
+                self._misses[idx] += 1
+                return default
+            
+            shard.move_to_end(key)
+            self._hits[idx] += 1
+            return value
+    
+    def peek(self, key, default=None):
+        """Como get, pero sin tocar contadores ni el orden LRU (para sondeos auxiliares)"""
+        idx = self._shard_index(key)
+        with self._locks[idx]:
+            entry = self._shards[idx].get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            return default
+        return entry[1]
+    
+    def set(self, key, value, ttl=None):
+        """Guarda un valor con su TTL (segundos) y expulsa los menos usados"""
+        idx = self._shard_index(key)
+        shard = self._shards[idx]
+        expires_at = time.monotonic() + (self.default_ttl if ttl is None else ttl)
+        
+        with self._locks[idx]:
+            shard[key] = (expires_at, value)
+            shard.move_to_end(key)
+            while len(shard) > self.max_per_shard:
+                shard.popitem(last=False)
+                self._evictions[idx] += 1
+    
+    def delete(self, key):
+        idx = self._shard_index(key)
+        with self._locks[idx]:
+            self._shards[idx].pop(key, None)
+    
+    def clear(self):
+        for idx in range(self.num_shards):
+            with self._locks[idx]:
+                self._shards[idx].clear()
+    
+    def __len__(self):
+        return sum(len(shard) for shard in self._shards)
+    
+    def stats(self):
+        """Devuelve contadores agregados para monitoreo"""
+        hits = sum(self._hits)
+        misses = sum(self._misses)
+        total = hits + misses
+        return {
+            'entries': len(self),
+            'max_entries': self.max_per_shard * self.num_shards,
+            'shards': self.num_shards,
+            'hits': hits,
+            'misses': misses,
+            'evictions': sum(self._evictions),
+            'expirations': sum(self._expirations),
+            'hit_ratio': round(hits / total, 4) if total else 0.0
+        }
+
+# ============================================
+# ÍNDICE DE NOMBRES DEL GAZETTEER (AHO-CORASICK)
+# ============================================
+def normalize_address(text):
+    """Normaliza texto para búsquedas: minúsculas, sin acentos y sin espacios repetidos"""
+    text = unicodedata.normalize('NFKD', str(text).lower())
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return ' '.join(text.split())
+
+class GazetteerMatcher:
+    """Autómata Aho-Corasick que encuentra todos los nombres del gazetteer en una sola pasada"""
+    
+    def __init__(self, names):
+        # Transiciones, enlaces de fallo y nombres que terminan en cada estado
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [()]
+        
+        for name in names:
+            self._add(name)
+        self._build_failure_links()
+    
+    def _add(self, name):
+        state = 0
+        for ch in name:
+            next_state = self._goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][ch] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(())
+            state = next_state
+        self._output[state] = (name,)
+    
+    def _build_failure_links(self):
+        pending = deque(self._goto[0].values())
+        while pending:
+            state = pending.popleft()
+            for ch, next_state in self._goto[state].items():
+                pending.append(next_state)
+                
+                fail = self._fail[state]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(ch, 0)
+                
+                # Heredar las salidas del sufijo más largo reconocido
+                self._output[next_state] += self._output[self._fail[next_state]]
+    
+    def find_all(self, text):
+        """Devuelve (inicio, fin, nombre) para cada nombre que aparece como palabra completa"""
+        matches = []
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(ch, 0)
+            
+            for name in self._output[state]:
+                start = i - len(name) + 1
+                end = i + 1
+                if start > 0 and text[start - 1].isalnum():
+                    continue
+                if end < len(text) and text[end].isalnum():
+                    continue
+                matches.append((start, end, name))
+        return matches
+    
+    def best_match(self, text):
+        """Elige la coincidencia más larga (más específica); en empate, la primera"""
+        matches = self.find_all(text)
+        if not matches:
+            return None
+        return max(matches, key=lambda m: (m[1] - m[0], -m[0]))[2]
+
+class PrefixIndex:
+    """Índice de prefijos (lista ordenada + bisect) para autocompletar nombres del gazetteer"""
+    
+    def __init__(self, entries):
+        # entries: (clave normalizada, prioridad, payload); se indexa también cada palabra interna
+        self.payloads = []
+        items = []
+        for key, priority, payload in entries:
+            payload_id = len(self.payloads)
+            self.payloads.append(payload)
+            words = key.split()
+            for i in range(len(words)):
+                items.append((' '.join(words[i:]), 0 if i == 0 else 1, priority, payload_id))
+        items.sort()
+        self.items = items
+        self.keys = [item[0] for item in items]
+    
+    def search(self, prefix, limit=5, max_candidates=500):
+        """Devuelve hasta `limit` payloads cuyo nombre (o una de sus palabras) empieza con prefix"""
+        start = bisect.bisect_left(self.keys, prefix)
+        candidates = []
+        for position in range(start, min(len(self.keys), start + max_candidates)):
+            text, word_rank, priority, payload_id = self.items[position]
+            if not text.startswith(prefix):
+                break
+            # Exacto > inicio del nombre > palabra interna; luego prioridad y nombres cortos
+            score = (0 if text == prefix and word_rank == 0 else 1, word_rank, -priority, len(text), payload_id)
+            candidates.append((score, payload_id))
+        
+        results = []
+        seen = set()
+        for _, payload_id in sorted(candidates):
+            payload = self.payloads[payload_id]
+            if payload['name'] in seen:
+                continue
+            seen.add(payload['name'])
+            results.append(payload)
+            if len(results) >= limit:
+                break
+        return results
+
+# ============================================
+# ÍNDICE ESPACIAL PARA BÚSQUEDA DE LOCALIDADES CERCANAS
+# ============================================
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.195
+WEB_MERCATOR_M_PER_PX = 156543.03392  # metros por píxel a zoom 0 en el ecuador
+
+def haversine_km(lat1, lng1, lat2, lng2):
+    """Distancia haversine en km; acepta escalares o arrays de NumPy"""
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(v, dtype=np.float64)) for v in (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def segment_distance_km(lats, lngs, start_lat, start_lng, end_lat, end_lng):
+    """
+    Distancia (km) de cada punto al trayecto de círculo máximo entre inicio y fin,
+    y su avance a lo largo del trayecto (km); acepta arrays de NumPy
+    """
+    lat1, lng1, lat2, lng2 = np.radians([start_lat, start_lng, end_lat, end_lng])
+    latp = np.radians(np.asarray(lats, dtype=np.float64))
+    lngp = np.radians(np.asarray(lngs, dtype=np.float64))
+    
+    def bearing(lat_a, lng_a, lat_b, lng_b):
+        return np.arctan2(
+            np.sin(lng_b - lng_a) * np.cos(lat_b),
+            np.cos(lat_a) * np.sin(lat_b) - np.sin(lat_a) * np.cos(lat_b) * np.cos(lng_b - lng_a)
+        )
+    
+    length = haversine_km(start_lat, start_lng, end_lat, end_lng) / EARTH_RADIUS_KM
+    from_start = haversine_km(start_lat, start_lng, lats, lngs) / EARTH_RADIUS_KM
+    angle = bearing(lat1, lng1, latp, lngp) - bearing(lat1, lng1, lat2, lng2)
+    
+    cross = np.arcsin(np.clip(np.sin(from_start) * np.sin(angle), -1.0, 1.0))
+    along = np.arccos(np.clip(np.cos(from_start) / np.maximum(np.cos(cross), 1e-12), -1.0, 1.0))
+    along = np.where(np.cos(angle) < 0, -along, along)
+    
+    # Fuera del segmento la distancia es al extremo más cercano
+    distance = np.where(
+        along < 0, from_start,
+        np.where(along > length, haversine_km(end_lat, end_lng, lats, lngs) / EARTH_RADIUS_KM, np.abs(cross))
+    )
+    return distance * EARTH_RADIUS_KM, along * EARTH_RADIUS_KM
+
+def point_segment_distance(points, seg_start, seg_end):
+    """Distancia de cada punto a su segmento (arrays N×2 en coordenadas planas)"""
+    direction = seg_end - seg_start
+    length_sq = np.einsum('ij,ij->i', direction, direction)
+    t = np.einsum('ij,ij->i', points - seg_start, direction) / np.where(length_sq > 0, length_sq, 1.0)
+    projection = seg_start + np.clip(t, 0.0, 1.0)[:, None] * direction
+    return np.hypot(*(points - projection).T)
+
+def douglas_peucker_significance(xy):
+    """
+    Tolerancia a partir de la cual Douglas-Peucker descarta cada vértice (los extremos
+    nunca se descartan). Se procesan todos los segmentos de un mismo nivel a la vez,
+    así que simplificar a cualquier tolerancia es solo significance > tolerancia.
+    """
+    xy = np.asarray(xy, dtype=np.float64)
+    n = len(xy)
+    significance = np.zeros(n)
+    significance[[0, -1]] = np.inf
+    
+    starts = np.array([0])
+    ends = np.array([n - 1])
+    parents = np.array([np.inf])
+    
+    while starts.size:
+        keep = ends - starts >= 2
+        starts, ends, parents = starts[keep], ends[keep], parents[keep]
+        if not starts.size:
+            break
+        
+        # Vértices interiores de todos los segmentos pendientes en un solo array
+        lengths = ends - starts - 1
+        offsets = np.cumsum(lengths) - lengths
+        segment = np.repeat(np.arange(starts.size), lengths)
+        index = np.repeat(starts + 1 - offsets, lengths) + np.arange(lengths.sum())
+        
+        distance = point_segment_distance(xy[index], xy[starts][segment], xy[ends][segment])
+        
+        # Vértice más lejano de cada segmento (el primero en caso de empate)
+        best = np.maximum.reduceat(distance, offsets)
+        candidates = np.flatnonzero(distance == best[segment])
+        _, first = np.unique(segment[candidates], return_index=True)
+        split = index[candidates[first]]
+        
+        # La significancia nunca supera la del vértice padre: los niveles quedan anidados
+        value = np.minimum(best, parents)
+        significance[split] = value
+        
+        starts = np.concatenate((starts, split))
+        ends = np.concatenate((split, ends))
+        parents = np.concatenate((value, value))
+    
+    return significance
+
+class GeoGridIndex:
+    """Rejilla uniforme sobre arrays de NumPy con consultas de k vecinos y de radio (haversine)"""
+    
+    def __init__(self, lats, lngs, cell_deg=None, grid=None):
+        lats = np.asarray(lats)
+        lngs = np.asarray(lngs)
+        self.size = len(lats)
+        
+        if self.size == 0:
+            raise ValueError("El índice espacial requiere al menos un punto")
+        
+        if grid is not None:
+            # Rejilla precalculada (archivo compilado): los puntos ya vienen
+            # ordenados por celda, así que no se copian ni se recalculan
+            self.lat0 = float(grid['lat0'])
+            self.lng0 = float(grid['lng0'])
+            self.cell_deg = float(grid['cell_deg'])
+            self.rows = int(grid['rows'])
+            self.cols = int(grid['cols'])
+            self.max_abs_lat = float(grid['max_abs_lat'])
+            self.cell_keys = grid['cell_keys']
+            self.cell_starts = grid['cell_starts']
+            self.order = None
+            self.lats = lats
+            self.lngs = lngs
+            return
+        
+        self.lat0 = float(lats.min())
+        self.lng0 = float(lngs.min())
+        lat_span = float(lats.max()) - self.lat0
+        lng_span = float(lngs.max()) - self.lng0
+        self.max_abs_lat = float(np.abs(lats).max())
+        
+        # Tamaño de celda automático: ~4 puntos por celda en promedio
+        if cell_deg is None:
+            area = max(lat_span * lng_span, 1e-6)
+            cell_deg = min(5.0, max(0.01, math.sqrt(area * 4 / self.size)))
+        self.cell_deg = float(cell_deg)
+        self.rows = int(lat_span // self.cell_deg) + 1
+        self.cols = int(lng_span // self.cell_deg) + 1
+        
+        cell_ids = self._cell_ids(lats, lngs)
+        self.order = np.argsort(cell_ids, kind='stable')
+        sorted_ids = cell_ids[self.order]
+        self.lats = lats[self.order]
+        self.lngs = lngs[self.order]
+        
+        # Celdas no vacías ordenadas y el inicio de cada una en los arrays ordenados
+        self.cell_keys, starts = np.unique(sorted_ids, return_index=True)
+        self.cell_starts = np.append(starts, self.size)
+    
+    def grid_params(self):
+        """Parámetros de la rejilla para persistirla junto a los puntos ordenados"""
+        return {
+            'lat0': self.lat0,
+            'lng0': self.lng0,
+            'cell_deg': self.cell_deg,
+            'rows': self.rows,
+            'cols': self.cols,
+            'max_abs_lat': self.max_abs_lat
+        }
+    
+    def _cell_ids(self, lats, lngs):
+        rows = np.floor((np.asarray(lats, dtype=np.float64) - self.lat0) / self.cell_deg).astype(np.int64)
+        cols = np.floor((np.asarray(lngs, dtype=np.float64) - self.lng0) / self.cell_deg).astype(np.int64)
+        return rows * self.cols + cols
+    
+    def _query_cell(self, lat, lng):
+        return (int(math.floor((lat - self.lat0) / self.cell_deg)),
+                int(math.floor((lng - self.lng0) / self.cell_deg)))
+    
+    def _ring_slices(self, row, col, ring):
+        """Rangos de posiciones de las celdas no vacías a distancia Chebyshev `ring`"""
+        if ring == 0:
+            rows = np.array([row])
+            cols = np.array([col])
+        else:
+            span = np.arange(-ring, ring + 1)
+            side = np.arange(-ring + 1, ring)
+            rows = row + np.concatenate([np.full(span.size, -ring), np.full(span.size, ring), side, side])
+            cols = col + np.concatenate([span, span, np.full(side.size, -ring), np.full(side.size, ring)])
+        
+        inside = (rows >= 0) & (rows < self.rows) & (cols >= 0) & (cols < self.cols)
+        if not inside.any():
+            return []
+        
+        cell_ids = rows[inside] * self.cols + cols[inside]
+        found = np.searchsorted(self.cell_keys, cell_ids)
+        hit = found < len(self.cell_keys)
+        hit[hit] = self.cell_keys[found[hit]] == cell_ids[hit]
+        return [(int(self.cell_starts[i]), int(self.cell_starts[i + 1])) for i in found[hit]]
+    
+    def _max_ring(self, row, col):
+        return max(abs(row), abs(self.rows - 1 - row), abs(col), abs(self.cols - 1 - col))
+    
+    def _min_km_per_ring(self, lat):
+        # Cota conservadora: un grado de longitud se encoge con la latitud
+        max_lat = min(89.0, max(self.max_abs_lat, abs(lat)))
+        return self.cell_deg * KM_PER_DEGREE * math.cos(math.radians(max_lat))
+    
+    def _positions(self, slices):
+        if not slices:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([np.arange(start, end) for start, end in slices])
+    
+    def _result(self, positions, distances):
+        ids = positions if self.order is None else self.order[positions]
+        return [(int(i), float(d)) for i, d in zip(ids, distances)]
+    
+    def nearest(self, lat, lng, k=1):
+        """Devuelve los k puntos más cercanos como [(id, distancia_km), ...]"""
+        k = max(1, min(int(k), self.size))
+        row, col = self._query_cell(lat, lng)
+        km_per_ring = self._min_km_per_ring(lat)
+        
+        positions = np.empty(0, dtype=np.int64)
+        distances = np.empty(0, dtype=np.float64)
+        
+        for ring in range(self._max_ring(row, col) + 1):
+            new_positions = self._positions(self._ring_slices(row, col, ring))
+            if len(new_positions):
+                positions = np.concatenate([positions, new_positions])
+                distances = np.concatenate([
+                    distances,
+                    haversine_km(lat, lng, self.lats[new_positions], self.lngs[new_positions])
+                ])
+            
+            # Todo punto fuera de los anillos ya vistos está al menos a ring * celda
+            if len(positions) >= k:
+                kth = np.partition(distances, k - 1)[k - 1]
+                if kth <= ring * km_per_ring:
+                    break
+        
+        best = np.argsort(distances, kind='stable')[:k]
+        return self._result(positions[best], distances[best])
+    
+    def within_radius(self, lat, lng, radius_km, limit=None):
+        """Devuelve los puntos a menos de radius_km ordenados por distancia"""
+        row, col = self._query_cell(lat, lng)
+        km_per_ring = max(self._min_km_per_ring(lat), 1e-9)
+        max_ring = min(self._max_ring(row, col), int(math.ceil(radius_km / km_per_ring)) + 1)
+        
+        slices = []
+        for ring in range(max_ring + 1):
+            slices.extend(self._ring_slices(row, col, ring))
+        
+        positions = self._positions(slices)
+        if not len(positions):
+            return []
+        
+        distances = haversine_km(lat, lng, self.lats[positions], self.lngs[positions])
+        inside = distances <= radius_km
+        positions = positions[inside]
+        distances = distances[inside]
+        
+        best = np.argsort(distances, kind='stable')
+        if limit:
+            best = best[:limit]
+        return self._result(positions[best], distances[best])
+
+# ============================================
+# ARCHIVOS BINARIOS MAPEADOS EN MEMORIA
+# ============================================
+# Formato: MAGIC | uint64 longitud del encabezado | encabezado JSON | arrays alineados a 8 bytes.
+# Los workers mapean el archivo en solo lectura y comparten las páginas vía el page cache del SO.
+ARRAY_BUNDLE_MAGIC = b"RUTASBIN"
+
+def _align8(value):
+    return (value + 7) & ~7
+
+def write_array_bundle(path, arrays, meta):
+    """Escribe arrays de NumPy y metadatos en un archivo binario listo para mmap"""
+    layout = {}
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        arrays[name] = array
+        layout[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+        offset = _align8(offset + array.nbytes)
+    
+    header = json.dumps({'meta': meta, 'arrays': layout}).encode('utf-8')
+    data_start = _align8(len(ARRAY_BUNDLE_MAGIC) + 8 + len(header))
+    
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + '.tmp')
+    
+    with open(tmp_path, 'wb') as f:
+        f.write(ARRAY_BUNDLE_MAGIC)
+        f.write(len(header).to_bytes(8, 'little'))
+        f.write(header)
+        for name, array in arrays.items():
+            f.seek(data_start + layout[name]['offset'])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+    
+    # Reemplazo atómico: los workers que ya mapearon el archivo anterior no se ven afectados
+    os.replace(tmp_path, path)
+
+def load_array_bundle(path):
+    """Mapea en memoria un archivo de arrays; devuelve (meta, {nombre: array de solo lectura})"""
+    with open(path, 'rb') as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    
+    magic_len = len(ARRAY_BUNDLE_MAGIC)
+    if buffer[:magic_len] != ARRAY_BUNDLE_MAGIC:
+        raise ValueError(f"{path} no es un archivo de arrays válido")
+    
+    header_len = int.from_bytes(buffer[magic_len:magic_len + 8], 'little')
+    header = json.loads(buffer[magic_len + 8:magic_len + 8 + header_len].decode('utf-8'))
+    data_start = _align8(magic_len + 8 + header_len)
+    
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        dtype = np.dtype(spec['dtype'])
+        count = int(np.prod(spec['shape'], dtype=np.int64))
+        arrays[name] = np.frombuffer(
+            buffer, dtype=dtype, count=count, offset=data_start + spec['offset']
+        ).reshape(spec['shape'])
+    
+    return header['meta'], arrays
+
+def pack_strings(strings):
+    """Empaqueta cadenas en (offsets uint32, blob uint8) para guardarlas en un archivo binario"""
+    encoded = [value.encode('utf-8') for value in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.uint32)
+    offsets[1:] = np.cumsum([len(value) for value in encoded], dtype=np.uint64)
+    blob = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return offsets, blob
+
+# ============================================
+# GAZETTEER OFFLINE DE LOCALIDADES
+# ============================================
+def gazetteer_key(text):
+    """Clave de búsqueda: palabras alfanuméricas normalizadas separadas por un espacio"""
+    return ' '.join(re.findall(r'[a-z0-9]+', normalize_address(text)))
+
+class OfflineGazetteer:
+    """Catálogo de localidades compilado a disco y mapeado en memoria (compartido entre workers)"""
+    
+    FORMAT = 'gazetteer-v1'
+    
+    # Columnas aceptadas (catálogo INEGI de localidades o CSV genérico)
+    NAME_COLUMNS = ('NOM_LOC', 'nombre', 'name', 'localidad')
+    MUNICIPALITY_COLUMNS = ('NOM_MUN', 'municipio', 'municipality')
+    STATE_COLUMNS = ('NOM_ENT', 'estado', 'state')
+    LAT_COLUMNS = ('LAT_DECIMAL', 'lat', 'latitud', 'latitude')
+    LNG_COLUMNS = ('LON_DECIMAL', 'lng', 'lon', 'longitud', 'longitude')
+    POPULATION_COLUMNS = ('POB_TOTAL', 'poblacion', 'population')
+    
+    def __init__(self, path):
+        self.path = path
+        self.meta, arrays = load_array_bundle(path)
+        
+        if self.meta.get('format') != self.FORMAT:
+            raise ValueError(f"Formato de gazetteer no soportado: {self.meta.get('format')}")
+        
+        self.lats = arrays['lat']
+        self.lngs = arrays['lng']
+        self.population = arrays['population']
+        self.key_offsets = arrays['key_offsets']
+        self.key_blob = arrays['key_blob']
+        self.name_offsets = arrays['name_offsets']
+        self.name_blob = arrays['name_blob']
+        self.key_order = arrays['key_order']
+        self.size = len(self.lats)
+        
+        grid = dict(self.meta['grid'], cell_keys=arrays['cell_keys'], cell_starts=arrays['cell_starts'])
+        self.spatial_index = GeoGridIndex(self.lats, self.lngs, grid=grid)
+    
+    @staticmethod
+    def _column(fieldnames, candidates):
+        lookup = {name.strip().lower(): name for name in fieldnames}
+        for candidate in candidates:
+            if candidate.lower() in lookup:
+                return lookup[candidate.lower()]
+        return None
+    
+    @staticmethod
+    def _read_csv_rows(csv_path):
+        # El catálogo de INEGI suele venir en latin-1
+        for encoding in ('utf-8-sig', 'latin-1'):
+            try:
+                with open(csv_path, newline='', encoding=encoding) as f:
+                    return list(csv.DictReader(f))
+            except UnicodeDecodeError:
+                continue
+        return []
+    
+    @classmethod
+    def compile_csv(cls, csv_path, output_path):
+        """Compila un CSV de localidades al formato binario; devuelve el número de localidades"""
+        rows = cls._read_csv_rows(csv_path)
+        if not rows:
+            raise ValueError(f"{csv_path} no contiene localidades")
+        
+        fieldnames = rows[0].keys()
+        name_col = cls._column(fieldnames, cls.NAME_COLUMNS)
+        lat_col = cls._column(fieldnames, cls.LAT_COLUMNS)
+        lng_col = cls._column(fieldnames, cls.LNG_COLUMNS)
+        if not (name_col and lat_col and lng_col):
+            raise ValueError("El CSV requiere columnas de nombre, latitud y longitud")
+        mun_col = cls._column(fieldnames, cls.MUNICIPALITY_COLUMNS)
+        state_col = cls._column(fieldnames, cls.STATE_COLUMNS)
+        pop_col = cls._column(fieldnames, cls.POPULATION_COLUMNS)
+        
+        keys, names, lats, lngs, population = [], [], [], [], []
+        for row in rows:
+            name = (row.get(name_col) or '').strip()
+            key = gazetteer_key(name)
+            try:
+                lat = float(row[lat_col])
+                lng = float(row[lng_col])
+            except (TypeError, ValueError):
+                continue
+            if not key:
+                continue
+            
+            # Nombre para mostrar: "Localidad, Municipio, Estado" sin repetir partes
+            parts = [name]
+            for col in (mun_col, state_col):
+                value = (row.get(col) or '').strip() if col else ''
+                if value and value not in parts:
+                    parts.append(value)
+            
+            try:
+                pop = int(float(row.get(pop_col) or 0)) if pop_col else 0
+            except ValueError:
+                pop = 0
+            
+            keys.append(key)
+            names.append(', '.join(parts))
+            lats.append(lat)
+            lngs.append(lng)
+            population.append(max(0, pop))
+        
+        if not keys:
+            raise ValueError(f"{csv_path} no contiene localidades con coordenadas válidas")
+        
+        # Ordenar los registros por celda de la rejilla para consultas espaciales sin copias
+        index = GeoGridIndex(np.array(lats), np.array(lngs))
+        order = index.order
+        keys = [keys[i] for i in order]
+        names = [names[i] for i in order]
+        
+        key_offsets, key_blob = pack_strings(keys)
+        name_offsets, name_blob = pack_strings(names)
+        encoded_keys = [key.encode('utf-8') for key in keys]
+        key_order = np.array(sorted(range(len(keys)), key=encoded_keys.__getitem__), dtype=np.uint32)
+        
+        arrays = {
+            'lat': index.lats.astype(np.float32),
+            'lng': index.lngs.astype(np.float32),
+            'population': np.array(population, dtype=np.uint32)[order],
+            'key_offsets': key_offsets,
+            'key_blob': key_blob,
+            'name_offsets': name_offsets,
+            'name_blob': name_blob,
+            'key_order': key_order,
+            'cell_keys': index.cell_keys,
+            'cell_starts': index.cell_starts
+        }
+        meta = {
+            'format': cls.FORMAT,
+            'count': len(keys),
+            'source': os.path.basename(str(csv_path)),
+            'compiled_at': datetime.utcnow().isoformat(),
+            'grid': index.grid_params()
+        }
+        write_array_bundle(output_path, arrays, meta)
+        return len(keys)
+    
+    def _key_bytes(self, record_id):
+        return self.key_blob[self.key_offsets[record_id]:self.key_offsets[record_id + 1]].tobytes()
+    
+    def _name(self, record_id):
+        return self.name_blob[self.name_offsets[record_id]:self.name_offsets[record_id + 1]].tobytes().decode('utf-8')
+    
+    def _lower_bound(self, target):
+        """Primera posición de key_order cuya clave es >= target (búsqueda binaria)"""
+        lo, hi = 0, self.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key_bytes(int(self.key_order[mid])) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+    
+    def find_exact(self, key):
+        """Ids de todas las localidades cuya clave es exactamente `key`"""
+        target = key.encode('utf-8')
+        position = self._lower_bound(target)
+        ids = []
+        while position < self.size:
+            record_id = int(self.key_order[position])
+            if self._key_bytes(record_id) != target:
+                break
+            ids.append(record_id)
+            position += 1
+        return ids
+    
+    def record(self, record_id):
+        return {
+            'key': self._key_bytes(record_id).decode('utf-8'),
+            'name': self._name(record_id),
+            'lat': round(float(self.lats[record_id]), 6),
+            'lng': round(float(self.lngs[record_id]), 6),
+            'population': int(self.population[record_id])
+        }
+    
+    # Prefijos de vialidad: el nombre que sigue (hasta el número) es la calle, no la localidad
+    STREET_PREFIXES = frozenset((
+        'calle', 'av', 'avenida', 'blvd', 'boulevard', 'bulevar', 'calz', 'calzada',
+        'carr', 'carretera', 'priv', 'privada', 'prol', 'prolongacion', 'andador',
+        'cerrada', 'circuito', 'eje', 'retorno'
+    ))
+    
+    @classmethod
+    def locality_runs(cls, address_lower):
+        """Tramos de palabras de cada segmento sin los nombres de calle ("Av. Hidalgo 10" se descarta)"""
+        runs = []
+        for segment in address_lower.split(','):
+            run, in_street, street_named = [], False, False
+            for word in re.findall(r'[a-z0-9]+', segment):
+                if word in cls.STREET_PREFIXES:
+                    in_street, street_named = True, False
+                elif in_street:
+                    # El número tras el nombre cierra la calle ("Calle 5 de Mayo 20")
+                    numeric = any(ch.isdigit() for ch in word)
+                    in_street = not (numeric and street_named)
+                    street_named = street_named or not numeric
+                    continue
+                else:
+                    run.append(word)
+                    continue
+                if run:
+                    runs.append(run)
+                run = []
+            if run:
+                runs.append(run)
+        return runs
+    
+    def match(self, address_lower):
+        """Busca la localidad más específica mencionada en la dirección, fuera del nombre de la calle (sin red)"""
+        runs = self.locality_runs(address_lower)
+        context = {word for words in runs for word in words if len(word) > 3}
+        
+        best_key, best_ids = None, []
+        for words in runs:
+            for n in range(min(GAZETTEER_MAX_NGRAM, len(words)), 0, -1):
+                for i in range(len(words) - n + 1):
+                    gram = ' '.join(words[i:i + n])
+                    if len(gram) < 4 or gram.isdigit():
+                        continue
+                    if best_key and len(gram) <= len(best_key):
+                        continue
+                    ids = self.find_exact(gram)
+                    if ids:
+                        best_key, best_ids = gram, ids
+        
+        if not best_ids:
+            return None
+        
+        # Desempatar homónimos con el resto de la dirección (municipio/estado) y la población
+        def score(record_id):
+            name_words = set(re.findall(r'[a-z0-9]+', normalize_address(self._name(record_id))))
+            overlap = len((context - set(best_key.split())) & name_words)
+            return (overlap, int(self.population[record_id]))
+        
+        return self.record(max(best_ids[:2000], key=score))
+    
+    def nearest(self, lat, lng):
+        """Devuelve (localidad, distancia_km) de la localidad más cercana"""
+        record_id, distance = self.spatial_index.nearest(lat, lng, k=1)[0]
+        return self.record(record_id), distance
+    
+    def suggest(self, prefix, limit=5, max_candidates=500):
+        """Localidades cuya clave empieza con prefix, priorizando coincidencia exacta y población"""
+        target = prefix.encode('utf-8')
+        position = self._lower_bound(target)
+        candidates = []
+        while position < self.size and len(candidates) < max_candidates:
+            record_id = int(self.key_order[position])
+            key = self._key_bytes(record_id)
+            if not key.startswith(target):
+                break
+            candidates.append((0 if key == target else 1, -int(self.population[record_id]), record_id))
+            position += 1
+        
+        return [self.record(record_id) for _, _, record_id in sorted(candidates)[:limit]]
+
+# ============================================
+# ENRUTADOR OFFLINE SOBRE LA RED VIAL (CONTRACTION HIERARCHIES)
+# ============================================
+class RoadGraphRouter:
+    """
+    Red vial de un extracto de OSM con contraction hierarchies, guardada como arrays
+    CSR en un archivo mapeado en memoria. Cada nodo solo guarda sus aristas hacia
+    nodos de mayor rango (hacia adelante y hacia atrás); las consultas son un
+    Dijkstra bidireccional ascendente que visita pocos cientos de nodos.
+    """
+    
+    FORMAT = 'road-graph-ch-v1'
+    
+    # Velocidad por defecto (km/h) por tipo de vía de OSM; otras vías no se consideran
+    HIGHWAY_SPEEDS = {
+        'motorway': 100, 'motorway_link': 60, 'trunk': 90, 'trunk_link': 50,
+        'primary': 70, 'primary_link': 45, 'secondary': 60, 'secondary_link': 40,
+        'tertiary': 50, 'tertiary_link': 35, 'unclassified': 40, 'residential': 30,
+        'living_street': 10, 'service': 20, 'road': 40
+    }
+    ONEWAY_HIGHWAYS = ('motorway', 'motorway_link')
+    NO_ACCESS = ('no', 'private')
+    WITNESS_SETTLE_LIMIT = 200
+    
+    def __init__(self, path):
+        self.path = path
+        self.meta, arrays = load_array_bundle(path)
+        
+        if self.meta.get('format') != self.FORMAT:
+            raise ValueError(f"Formato de red vial no soportado: {self.meta.get('format')}")
+        
+        self.lats = arrays['lat']
+        self.lngs = arrays['lng']
+        self.size = len(self.lats)
+        
+        # Aristas ascendentes: fwd (u -> nodo de mayor rango) y bwd (nodo de mayor rango -> u)
+        self.fwd = (arrays['fwd_offsets'], arrays['fwd_nodes'], arrays['fwd_weights'])
+        self.bwd = (arrays['bwd_offsets'], arrays['bwd_nodes'], arrays['bwd_weights'])
+        self.fwd_extra = (arrays['fwd_distances'], arrays['fwd_middle'], arrays['fwd_toll'])
+        self.bwd_extra = (arrays['bwd_distances'], arrays['bwd_middle'], arrays['bwd_toll'])
+        
+        grid = dict(self.meta['grid'], cell_keys=arrays['cell_keys'], cell_starts=arrays['cell_starts'])
+        self.spatial_index = GeoGridIndex(self.lats, self.lngs, grid=grid)
+    
+    @staticmethod
+    def _open(osm_path):
+        osm_path = str(osm_path)
+        if osm_path.endswith('.gz'):
+            return gzip.open(osm_path, 'rb')
+        if osm_path.endswith('.bz2'):
+            return bz2.open(osm_path, 'rb')
+        return open(osm_path, 'rb')
+    
+    @staticmethod
+    def _speed(tags, default):
+        """Velocidad de la vía: maxspeed numérico en km/h si existe, si no la del tipo de vía"""
+        match = re.match(r'\s*(\d+(?:\.\d+)?)\s*(km/h|kmh)?\s*$', tags.get('maxspeed', ''))
+        return float(match.group(1)) if match and float(match.group(1)) > 0 else float(default)
+    
+    @classmethod
+    def _iter_osm(cls, osm_path):
+        """
+        Elementos de primer nivel (node, way, relation) del extracto en streaming:
+        tras procesar cada uno se vacía la raíz, así la memoria no crece con el archivo
+        """
+        with cls._open(osm_path) as f:
+            root = None
+            for event, elem in ElementTree.iterparse(f, events=('start', 'end')):
+                if root is None:
+                    root = elem
+                if event == 'end' and elem.tag in ('node', 'way', 'relation'):
+                    yield elem
+                    root.clear()
+    
+    @classmethod
+    def _read_osm(cls, osm_path):
+        """Dos pasadas con iterparse: vías transitables y luego solo los nodos que usan"""
+        segments = []
+        needed = set()
+        
+        for elem in cls._iter_osm(osm_path):
+            if elem.tag != 'way':
+                continue
+            tags = {tag.get('k'): tag.get('v') for tag in elem.iter('tag')}
+            highway = tags.get('highway')
+            if (highway in cls.HIGHWAY_SPEEDS
+                    and tags.get('access') not in cls.NO_ACCESS
+                    and tags.get('motor_vehicle') not in cls.NO_ACCESS):
+                refs = [int(nd.get('ref')) for nd in elem.iter('nd')]
+                oneway = tags.get('oneway', '')
+                if oneway == '-1':
+                    refs.reverse()
+                forward_only = (
+                    oneway in ('yes', 'true', '1', '-1')
+                    or highway in cls.ONEWAY_HIGHWAYS
+                    or tags.get('junction') == 'roundabout'
+                )
+                speed = cls._speed(tags, cls.HIGHWAY_SPEEDS[highway])
+                toll = tags.get('toll') == 'yes'
+                
+                for a, b in zip(refs, refs[1:]):
+                    segments.append((a, b, speed, toll, not forward_only))
+                needed.update(refs)
+        
+        coordinates = {}
+        for elem in cls._iter_osm(osm_path):
+            if elem.tag == 'node':
+                node_id = int(elem.get('id'))
+                if node_id in needed:
+                    coordinates[node_id] = (float(elem.get('lat')), float(elem.get('lon')))
+        
+        return segments, coordinates
+    
+    @classmethod
+    def _witness_search(cls, out, source, skip, max_cost):
+        """Dijkstra acotado desde source sin pasar por skip (búsqueda de testigos)"""
+        dist = {source: 0.0}
+        heap = [(0.0, source)]
+        settled = 0
+        while heap and settled < cls.WITNESS_SETTLE_LIMIT:
+            d, u = heapq.heappop(heap)
+            if d > dist[u]:
+                continue
+            if d > max_cost:
+                break
+            settled += 1
+            for x, edge in out[u].items():
+                if x == skip:
+                    continue
+                nd = d + edge[0]
+                if nd < dist.get(x, math.inf):
+                    dist[x] = nd
+                    heapq.heappush(heap, (nd, x))
+        return dist
+    
+    @classmethod
+    def _shortcuts(cls, out, inn, v):
+        """Atajos necesarios al contraer v: (u, x, peso, distancia, cuota)"""
+        shortcuts = []
+        for u, (w_uv, d_uv, toll_uv, _) in inn[v].items():
+            targets = {x: w_uv + edge[0] for x, edge in out[v].items() if x != u}
+            if not targets:
+                continue
+            dist = cls._witness_search(out, u, v, max(targets.values()))
+            for x, via in targets.items():
+                if dist.get(x, math.inf) > via + 1e-9:
+                    edge = out[v][x]
+                    shortcuts.append((u, x, via, d_uv + edge[1], toll_uv or edge[2]))
+        return shortcuts
+    
+    @classmethod
+    def _contract(cls, n, out, inn):
+        """
+        Contrae primero los nodos intermedios de cadenas y luego el resto en orden de
+        diferencia de aristas (con actualización perezosa); devuelve las aristas
+        ascendentes (nodo, vecino, peso, distancia, intermedio, cuota)
+        """
+        deleted_neighbors = [0] * n
+        contracted = [False] * n
+        up_fwd, up_bwd = [], []
+        
+        def priority(v):
+            shortcuts = cls._shortcuts(out, inn, v)
+            return len(shortcuts) - len(inn[v]) - len(out[v]) + deleted_neighbors[v], shortcuts
+        
+        def contract(v, shortcuts):
+            # Las aristas que le quedan a v van a nodos aún no contraídos (de mayor rango)
+            for x, (w, d, toll, middle) in out[v].items():
+                up_fwd.append((v, x, w, d, middle, toll))
+                del inn[x][v]
+                deleted_neighbors[x] += 1
+            for u, (w, d, toll, middle) in inn[v].items():
+                up_bwd.append((v, u, w, d, middle, toll))
+                del out[u][v]
+                deleted_neighbors[u] += 1
+            out[v] = {}
+            inn[v] = {}
+            contracted[v] = True
+            
+            for u, x, w, d, toll in shortcuts:
+                current = out[u].get(x)
+                if current is None or current[0] > w:
+                    out[u][x] = inn[x][u] = (w, d, toll, v)
+        
+        def chain_neighbors(v):
+            neighbors = set(inn[v]) | set(out[v])
+            return neighbors if len(neighbors) == 2 else None
+        
+        # Nodos de grado 2 (los puntos de forma de cada vía): unir a sus dos vecinos no
+        # requiere búsqueda de testigos y deja para el heap solo las intersecciones
+        pending = [v for v in range(n) if chain_neighbors(v)]
+        while pending:
+            v = pending.pop()
+            if contracted[v]:
+                continue
+            neighbors = chain_neighbors(v)
+            if not neighbors:
+                continue
+            contract(v, [
+                (u, x, w_uv + edge[0], d_uv + edge[1], toll_uv or edge[2])
+                for u, (w_uv, d_uv, toll_uv, _) in inn[v].items()
+                for x, edge in out[v].items() if x != u
+            ])
+            pending.extend(u for u in neighbors if chain_neighbors(u))
+        
+        heap = [(priority(v)[0], v) for v in range(n) if not contracted[v]]
+        heapq.heapify(heap)
+        
+        while heap:
+            _, v = heapq.heappop(heap)
+            value, shortcuts = priority(v)
+            if heap and value > heap[0][0]:
+                heapq.heappush(heap, (value, v))
+                continue
+            contract(v, shortcuts)
+        
+        return up_fwd, up_bwd
+    
+    @staticmethod
+    def _csr(edges, n, prefix):
+        """Aristas (nodo, vecino, peso, distancia, intermedio, cuota) a arrays CSR por nodo"""
+        edges.sort(key=lambda edge: edge[0])
+        columns = list(zip(*edges)) if edges else [[]] * 6
+        counts = np.bincount(np.array(columns[0], dtype=np.int64), minlength=n)
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(counts)
+        return {
+            f'{prefix}_offsets': offsets,
+            f'{prefix}_nodes': np.array(columns[1], dtype=np.int32),
+            f'{prefix}_weights': np.array(columns[2], dtype=np.float32),
+            f'{prefix}_distances': np.array(columns[3], dtype=np.float32),
+            f'{prefix}_middle': np.array(columns[4], dtype=np.int32),
+            f'{prefix}_toll': np.array(columns[5], dtype=np.uint8)
+        }
+    
+    @classmethod
+    def compile_osm(cls, osm_path, output_path):
+        """Compila un extracto OSM (.osm, .osm.gz, .osm.bz2) a la red vial con CH; devuelve (nodos, aristas)"""
+        segments, coordinates = cls._read_osm(osm_path)
+        segments = [seg for seg in segments if seg[0] in coordinates and seg[1] in coordinates]
+        if not segments:
+            raise ValueError(f"{osm_path} no contiene vías transitables")
+        
+        # Nodos ordenados por celda de la rejilla: su posición es su identificador
+        osm_ids = sorted({node for seg in segments for node in seg[:2]})
+        lats = np.array([coordinates[node][0] for node in osm_ids])
+        lngs = np.array([coordinates[node][1] for node in osm_ids])
+        index = GeoGridIndex(lats, lngs)
+        position = np.empty(len(osm_ids), dtype=np.int64)
+        position[index.order] = np.arange(len(osm_ids))
+        node_of = {node: int(position[i]) for i, node in enumerate(osm_ids)}
+        
+        a = np.array([node_of[seg[0]] for seg in segments])
+        b = np.array([node_of[seg[1]] for seg in segments])
+        length_m = haversine_km(index.lats[a], index.lngs[a], index.lats[b], index.lngs[b]) * 1000
+        duration_s = length_m / (np.array([seg[2] for seg in segments]) / 3.6)
+        
+        n = len(osm_ids)
+        out = [{} for _ in range(n)]
+        inn = [{} for _ in range(n)]
+        
+        def add_edge(u, v, w, d, toll):
+            if u != v and (v not in out[u] or out[u][v][0] > w):
+                out[u][v] = inn[v][u] = (w, d, toll, -1)
+        
+        for k, seg in enumerate(segments):
+            u, v = int(a[k]), int(b[k])
+            w, d = float(duration_s[k]), float(length_m[k])
+            add_edge(u, v, w, d, seg[3])
+            if seg[4]:
+                add_edge(v, u, w, d, seg[3])
+        
+        print(f"🛣️  Contrayendo red vial: {n} nodos, {len(segments)} tramos")
+        up_fwd, up_bwd = cls._contract(n, out, inn)
+        
+        arrays = {
+            'lat': index.lats,
+            'lng': index.lngs,
+            'cell_keys': index.cell_keys,
+            'cell_starts': index.cell_starts
+        }
+        arrays.update(cls._csr(up_fwd, n, 'fwd'))
+        arrays.update(cls._csr(up_bwd, n, 'bwd'))
+        meta = {
+            'format': cls.FORMAT,
+            'nodes': n,
+            'edges': len(up_fwd) + len(up_bwd),
+            'source': os.path.basename(str(osm_path)),
+            'compiled_at': datetime.utcnow().isoformat(),
+            'grid': index.grid_params()
+        }
+        write_array_bundle(output_path, arrays, meta)
+        return n, len(up_fwd) + len(up_bwd)
+    
+    def _find_edge(self, graph, node, neighbor):
+        offsets, nodes, _ = graph
+        start, end = int(offsets[node]), int(offsets[node + 1])
+        return start + int(np.flatnonzero(nodes[start:end] == neighbor)[0])
+    
+    def _unpack(self, a, b, middle, path):
+        """Expande un atajo a→b en los nodos originales (se agregan a path sin a)"""
+        stack = [(a, b, middle)]
+        while stack:
+            a, b, middle = stack.pop()
+            if middle < 0:
+                path.append(b)
+                continue
+            # a→m está entre las aristas bwd de m y m→b entre sus aristas fwd
+            first = self._find_edge(self.bwd, middle, a)
+            second = self._find_edge(self.fwd, middle, b)
+            stack.append((middle, b, int(self.fwd_extra[1][second])))
+            stack.append((a, middle, int(self.bwd_extra[1][first])))
+    
+    def shortest_path(self, source, target):
+        """Camino más rápido entre dos nodos; devuelve (nodos, segundos, metros, cuota) o None"""
+        dist = ({source: 0.0}, {target: 0.0})
+        parent = ({source: None}, {target: None})
+        heaps = ([(0.0, source)], [(0.0, target)])
+        graphs = (self.fwd, self.bwd)
+        best, meet = math.inf, None
+        
+        while True:
+            # Avanzar el lado con el menor costo pendiente; terminar cuando ninguno puede mejorar
+            tops = [heap[0][0] if heap else math.inf for heap in heaps]
+            side = 0 if tops[0] <= tops[1] else 1
+            if tops[side] >= best:
+                break
+            
+            d, u = heapq.heappop(heaps[side])
+            if d > dist[side][u]:
+                continue
+            
+            other = dist[1 - side].get(u)
+            if other is not None and d + other < best:
+                best, meet = d + other, u
+            
+            offsets, nodes, weights = graphs[side]
+            for e in range(int(offsets[u]), int(offsets[u + 1])):
+                x = int(nodes[e])
+                nd = d + float(weights[e])
+                if nd < dist[side].get(x, math.inf):
+                    dist[side][x] = nd
+                    parent[side][x] = (u, e)
+                    heapq.heappush(heaps[side], (nd, x))
+        
+        if meet is None:
+            return None
+        
+        # Aristas de la jerarquía: source→meet (fwd) y meet→target (bwd), luego desempaquetar
+        hops = []
+        node = meet
+        while parent[0][node] is not None:
+            prev, e = parent[0][node]
+            hops.append((prev, node, e, self.fwd_extra))
+            node = prev
+        hops.reverse()
+        node = meet
+        while parent[1][node] is not None:
+            prev, e = parent[1][node]
+            hops.append((node, prev, e, self.bwd_extra))
+            node = prev
+        
+        path = [source]
+        meters = 0.0
+        toll = False
+        for a, b, e, (distances, middle, tolls) in hops:
+            meters += float(distances[e])
+            toll = toll or bool(tolls[e])
+            self._unpack(a, b, int(middle[e]), path)
+        
+        return path, best, meters, toll
+    
+    def route(self, start_lat, start_lng, end_lat, end_lng):
+        """Ruta entre dos coordenadas ajustadas al nodo más cercano de la red; None si no hay"""
+        source, source_km = self.spatial_index.nearest(start_lat, start_lng, k=1)[0]
+        target, target_km = self.spatial_index.nearest(end_lat, end_lng, k=1)[0]
+        if max(source_km, target_km) > ROAD_GRAPH_MAX_SNAP_KM:
+            return None
+        
+        result = self.shortest_path(source, target)
+        if result is None:
+            return None
+        
+        path, seconds, meters, toll = result
+        nodes = np.array(path, dtype=np.int64)
+        return {
+            'coordinates': np.column_stack((self.lngs[nodes], self.lats[nodes])).tolist(),
+            'duration_s': seconds,
+            'distance_m': meters,
+            'has_tolls': toll
+        }
+
+# ============================================
+# ÍNDICE DE CASETAS Y TRAMOS DE CUOTA
+# ============================================
+class TollIndex:
+    """
+    Casetas con tarifa y puntos muestreados de los tramos de cuota en una rejilla
+    compilada a disco. Cada geometría de ruta se cruza con el índice en una sola
+    pasada vectorizada: presencia real de cuotas, casetas cruzadas y costo.
+    """
+    
+    FORMAT = 'toll-index-v1'
+    PLAZA = 0
+    SEGMENT = 1
+    
+    NAME_COLUMNS = ('nombre', 'caseta', 'name', 'plaza')
+    LAT_COLUMNS = ('lat', 'latitud', 'latitude')
+    LNG_COLUMNS = ('lng', 'lon', 'longitud', 'longitude')
+    TARIFF_COLUMNS = ('tarifa', 'tarifa_auto', 'automovil', 'tariff', 'toll')
+    
+    def __init__(self, path):
+        self.path = path
+        self.meta, arrays = load_array_bundle(path)
+        
+        if self.meta.get('format') != self.FORMAT:
+            raise ValueError(f"Formato de índice de cuotas no soportado: {self.meta.get('format')}")
+        
+        self.lats = arrays['lat']
+        self.lngs = arrays['lng']
+        self.kinds = arrays['kind']
+        self.tariffs = arrays['tariff']
+        self.weights = arrays['weight_m']
+        self.name_offsets = arrays['name_offsets']
+        self.name_blob = arrays['name_blob']
+        self.size = len(self.lats)
+        
+        grid = dict(self.meta['grid'], cell_keys=arrays['cell_keys'], cell_starts=arrays['cell_starts'])
+        self.spatial_index = GeoGridIndex(self.lats, self.lngs, grid=grid)
+    
+    @classmethod
+    def compile(cls, csv_path, output_path, osm_path=None):
+        """Compila casetas (CSV) y tramos de cuota (OSM, opcional); devuelve (casetas, puntos de tramo)"""
+        rows = OfflineGazetteer._read_csv_rows(csv_path)
+        if not rows:
+            raise ValueError(f"{csv_path} no contiene casetas")
+        
+        fieldnames = rows[0].keys()
+        name_col = OfflineGazetteer._column(fieldnames, cls.NAME_COLUMNS)
+        lat_col = OfflineGazetteer._column(fieldnames, cls.LAT_COLUMNS)
+        lng_col = OfflineGazetteer._column(fieldnames, cls.LNG_COLUMNS)
+        tariff_col = OfflineGazetteer._column(fieldnames, cls.TARIFF_COLUMNS)
+        if not (name_col and lat_col and lng_col and tariff_col):
+            raise ValueError("El CSV requiere columnas de nombre, latitud, longitud y tarifa")
+        
+        names, lats, lngs, tariffs = [], [], [], []
+        for row in rows:
+            try:
+                lat = float(row[lat_col])
+                lng = float(row[lng_col])
+                tariff = float(str(row[tariff_col]).replace('$', '').replace(',', '').strip())
+            except (TypeError, ValueError):
+                continue
+            names.append((row.get(name_col) or '').strip())
+            lats.append(lat)
+            lngs.append(lng)
+            tariffs.append(max(0.0, tariff))
+        
+        plazas = len(names)
+        if not plazas:
+            raise ValueError(f"{csv_path} no contiene casetas con coordenadas y tarifa válidas")
+        
+        kinds = np.full(plazas, cls.PLAZA, dtype=np.uint8)
+        weights = np.zeros(plazas)
+        lats, lngs, tariffs = np.array(lats), np.array(lngs), np.array(tariffs)
+        
+        # Tramos de cuota: puntos cada TOLL_SAMPLE_M, cada uno con los metros que representa
+        if osm_path:
+            segments, coordinates = RoadGraphRouter._read_osm(osm_path)
+            ends = np.array([
+                (coordinates[a], coordinates[b]) for a, b, _, toll, _ in segments
+                if toll and a in coordinates and b in coordinates
+            ]).reshape(-1, 2, 2)
+            length_m = haversine_km(ends[:, 0, 0], ends[:, 0, 1], ends[:, 1, 0], ends[:, 1, 1]) * 1000
+            counts = np.maximum(1, np.ceil(length_m / TOLL_SAMPLE_M)).astype(np.int64)
+            owner = np.repeat(np.arange(len(ends)), counts)
+            fraction = (np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + 0.5) / counts[owner]
+            points = ends[owner, 0] + (ends[owner, 1] - ends[owner, 0]) * fraction[:, None]
+            
+            lats = np.concatenate([lats, points[:, 0]])
+            lngs = np.concatenate([lngs, points[:, 1]])
+            tariffs = np.concatenate([tariffs, np.zeros(len(points))])
+            kinds = np.concatenate([kinds, np.full(len(points), cls.SEGMENT, dtype=np.uint8)])
+            weights = np.concatenate([weights, (length_m / counts)[owner]])
+            names.extend([''] * len(points))
+        
+        index = GeoGridIndex(lats, lngs, cell_deg=TOLL_CELL_DEG)
+        order = index.order
+        name_offsets, name_blob = pack_strings([names[i] for i in order])
+        
+        arrays = {
+            'lat': index.lats.astype(np.float32),
+            'lng': index.lngs.astype(np.float32),
+            'kind': kinds[order],
+            'tariff': tariffs[order].astype(np.float32),
+            'weight_m': weights[order].astype(np.float32),
+            'name_offsets': name_offsets,
+            'name_blob': name_blob,
+            'cell_keys': index.cell_keys,
+            'cell_starts': index.cell_starts
+        }
+        meta = {
+            'format': cls.FORMAT,
+            'plazas': plazas,
+            'segment_points': len(names) - plazas,
+            'source': ', '.join(os.path.basename(str(p)) for p in (csv_path, osm_path) if p),
+            'compiled_at': datetime.utcnow().isoformat(),
+            'grid': index.grid_params()
+        }
+        write_array_bundle(output_path, arrays, meta)
+        return plazas, len(names) - plazas
+    
+    def _name(self, record_id):
+        return self.name_blob[self.name_offsets[record_id]:self.name_offsets[record_id + 1]].tobytes().decode('utf-8')
+    
+    def _candidate_pairs(self, start, end):
+        """Pares (punto del índice, segmento de la ruta) que comparten celda o celda vecina"""
+        index = self.spatial_index
+        
+        # Muestras cada media celda sobre cada segmento: todas las celdas que toca la ruta
+        steps = np.maximum(1, np.ceil(np.abs(end - start).max(axis=1) / (index.cell_deg / 2))).astype(np.int64)
+        segment = np.repeat(np.arange(len(start)), steps)
+        t = (np.arange(len(segment)) - np.repeat(np.cumsum(steps) - steps, steps)) / np.repeat(steps, steps)
+        samples = start[segment] + (end - start)[segment] * t[:, None]
+        
+        # Celdas vecinas (3×3): los radios de captura son menores que una celda
+        offsets = np.array([-1, 0, 1])
+        rows = np.floor((samples[:, 1] - index.lat0) / index.cell_deg).astype(np.int64)
+        cols = np.floor((samples[:, 0] - index.lng0) / index.cell_deg).astype(np.int64)
+        rows = (rows[:, None] + np.repeat(offsets, 3)[None, :]).ravel()
+        cols = (cols[:, None] + np.tile(offsets, 3)[None, :]).ravel()
+        segment = np.repeat(segment, 9)
+        inside = (rows >= 0) & (rows < index.rows) & (cols >= 0) & (cols < index.cols)
+        cells = rows[inside] * index.cols + cols[inside]
+        segment = segment[inside]
+        
+        # Solo las celdas no vacías del índice (pocas) y sin pares (celda, segmento) repetidos
+        slot = np.minimum(np.searchsorted(index.cell_keys, cells), len(index.cell_keys) - 1)
+        found = index.cell_keys[slot] == cells
+        pairs = np.unique(slot[found] * len(start) + segment[found])
+        slot, segment = pairs // len(start), pairs % len(start)
+        
+        # Todos los puntos de esas celdas, cada uno con el segmento del par
+        counts = index.cell_starts[slot + 1] - index.cell_starts[slot]
+        point = (
+            np.repeat(index.cell_starts[slot], counts)
+            + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        )
+        return point, np.repeat(segment, counts)
+    
+    def route_tolls(self, coordinates):
+        """Cuotas de una geometría [[lng, lat], ...]: presencia, casetas en orden, km de cuota y costo"""
+        lnglat = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+        if len(lnglat) < 2:
+            return None
+        
+        start, end = lnglat[:-1], lnglat[1:]
+        point, segment = self._candidate_pairs(start, end)
+        
+        plazas = []
+        toll_km = 0.0
+        if len(point):
+            # Distancia en metros con proyección plana local a la latitud de cada punto
+            x_scale = np.cos(np.radians(self.lats[point].astype(np.float64)))
+            scale = np.column_stack((x_scale, np.ones_like(x_scale))) * KM_PER_DEGREE * 1000
+            xy = np.column_stack((self.lngs[point], self.lats[point])).astype(np.float64) * scale
+            distance = point_segment_distance(xy, start[segment] * scale, end[segment] * scale)
+            
+            # Distancia mínima de cada punto a la ruta y el segmento donde ocurre
+            order = np.lexsort((distance, point))
+            point, segment, distance = point[order], segment[order], distance[order]
+            first = np.r_[True, point[1:] != point[:-1]]
+            point, segment, distance = point[first], segment[first], distance[first]
+            
+            kinds = self.kinds[point]
+            crossed = (kinds == self.PLAZA) & (distance <= TOLL_PLAZA_RADIUS_M)
+            on_toll_road = (kinds == self.SEGMENT) & (distance <= TOLL_SEGMENT_RADIUS_M)
+            toll_km = float(self.weights[point[on_toll_road]].sum()) / 1000
+            
+            # Casetas en el orden en que la ruta las cruza
+            for record_id in point[crossed][np.argsort(segment[crossed], kind='stable')]:
+                plazas.append({
+                    'name': self._name(record_id),
+                    'location': [float(self.lngs[record_id]), float(self.lats[record_id])],
+                    'tariff_mxn': round(float(self.tariffs[record_id]), 2)
+                })
+        
+        return {
+            'has_tolls': bool(plazas) or toll_km >= TOLL_MIN_KM,
+            'plazas': plazas,
+            'toll_km': round(toll_km, 1),
+            'cost_mxn': round(sum(plaza['tariff_mxn'] for plaza in plazas), 2)
+        }
+
 # ============================================
 # SISTEMA DE GEOCODIFICACIÓN MEJORADO PARA MÉXICO
 # ============================================
 class MexicoGeocoder:
-    def __init__(self):
-        self.cache = {}
+    def __init__(self, persistence=None, warmup_entries=0):
+        self.persistence = persistence
+        self.warmup_entries = warmup_entries
+        self.warmup_lock = threading.Lock()
+        self.warmup_pid = None
+        self.cache = ShardedLRUCache(
+            max_entries=GEOCODE_CACHE_MAX_ENTRIES,
+            shards=GEOCODE_CACHE_SHARDS,
+            default_ttl=GEOCODE_TTL_GAZETTEER
+        )
         self.mexico_cities = {
             # Ciudad de México y Área Metropolitana
             'ciudad de mexico': {'lat': 19.4326, 'lng': -99.1332, 'name': 'Ciudad de México'},
@@ -181,49 +2107,232 @@ class MexicoGeocoder:
             'aeropuerto guadalajara': {'lat': 20.5218, 'lng': -103.3112, 'name': 'Aeropuerto Guadalajara'},
             'aeropuerto monterrey': {'lat': 25.7785, 'lng': -100.1075, 'name': 'Aeropuerto Monterrey'},
         }
+        
+        # Índices construidos una sola vez al arrancar
+        self.matcher = GazetteerMatcher(self.mexico_cities.keys())
+        self.city_words = {}
+        for city_name in self.mexico_cities:
+            for word in city_name.split():
+                if len(word) > 3:
+                    self.city_words.setdefault(word, city_name)
+        
+        self.prefix_index = PrefixIndex(
+            (gazetteer_key(city_name), 0, {'name': data['name'], 'lat': data['lat'], 'lng': data['lng']})
+            for city_name, data in self.mexico_cities.items()
+        )
+        
+        self.city_list = list(self.mexico_cities.values())
+        self.spatial_index = GeoGridIndex(
+            [city['lat'] for city in self.city_list],
+            [city['lng'] for city in self.city_list]
+        )
+        
+        # Cache de geocodificación inversa por celdas cuantizadas
+        self.reverse_cache = ShardedLRUCache(
+            max_entries=REVERSE_GEOCODE_CACHE_MAX_ENTRIES,
+            shards=GEOCODE_CACHE_SHARDS,
+            default_ttl=REVERSE_GEOCODE_TTL
+        )
+        self.reverse_cell_deg = REVERSE_GEOCODE_CELL_M / (KM_PER_DEGREE * 1000)
+        # Aciertos en celdas vecinas (se actualizan bajo su propio lock, como los de la cache)
+        self.reverse_neighbor_hits = 0
+        self.reverse_stats_lock = threading.Lock()
+        
+        # Coalescencia de consultas idénticas a Nominatim
+        self.flights = SingleFlight()
+        
+        # Cache negativa: consultas sin resultado o fallidas recientemente
+        self.negative_cache = ShardedLRUCache(
+            max_entries=GEOCODE_CACHE_MAX_ENTRIES,
+            shards=GEOCODE_CACHE_SHARDS,
+            default_ttl=GEOCODE_NEGATIVE_TTL
+        )
+        
+        # Gazetteer offline de localidades (opcional)
+        self.offline_gazetteer = None
+        if GAZETTEER_PATH and os.path.exists(GAZETTEER_PATH):
+            try:
+                self.offline_gazetteer = OfflineGazetteer(GAZETTEER_PATH)
+                print(f"📚 Gazetteer offline cargado: {self.offline_gazetteer.size} localidades")
+            except Exception as e:
+                print(f"❌ Error cargando gazetteer offline: {e}")
+    
+    def nearest_city(self, lat, lng):
+        """Devuelve (ciudad, distancia_km) de la ciudad o localidad conocida más cercana"""
+        idx, distance = self.spatial_index.nearest(lat, lng, k=1)[0]
+        closest = self.city_list[idx]
+        
+        if self.offline_gazetteer:
+            locality, locality_distance = self.offline_gazetteer.nearest(lat, lng)
+            if locality_distance < distance:
+                closest = {'lat': locality['lat'], 'lng': locality['lng'], 'name': locality['name']}
+                distance = locality_distance
+        
+        return closest, distance
+    
+    def _ensure_warm_up(self):
+        # Precargar una vez por proceso, en el primer uso y no al importar
+        # (con gunicorn --preload el import ocurre en el master, antes del fork)
+        if not self.persistence or self.warmup_pid == os.getpid():
+            return
+        with self.warmup_lock:
+            if self.warmup_pid == os.getpid():
+                return
+            self.warmup_pid = os.getpid()
+            threading.Thread(
+                target=self.warm_up_cache,
+                args=(self.warmup_entries,),
+                name='geocode-cache-warmup',
+                daemon=True
+            ).start()
+    
+    def warm_up_cache(self, limit):
+        """Precarga en memoria las entradas persistidas más usadas"""
+        if not self.persistence or limit <= 0:
+            return 0
+        
+        entries = self.persistence.most_used(limit)
+        for address_key, result, ttl in entries:
+            self.cache.set(address_key, result, ttl=ttl)
+        
+        if entries:
+            print(f"🔥 Cache de geocodificación precargada: {len(entries)} entradas")
+        return len(entries)
+    
+    def suggest(self, query, limit=5):
+        """Sugerencias de autocompletado sin red (listado curado primero, luego localidades)"""
+        prefix = gazetteer_key(query)
+        if len(prefix) < 2:
+            return []
+        
+        suggestions = self.prefix_index.search(prefix, limit=limit)
+        
+        if self.offline_gazetteer and len(suggestions) < limit:
+            seen = {item['name'] for item in suggestions}
+            for locality in self.offline_gazetteer.suggest(prefix, limit=limit):
+                if locality['name'] not in seen:
+                    suggestions.append({'name': locality['name'], 'lat': locality['lat'], 'lng': locality['lng']})
+                    seen.add(locality['name'])
+        
+        return suggestions[:limit]
     
     def geocode(self, address):
         """Geocodifica una dirección en México"""
-        address_lower = address.lower().strip()
+        address_lower = normalize_address(address)
         
-        # Primero verificar cache
-        if address_lower in self.cache:
-            return self.cache[address_lower]
+        result = self.geocode_local(address_lower)
+        if result is not None:
+            return result
         
-        # Verificar ciudades conocidas
-        for city_name, data in self.mexico_cities.items():
-            if city_name in address_lower:
+        return self.geocode_remote(address, address_lower, rate_wait=NOMINATIM_RATE_WAIT)
+    
+    def geocode_local(self, address_lower):
+        """Resuelve sin red (cache y gazetteer); devuelve None si hace falta Nominatim"""
+        self._ensure_warm_up()
+        
+        # Primero verificar cache
+        cached = self.cache.get(address_lower)
+        if cached is not None:
+            if self.persistence:
+                self.persistence.record_hit(address_lower)
+            return cached
+        
+        # Verificar ciudades conocidas (coincidencia más específica)
+        city_name = self.matcher.best_match(address_lower)
+        
+        # Gazetteer offline: gana si su coincidencia es más específica que la del listado curado
+        if self.offline_gazetteer:
+            locality = self.offline_gazetteer.match(address_lower)
+            if locality and (not city_name or len(locality['key']) > len(city_name)):
                 result = {
                     'success': True,
-                    'address': data['name'],
-                    'lat': data['lat'],
-                    'lng': data['lng'],
-                    'city': data['name']
+                    'address': locality['name'],
+                    'lat': locality['lat'],
+                    'lng': locality['lng'],
+                    'city': locality['name']
                 }
-                self.cache[address_lower] = result
+                self.cache.set(address_lower, result, ttl=GEOCODE_TTL_GAZETTEER)
                 return result
         
-        # Si no está en la lista, usar Nominatim
+        if city_name:
+            data = self.mexico_cities[city_name]
+            result = {
+                'success': True,
+                'address': data['name'],
+                'lat': data['lat'],
+                'lng': data['lng'],
+                'city': data['name']
+            }
+            self.cache.set(address_lower, result, ttl=GEOCODE_TTL_GAZETTEER)
+            return result
+        
+        return None
+    
+    def geocode_remote(self, address, address_lower, rate_wait=None, priority=NOMINATIM_PRIORITY_INTERACTIVE):
+        """Consulta Nominatim respetando el límite de tasa y aplica los fallbacks"""
+        # Las peticiones concurrentes de la misma dirección comparten una sola consulta,
+        # pero cada una espera solo lo que le tocaría esperar por su cuenta
         try:
-            location = geolocator.geocode(f"{address}, México")
-            if location:
-                result = {
-                    'success': True,
-                    'address': location.address,
-                    'lat': location.latitude,
-                    'lng': location.longitude
-                }
-                self.cache[address_lower] = result
+            return self.flights.do(
+                ('geocode', address_lower), self._geocode_remote, address, address_lower, rate_wait, priority,
+                wait_timeout=self.nominatim_deadline(rate_wait)
+            )
+        except TimeoutError:
+            print("⏳ Consulta compartida de Nominatim demorada, usando fallback")
+            return self.geocode_fallback(address, address_lower)
+    
+    @staticmethod
+    def nominatim_deadline(rate_wait):
+        """Tiempo máximo de una consulta: esperar turno y la respuesta (None = sin límite)"""
+        if rate_wait is None:
+            return None
+        return rate_wait + upstream_guards['nominatim'].timeouts.maximum
+    
+    def _geocode_remote(self, address, address_lower, rate_wait, priority):
+        # Otra llamada pudo haber resuelto la dirección mientras esperábamos
+        cached = self.cache.peek(address_lower)
+        if cached is not None:
+            return cached
+        
+        # Segundo nivel: tabla persistente compartida por todos los workers
+        if self.persistence:
+            stored = self.persistence.lookup(address_lower)
+            if stored:
+                result, ttl = stored
+                self.cache.set(address_lower, result, ttl=ttl)
                 return result
-        except Exception as e:
-            print(f"Error en geocodificación Nominatim: {e}")
         
+        # Si no está en la lista, usar Nominatim
+        location = self.call_nominatim(
+            address_lower,
+            lambda timeout: geolocator.geocode(f"{address}, México", timeout=timeout),
+            rate_wait=rate_wait,
+            priority=priority
+        )
+        if location:
+            result = {
+                'success': True,
+                'address': location.address,
+                'lat': location.latitude,
+                'lng': location.longitude
+            }
+            self.cache.set(address_lower, result, ttl=GEOCODE_TTL_NOMINATIM)
+            if self.persistence:
+                self.persistence.enqueue(address_lower, result, 'nominatim', GEOCODE_TTL_NOMINATIM)
+            return result
+        
+        return self.geocode_fallback(address, address_lower)
+    
+    def geocode_fallback(self, address, address_lower):
+        """Resultado aproximado sin Nominatim: palabra clave en una ciudad conocida o ubicación aleatoria"""
         # Fallback: buscar en palabras clave
         for keyword in ['centro', 'plaza', 'mercado', 'hospital', 'universidad', 'escuela', 'hotel']:
             if keyword in address_lower:
-                # Asociar con ciudad más cercana mencionada
-                for city_name, data in self.mexico_cities.items():
-                    if any(word in address_lower for word in city_name.split() if len(word) > 3):
+                # Asociar con la primera ciudad mencionada por alguna de sus palabras
+                for word in address_lower.split():
+                    city_name = self.city_words.get(word.strip('.,;:#()'))
+                    if city_name:
+                        data = self.mexico_cities[city_name]
                         result = {
                             'success': True,
                             'address': f"{keyword.title()}, {data['name']}",
@@ -231,12 +2340,61 @@ class MexicoGeocoder:
                             'lng': data['lng'] + random.uniform(-0.01, 0.01),
                             'city': data['name']
                         }
-                        self.cache[address_lower] = result
+                        self.cache.set(address_lower, result, ttl=GEOCODE_TTL_FALLBACK)
                         return result
         
         # Fallback final: ubicación aleatoria en México
         return self.get_random_mexico_location(address)
     
+    def _reverse_remote(self, lat, lng, cell):
+        """Consulta inversa a Nominatim; devuelve la dirección o None"""
+        cached = self.reverse_cache.peek(cell)
+        if cached is not None:
+            return cached['address']
+        
+        location = self.call_nominatim(
+            ('reverse',) + cell,
+            lambda timeout: geolocator.reverse(f"{lat}, {lng}", language='es', exactly_one=True, timeout=timeout),
+            rate_wait=NOMINATIM_RATE_WAIT
+        )
+        if location:
+            self.reverse_cache.set(
+                cell,
+                {'address': location.address, 'lat': lat, 'lng': lng},
+                ttl=REVERSE_GEOCODE_TTL
+            )
+            return location.address
+        
+        return None
+    
+    def call_nominatim(self, negative_key, query, rate_wait=None, priority=NOMINATIM_PRIORITY_INTERACTIVE):
+        """Llama a Nominatim con cache negativa, circuit breaker y límite de tasa; None si no hay resultado"""
+        if self.negative_cache.get(negative_key) is not None:
+            return None
+        
+        # Con el circuito abierto se usa directamente el gazetteer/fallback, sin esperar turno
+        guard = upstream_guards['nominatim']
+        if not guard.allow():
+            return None
+        
+        if not nominatim_rate_limiter.acquire(timeout=rate_wait, priority=priority):
+            print("⏳ Límite de tasa de Nominatim alcanzado, usando fallback")
+            return None
+        
+        started = time.monotonic()
+        try:
+            location = query(guard.timeout())
+        except Exception as e:
+            print(f"Error en Nominatim: {e}")
+            guard.record_failure(e)
+            self.negative_cache.set(negative_key, True, ttl=GEOCODE_ERROR_TTL)
+            return None
+        
+        guard.record_success(started)
+        if not location:
+            self.negative_cache.set(negative_key, True, ttl=GEOCODE_NEGATIVE_TTL)
+        return location
+    
     def get_random_mexico_location(self, address):
         """Genera una ubicación aleatoria dentro de México"""
         # Coordenadas aproximadas de México con distribución de población
@@ -259,8 +2417,7 @@ class MexicoGeocoder:
         lng = random.uniform(selected_region['west'], selected_region['east'])
         
         # Obtener ciudad más cercana para el nombre
-        closest_city = min(self.mexico_cities.values(), 
-                          key=lambda x: math.sqrt((x['lat']-lat)**2 + (x['lng']-lng)**2))
+        closest_city, _ = self.nearest_city(lat, lng)
         
         result = {
             'success': True,
@@ -270,28 +2427,74 @@ class MexicoGeocoder:
             'city': closest_city['name']
         }
         
-        self.cache[address.lower()] = result
+        self.cache.set(normalize_address(address), result, ttl=GEOCODE_TTL_FALLBACK)
         return result
     
+    def reverse_cell(self, lat, lng):
+        """Celda cuantizada (fila, columna) que contiene las coordenadas"""
+        return (int(math.floor(lat / self.reverse_cell_deg)),
+                int(math.floor(lng / self.reverse_cell_deg)))
+    
+    def reverse_cache_lookup(self, lat, lng):
+        """Busca en la celda propia y, si falla, en las 8 vecinas (absorbe el ruido del GPS)"""
+        row, col = self.reverse_cell(lat, lng)
+        entry = self.reverse_cache.get((row, col))
+        if entry is not None:
+            return entry
+        
+        for d_row in (-1, 0, 1):
+            for d_col in (-1, 0, 1):
+                if d_row == 0 and d_col == 0:
+                    continue
+                entry = self.reverse_cache.peek((row + d_row, col + d_col))
+                if entry is None:
+                    continue
+                # Solo si el punto original está realmente cerca (no solo en la celda vecina)
+                if haversine_km(lat, lng, entry['lat'], entry['lng']) * 1000 <= REVERSE_GEOCODE_CELL_M:
+                    with self.reverse_stats_lock:
+                        self.reverse_neighbor_hits += 1
+                    return entry
+        return None
+    
+    def reverse_cache_stats(self):
+        """Contadores de la cache inversa, incluidos los aciertos en celdas vecinas"""
+        with self.reverse_stats_lock:
+            neighbor_hits = self.reverse_neighbor_hits
+        return dict(self.reverse_cache.stats(), cell_m=REVERSE_GEOCODE_CELL_M, neighbor_hits=neighbor_hits)
+    
     def reverse_geocode(self, lat, lng):
         """Convierte coordenadas a dirección"""
+        lat = float(lat)
+        lng = float(lng)
+        
+        cached = self.reverse_cache_lookup(lat, lng)
+        if cached is not None:
+            return {
+                'success': True,
+                'address': cached['address'],
+                'lat': lat,
+                'lng': lng
+            }
+        
+        # Las peticiones concurrentes sobre la misma celda comparten una sola consulta
+        cell = self.reverse_cell(lat, lng)
         try:
-            location = geolocator.reverse(f"{lat}, {lng}", language='es', exactly_one=True)
-            if location:
-                return {
-                    'success': True,
-                    'address': location.address,
-                    'lat': lat,
-                    'lng': lng
-                }
-        except Exception as e:
-            print(f"Error en reverse geocoding: {e}")
+            address = self.flights.do(
+                ('reverse',) + cell, self._reverse_remote, lat, lng, cell,
+                wait_timeout=self.nominatim_deadline(NOMINATIM_RATE_WAIT)
+            )
+        except TimeoutError:
+            address = None
+        if address:
+            return {
+                'success': True,
+                'address': address,
+                'lat': lat,
+                'lng': lng
+            }
         
         # Encontrar ciudad más cercana
-        closest_city = min(self.mexico_cities.values(), 
-                          key=lambda x: math.sqrt((x['lat']-lat)**2 + (x['lng']-lng)**2))
-        
-        distance = math.sqrt((closest_city['lat']-lat)**2 + (closest_city['lng']-lng)**2) * 111
+        closest_city, distance = self.nearest_city(lat, lng)
         
         if distance < 10:  # Menos de 10 km
             location_desc = f"{closest_city['name']}"
@@ -307,13 +2510,50 @@ class MexicoGeocoder:
             'lng': lng
         }
 
+# ============================================
+# ALEATORIEDAD DETERMINISTA POR SOLICITUD
+# ============================================
+# Semilla de la solicitud de ruta en curso (None: aleatoriedad normal)
+route_request_seed = contextvars.ContextVar('route_request_seed', default=None)
+
+def request_seed(*inputs):
+    """Semilla estable a partir de las entradas de la solicitud"""
+    return hashlib.blake2b(repr((ROUTE_RANDOM_SEED,) + inputs).encode(), digest_size=16).hexdigest()
+
+@contextmanager
+def seeded_route_request(*inputs):
+    """Fija la semilla de la solicitud de ruta en curso (solo con ROUTE_DETERMINISTIC)"""
+    token = route_request_seed.set(request_seed(*inputs) if ROUTE_DETERMINISTIC else None)
+    try:
+        yield
+    finally:
+        route_request_seed.reset(token)
+
+def route_random(*salt):
+    """
+    Generador para un atributo de la ruta: derivado de la semilla de la solicitud
+    y de salt, o el módulo random si no hay semilla (mismo API)
+    """
+    seed = route_request_seed.get()
+    if seed is None:
+        return random
+    return random.Random(f"{seed}:{salt!r}")
+
 # ============================================
 # SISTEMA DE RUTAS REALES CON OSRM
 # ============================================
 class RealRouteSystem:
-    def __init__(self):
+    # Proveedores de respaldo: fuera del orden por latencia, solo cuando fallan los remotos
+    FALLBACK_PROVIDERS = ('local',)
+    
+    def __init__(self, geocoder=None):
+        # Geocodificador con las ciudades conocidas y el gazetteer offline (rutas simuladas)
+        self.geocoder = geocoder
+        self.corridor_candidates = None
+        
         # Configuración de OSRM (Open Source Routing Machine)
-        self.osrm_base_url = "http://router.project-osrm.org/route/v1"
+        self.osrm_base_url = f"{OSRM_URL}/route/v1"
+        self.osrm_table_url = f"{OSRM_URL}/table/v1"
         # Alternativa: servidor OSRM local o de Mapbox
         self.mapbox_access_token = os.environ.get('MAPBOX_ACCESS_TOKEN', '')
         
@@ -328,31 +2568,244 @@ class RealRouteSystem:
         print(f"🗺️  Usando OSRM para rutas: {self.osrm_base_url}")
         if self.mapbox_access_token:
             print(f"🗺️  Mapbox también disponible con token")
+        
+        # Cache de rutas ya interpretadas (solo resultados de proveedores reales)
+        self.route_cache = ShardedLRUCache(
+            max_entries=ROUTE_CACHE_MAX_ENTRIES,
+            shards=GEOCODE_CACHE_SHARDS,
+            default_ttl=ROUTE_CACHE_TTL
+        )
+        self.route_cell_deg = ROUTE_CACHE_CELL_M / (KM_PER_DEGREE * 1000)
+        
+        # Rutas entregadas por handle, para pedir sus pasos después (también las simuladas)
+        self.route_handles = ShardedLRUCache(
+            max_entries=ROUTE_CACHE_MAX_ENTRIES * 3,
+            shards=GEOCODE_CACHE_SHARDS,
+            default_ttl=ROUTE_CACHE_TTL
+        )
+        
+        # Red vial offline para el proveedor 'local' (opcional)
+        self.road_graph = None
+        if ROAD_GRAPH_PATH and os.path.exists(ROAD_GRAPH_PATH):
+            try:
+                self.road_graph = RoadGraphRouter(ROAD_GRAPH_PATH)
+                print(f"🛣️  Red vial offline cargada: {self.road_graph.size} nodos")
+            except Exception as e:
+                print(f"❌ Error cargando red vial offline: {e}")
+        
+        # Índice de casetas y tramos de cuota (opcional)
+        self.toll_index = None
+        if TOLL_INDEX_PATH and os.path.exists(TOLL_INDEX_PATH):
+            try:
+                self.toll_index = TollIndex(TOLL_INDEX_PATH)
+                print(f"🚧 Índice de cuotas cargado: {self.toll_index.meta.get('plazas')} casetas")
+            except Exception as e:
+                print(f"❌ Error cargando índice de cuotas: {e}")
+        
+        # Proveedores disponibles y latencia promedio (EWMA, segundos) de cada uno
+        self.graphhopper_url = "https://graphhopper.com/api/1/route"
+        self.ors_url = "https://api.openrouteservice.org/v2/directions/driving-car/geojson"
+        available = {
+            'osrm': self.get_osrm_route,
+            'mapbox': self.get_mapbox_route if self.use_mapbox else None,
+            'graphhopper': self.get_graphhopper_route if GRAPHHOPPER_API_KEY else None,
+            'ors': self.get_ors_route if ORS_API_KEY else None,
+            'local': self.get_local_route if self.road_graph else None
+        }
+        self.providers = [
+            (name, available[name])
+            for name in (p.strip() for p in ROUTE_PROVIDERS.split(','))
+            if available.get(name)
+        ]
+        self.provider_latency = {}
+        self.provider_wins = {name: 0 for name, _ in self.providers}
+        self.latency_lock = threading.Lock()
+        self.hedge_executor = ThreadPoolExecutor(max_workers=ROUTE_HEDGE_WORKERS, thread_name_prefix='route-hedge')
+        
+        # Matrices de distancia por teselas con paralelismo acotado
+        self.matrix_executor = ThreadPoolExecutor(max_workers=ROUTE_MATRIX_WORKERS, thread_name_prefix='route-matrix')
+        self.matrix_tile_cache = ShardedLRUCache(
+            max_entries=ROUTE_MATRIX_CACHE_TILES,
+            shards=GEOCODE_CACHE_SHARDS,
+            default_ttl=ROUTE_MATRIX_CACHE_TTL
+        )
+        print(f"🏁 Proveedores de rutas: {', '.join(name for name, _ in self.providers)}")
+    
+    def route_cache_key(self, start_lat, start_lng, end_lat, end_lng, route_type, geometry_format="geojson"):
+        """Clave de cache con origen y destino ajustados a la malla configurada"""
+        cell = self.route_cell_deg
+        return (
+            round(float(start_lat) / cell), round(float(start_lng) / cell),
+            round(float(end_lat) / cell), round(float(end_lng) / cell),
+            route_type, geometry_format
+        )
     
-    def get_real_route(self, start_lat, start_lng, end_lat, end_lng, route_type="all"):
+    def get_real_route(self, start_lat, start_lng, end_lat, end_lng, route_type="all", geometry_format="geojson"):
         """
         Obtiene rutas reales usando OSRM o Mapbox
         """
+        routes = []
+        for stage, value in self.iter_real_route(start_lat, start_lng, end_lat, end_lng, route_type, geometry_format):
+            if stage == 'complete':
+                routes = value
+        return routes
+    
+    def iter_real_route(self, start_lat, start_lng, end_lat, end_lng, route_type="all", geometry_format="geojson"):
+        """
+        Rutas por etapas para poder enviarlas en cuanto están listas:
+        ('route', ruta) por cada alternativa del proveedor ganador, la más rápida
+        primero y aún sin cuotas, y al final ('complete', rutas) con cuotas,
+        niveles de detalle y handles. De la cache o la simulación solo llega 'complete'.
+        """
+        # Las rutas en cache se comparten entre peticiones: se devuelve una copia
+        # de la lista y los diccionarios de ruta se tratan como solo lectura
+        cache_key = self.route_cache_key(start_lat, start_lng, end_lat, end_lng, route_type, geometry_format)
+        cached = self.route_cache.get(cache_key)
+        if cached is not None:
+            yield 'complete', list(self.assign_route_handles(cached, cache_key))
+            return
+        
+        # Semilla y handles salen de la misma clave que la cache: da igual qué
+        # petición de la celda llenó la entrada, los atributos simulados coinciden
+        routes = []
         try:
-            # Intentar OSRM primero (gratuito)
-            routes = self.get_osrm_route(start_lat, start_lng, end_lat, end_lng, route_type)
-            if routes:
-                return routes
-            
-            # Si OSRM falla, usar Mapbox si está disponible
-            if self.use_mapbox:
-                routes = self.get_mapbox_route(start_lat, start_lng, end_lat, end_lng, route_type)
-                if routes:
-                    return routes
-                    
+            with seeded_route_request(*cache_key):
+                routes = self.race_providers(start_lat, start_lng, end_lat, end_lng, route_type, geometry_format)
         except Exception as e:
             print(f"❌ Error obteniendo ruta real: {e}")
         
+        if routes:
+            routes.sort(key=lambda x: x['duration_min'])
+            for route in routes:
+                self.add_geometry_levels([route], geometry_format)
+                yield 'route', route
+            
+            self.add_toll_info(routes)
+            self.assign_route_handles(routes, cache_key)
+            self.route_cache.set(cache_key, routes)
+            yield 'complete', list(routes)
+            return
+        
         # Fallback a simulación mejorada
-        return self.get_simulated_route(start_lat, start_lng, end_lat, end_lng, route_type)
+        with seeded_route_request(*cache_key):
+            routes = self.get_simulated_route(start_lat, start_lng, end_lat, end_lng, route_type)
+        self.add_toll_info(routes)
+        if geometry_format != "geojson":
+            for route in routes:
+                route['geometry'] = self.format_geometry(route['geometry'], geometry_format)
+        self.add_geometry_levels(routes, geometry_format)
+        yield 'complete', self.assign_route_handles(routes, cache_key)
+    
+    def assign_route_handles(self, routes, cache_key):
+        """
+        Handle estable de cada ruta (derivado de la clave de cache) para pedir
+        después sus pasos; las rutas en cache conservan el suyo y se renuevan
+        """
+        for route in routes:
+            if 'handle' not in route:
+                route['handle'] = hashlib.blake2b(
+                    repr(cache_key + (route['id'],)).encode(), digest_size=12
+                ).hexdigest()
+            self.route_handles.set(route['handle'], route)
+        return routes
+    
+    def ordered_providers(self):
+        """
+        Proveedores ordenados por latencia promedio; los no medidos cuentan como
+        ROUTE_PROVIDER_TIMEOUT y entre ellos conservan su prioridad. Los de
+        respaldo (FALLBACK_PROVIDERS) van siempre al final.
+        """
+        with self.latency_lock:
+            latency = dict(self.provider_latency)
+        ranked = sorted(
+            enumerate(self.providers),
+            key=lambda item: (
+                item[1][0] in self.FALLBACK_PROVIDERS,
+                latency.get(item[1][0], ROUTE_PROVIDER_TIMEOUT),
+                item[0]
+            )
+        )
+        return [provider for _, provider in ranked]
+    
+    def record_provider_latency(self, name, elapsed):
+        """Actualiza la latencia promedio exponencial del proveedor"""
+        with self.latency_lock:
+            previous = self.provider_latency.get(name)
+            if previous is None:
+                self.provider_latency[name] = elapsed
+            else:
+                self.provider_latency[name] = previous + ROUTE_LATENCY_ALPHA * (elapsed - previous)
+    
+    def timed_provider_call(self, name, provider, *args):
+        """Ejecuta un proveedor midiendo su latencia; un fallo cuenta como tiempo agotado"""
+        started = time.monotonic()
+        routes = provider(*args)
+        elapsed = time.monotonic() - started
+        self.record_provider_latency(name, elapsed if routes else max(elapsed, ROUTE_PROVIDER_TIMEOUT))
+        return routes
+    
+    def race_providers(self, start_lat, start_lng, end_lat, end_lng, route_type, geometry_format="geojson"):
+        """
+        Carrera con cobertura entre proveedores: arranca el más rápido y, si no
+        responde en ROUTE_HEDGE_DELAY_MS o falla, lanza el siguiente. Gana la
+        primera respuesta con rutas; las peticiones perdedoras se descartan. Los
+        proveedores de respaldo solo arrancan cuando ya no queda ningún remoto en curso.
+        """
+        args = (start_lat, start_lng, end_lat, end_lng, route_type, geometry_format)
+        remaining = self.ordered_providers()
+        hedge_delay = max(ROUTE_HEDGE_DELAY_MS, 0) / 1000
+        pending = {}
+        
+        while remaining or pending:
+            # Lanzar el siguiente proveedor (todos de golpe si el retraso es 0)
+            while remaining:
+                name, provider = remaining[0]
+                if name in self.FALLBACK_PROVIDERS and pending:
+                    break
+                remaining.pop(0)
+                # Cada proveedor corre con el contexto (semilla) de la solicitud
+                future = self.hedge_executor.submit(
+                    contextvars.copy_context().run, self.timed_provider_call, name, provider, *args
+                )
+                pending[future] = name
+                if hedge_delay > 0:
+                    break
+            
+            # Con solo respaldos por lanzar se espera a que terminen los remotos
+            hedging = remaining and remaining[0][0] not in self.FALLBACK_PROVIDERS
+            done, _ = wait(pending, timeout=hedge_delay if hedging else None, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = pending.pop(future)
+                routes = future.result()
+                if routes:
+                    with self.latency_lock:
+                        self.provider_wins[name] += 1
+                    # Las perdedoras que no han arrancado ya no se ejecutan
+                    for loser in pending:
+                        loser.cancel()
+                    return routes
+        
+        return []
+    
+    def provider_stats(self):
+        """Latencia promedio y victorias por proveedor"""
+        with self.latency_lock:
+            return [
+                {
+                    'name': name,
+                    'latency_ms': round(self.provider_latency[name] * 1000, 1) if name in self.provider_latency else None,
+                    'wins': self.provider_wins[name]
+                }
+                for name, _ in self.providers
+            ]
     
-    def get_osrm_route(self, start_lat, start_lng, end_lat, end_lng, route_type):
+    def get_osrm_route(self, start_lat, start_lng, end_lat, end_lng, route_type, geometry_format="geojson"):
         """Usa OSRM para obtener rutas reales"""
+        # Con el circuito abierto se pasa al siguiente proveedor o a la simulación
+        guard = upstream_guards['osrm']
+        if not guard.allow():
+            return []
+        
         try:
             # Construir URL para OSRM
             coordinates = f"{start_lng},{start_lat};{end_lng},{end_lat}"
@@ -360,7 +2813,7 @@ class RealRouteSystem:
             # Parámetros para OSRM
             params = {
                 'overview': 'full',  # Obtener geometría completa
-                'geometries': 'geojson',  # Formato GeoJSON
+                'geometries': OSRM_GEOMETRY_PARAMS[geometry_format],  # GeoJSON o polilínea codificada
                 'steps': 'true',  # Incluir instrucciones paso a paso
                 'alternatives': '3'  # Obtener 3 rutas alternativas
             }
@@ -371,26 +2824,34 @@ class RealRouteSystem:
                 params['exclude'] = 'motorway'
             
             url = f"{self.osrm_base_url}/driving/{coordinates}"
-            response = requests.get(url, params=params, timeout=30)
+            started = time.monotonic()
+            response = upstream_http.get(url, params=params, timeout=guard.timeout())
+            guard.record_response(response, started)
             
             if response.status_code == 200:
                 data = response.json()
-                return self.parse_osrm_response(data, start_lat, start_lng, end_lat, end_lng, route_type)
+                return self.parse_osrm_response(data, start_lat, start_lng, end_lat, end_lng, route_type, geometry_format)
             else:
                 print(f"OSRM error {response.status_code}: {response.text}")
                 
         except Exception as e:
             print(f"Error OSRM: {e}")
+            guard.record_failure(e)
         
         return []
     
-    def get_mapbox_route(self, start_lat, start_lng, end_lat, end_lng, route_type):
+    def get_mapbox_route(self, start_lat, start_lng, end_lat, end_lng, route_type, geometry_format="geojson"):
         """Usa Mapbox API para rutas reales"""
+        # Con el circuito abierto se pasa al siguiente proveedor o a la simulación
+        guard = upstream_guards['mapbox']
+        if not guard.allow():
+            return []
+        
         try:
             coordinates = f"{start_lng},{start_lat};{end_lng},{end_lat}"
             
             params = {
-                'geometries': 'geojson',
+                'geometries': OSRM_GEOMETRY_PARAMS[geometry_format],
                 'steps': 'true',
                 'alternatives': 'true',
                 'overview': 'full',
@@ -401,25 +2862,470 @@ class RealRouteSystem:
                 params['exclude'] = 'toll'
             
             url = f"{self.mapbox_base_url}/{coordinates}"
-            response = requests.get(url, params=params, timeout=30)
+            started = time.monotonic()
+            response = upstream_http.get(url, params=params, timeout=guard.timeout())
+            guard.record_response(response, started)
             
             if response.status_code == 200:
                 data = response.json()
-                return self.parse_mapbox_response(data, start_lat, start_lng, end_lat, end_lng, route_type)
+                return self.parse_mapbox_response(data, start_lat, start_lng, end_lat, end_lng, route_type, geometry_format)
             else:
                 print(f"Mapbox error {response.status_code}: {response.text}")
                 
         except Exception as e:
             print(f"Error Mapbox: {e}")
+            guard.record_failure(e)
+        
+        return []
+    
+    def get_graphhopper_route(self, start_lat, start_lng, end_lat, end_lng, route_type, geometry_format="geojson"):
+        """Usa GraphHopper para rutas reales"""
+        # Con el circuito abierto se pasa al siguiente proveedor o a la simulación
+        guard = upstream_guards['graphhopper']
+        if not guard.allow():
+            return []
+        
+        try:
+            payload = {
+                'points': [[start_lng, start_lat], [end_lng, end_lat]],
+                'profile': 'car',
+                'locale': 'es',
+                'instructions': True,
+                'points_encoded': geometry_format != 'geojson',
+                'details': ['toll'],
+                'algorithm': 'alternative_route',
+                'alternative_route.max_paths': 3
+            }
+            
+            if geometry_format == 'polyline6':
+                payload['points_encoded_multiplier'] = 1e6
+            
+            if route_type == "without_tolls":
+                # Los modelos personalizados requieren desactivar contraction hierarchies
+                payload['ch.disable'] = True
+                payload['custom_model'] = {
+                    'priority': [{'if': 'toll == ALL', 'multiply_by': '0'}]
+                }
+            
+            started = time.monotonic()
+            response = upstream_http.post(
+                self.graphhopper_url,
+                params={'key': GRAPHHOPPER_API_KEY},
+                json=payload,
+                timeout=guard.timeout()
+            )
+            guard.record_response(response, started)
+            
+            if response.status_code == 200:
+                data = response.json()
+                return self.parse_graphhopper_response(data, start_lat, start_lng, end_lat, end_lng, route_type, geometry_format)
+            else:
+                print(f"GraphHopper error {response.status_code}: {response.text}")
+                
+        except Exception as e:
+            print(f"Error GraphHopper: {e}")
+            guard.record_failure(e)
+        
+        return []
+    
+    def get_ors_route(self, start_lat, start_lng, end_lat, end_lng, route_type, geometry_format="geojson"):
+        """Usa OpenRouteService para rutas reales"""
+        # Con el circuito abierto se pasa al siguiente proveedor o a la simulación
+        guard = upstream_guards['ors']
+        if not guard.allow():
+            return []
+        
+        try:
+            payload = {
+                'coordinates': [[start_lng, start_lat], [end_lng, end_lat]],
+                'instructions': True,
+                'language': 'es',
+                'extra_info': ['tollways']
+            }
+            
+            # ORS solo calcula alternativas para trayectos cortos (< 100 km)
+            if haversine_km(start_lat, start_lng, end_lat, end_lng) < 100:
+                payload['alternative_routes'] = {'target_count': 3, 'weight_factor': 1.4, 'share_factor': 0.6}
+            
+            if route_type == "without_tolls":
+                payload['options'] = {'avoid_features': ['tollways']}
+            
+            started = time.monotonic()
+            response = upstream_http.post(
+                self.ors_url,
+                headers={'Authorization': ORS_API_KEY},
+                json=payload,
+                timeout=guard.timeout()
+            )
+            guard.record_response(response, started)
+            
+            if response.status_code == 200:
+                data = response.json()
+                return self.parse_ors_response(data, start_lat, start_lng, end_lat, end_lng, route_type, geometry_format)
+            else:
+                print(f"ORS error {response.status_code}: {response.text}")
+                
+        except Exception as e:
+            print(f"Error ORS: {e}")
+            guard.record_failure(e)
         
         return []
     
-    def parse_osrm_response(self, data, start_lat, start_lng, end_lat, end_lng, route_type):
+    def get_local_route(self, start_lat, start_lng, end_lat, end_lng, route_type, geometry_format="geojson"):
+        """Usa la red vial offline (contraction hierarchies) dentro del proceso"""
+        try:
+            result = self.road_graph.route(float(start_lat), float(start_lng), float(end_lat), float(end_lng))
+        except Exception as e:
+            print(f"Error red vial offline: {e}")
+            return []
+        
+        # Sin rutas alternativas: si la más rápida usa cuotas no sirve para "sin cuotas"
+        if result is None or (route_type == "without_tolls" and result['has_tolls']):
+            return []
+        
+        distance = result['distance_m'] / 1000
+        duration = result['duration_s'] / 60
+        steps = [
+            {
+                'maneuver': {'instruction': 'Iniciar en punto de partida', 'type': 'depart'},
+                'distance': result['distance_m'],
+                'duration': result['duration_s']
+            },
+            {
+                'maneuver': {'instruction': 'Llegada a destino', 'type': 'arrive'},
+                'distance': 0,
+                'duration': 0
+            }
+        ]
+        
+        return [self.build_route_data(
+            0, distance, duration, result['has_tolls'],
+            self.calculate_primary_roads(None, result['has_tolls']),
+            steps, self.format_geometry(result['coordinates'], geometry_format),
+            waypoints=self.extract_waypoints(None, start_lat, start_lng, end_lat, end_lng)
+        )]
+    
+    def estimate_matrix(self, sources, destinations):
+        """Duraciones (s) y distancias (m) estimadas con haversine y factor de carretera"""
+        src = np.asarray(sources, dtype=np.float64).reshape(-1, 2)
+        dst = np.asarray(destinations, dtype=np.float64).reshape(-1, 2)
+        km = haversine_km(src[:, None, 0], src[:, None, 1], dst[None, :, 0], dst[None, :, 1]) * ROUTE_FALLBACK_ROAD_FACTOR
+        return km / ROUTE_FALLBACK_SPEED_KMH * 3600, km * 1000
+    
+    def get_travel_matrix(self, points):
+        """
+        Matrices de duración (s) y distancia (m) entre todas las paradas con una sola
+        llamada a OSRM /table; sin OSRM se estiman con haversine. Devuelve (duraciones, distancias, fuente)
+        """
+        estimated_durations, estimated_distances = self.estimate_matrix(points, points)
+        
+        guard = upstream_guards['osrm']
+        if guard.allow() and self.acquire_table_turn():
+            try:
+                coordinates = ';'.join(f"{lng},{lat}" for lat, lng in points)
+                url = f"{self.osrm_table_url}/driving/{coordinates}"
+                started = time.monotonic()
+                response = upstream_http.get(url, params={'annotations': 'duration,distance'}, timeout=guard.timeout())
+                guard.record_response(response, started)
+                
+                data = response.json() if response.status_code == 200 else {}
+                if data.get('code') == 'Ok':
+                    # Los pares sin ruta llegan como null: se completan con la estimación
+                    durations = np.array(data['durations'], dtype=np.float64)
+                    distances = np.array(data['distances'], dtype=np.float64)
+                    np.copyto(durations, estimated_durations, where=np.isnan(durations))
+                    np.copyto(distances, estimated_distances, where=np.isnan(distances))
+                    return durations, distances, 'osrm'
+                else:
+                    print(f"OSRM table error {response.status_code}: {response.text[:200]}")
+                    
+            except Exception as e:
+                print(f"Error OSRM table: {e}")
+                guard.record_failure(e)
+        
+        return estimated_durations, estimated_distances, 'haversine'
+    
+    def acquire_table_turn(self):
+        """Turno para consultar OSRM /table; False si no llega a tiempo (se usa la estimación)"""
+        if osrm_table_rate_limiter is None or osrm_table_rate_limiter.acquire(timeout=OSRM_TABLE_RATE_WAIT):
+            return True
+        print("⏳ Límite de tasa de OSRM /table alcanzado, usando estimación")
+        return False
+    
+    def matrix_tile_count(self, num_sources, num_destinations):
+        """Número de consultas /table que requiere una matriz N×M"""
+        tile = max(1, ROUTE_MATRIX_TILE)
+        return math.ceil(num_sources / tile) * math.ceil(num_destinations / tile)
+    
+    def fetch_matrix_tile(self, sources, destinations, use_cache=True):
+        """Una tesela de la matriz vía OSRM /table; devuelve (duraciones, distancias, estimada)"""
+        cache_key = (tuple(sources), tuple(destinations))
+        if use_cache:
+            cached = self.matrix_tile_cache.get(cache_key)
+            if cached is not None:
+                return cached[0], cached[1], False
+        
+        estimated_durations, estimated_distances = self.estimate_matrix(sources, destinations)
+        
+        guard = upstream_guards['osrm']
+        if guard.allow() and self.acquire_table_turn():
+            try:
+                coordinates = ';'.join(f"{lng},{lat}" for lat, lng in list(sources) + list(destinations))
+                params = {
+                    'sources': ';'.join(str(i) for i in range(len(sources))),
+                    'destinations': ';'.join(str(len(sources) + j) for j in range(len(destinations))),
+                    'annotations': 'duration,distance'
+                }
+                url = f"{self.osrm_table_url}/driving/{coordinates}"
+                started = time.monotonic()
+                response = upstream_http.get(url, params=params, timeout=guard.timeout())
+                guard.record_response(response, started)
+                
+                data = response.json() if response.status_code == 200 else {}
+                if data.get('code') == 'Ok':
+                    durations = np.array(data['durations'], dtype=np.float64)
+                    distances = np.array(data['distances'], dtype=np.float64)
+                    np.copyto(durations, estimated_durations, where=np.isnan(durations))
+                    np.copyto(distances, estimated_distances, where=np.isnan(distances))
+                    if use_cache:
+                        self.matrix_tile_cache.set(cache_key, (durations, distances))
+                    return durations, distances, False
+                else:
+                    print(f"OSRM table error {response.status_code}: {response.text[:200]}")
+                    
+            except Exception as e:
+                print(f"Error OSRM table: {e}")
+                guard.record_failure(e)
+        
+        return estimated_durations, estimated_distances, True
+    
+    def get_distance_matrix(self, sources, destinations, use_cache=True):
+        """
+        Matriz N×M de duraciones (s) y distancias (m) dividida en teselas del tamaño
+        que admite el proveedor, consultadas en paralelo (ROUTE_MATRIX_WORKERS).
+        Las teselas sin respuesta se estiman; devuelve (duraciones, distancias, teselas estimadas)
+        """
+        sources = [(round(lat, 6), round(lng, 6)) for lat, lng in sources]
+        destinations = [(round(lat, 6), round(lng, 6)) for lat, lng in destinations]
+        tile = max(1, ROUTE_MATRIX_TILE)
+        
+        durations = np.empty((len(sources), len(destinations)), dtype=np.float32)
+        distances = np.empty((len(sources), len(destinations)), dtype=np.float32)
+        
+        futures = {}
+        for i in range(0, len(sources), tile):
+            for j in range(0, len(destinations), tile):
+                future = self.matrix_executor.submit(
+                    self.fetch_matrix_tile, sources[i:i + tile], destinations[j:j + tile], use_cache
+                )
+                futures[future] = (i, j)
+        
+        estimated_tiles = 0
+        for future, (i, j) in futures.items():
+            tile_durations, tile_distances, estimated = future.result()
+            rows, cols = tile_durations.shape
+            durations[i:i + rows, j:j + cols] = tile_durations
+            distances[i:i + rows, j:j + cols] = tile_distances
+            estimated_tiles += int(estimated)
+        
+        return durations, distances, estimated_tiles
+    
+    def get_multi_stop_route(self, points, route_type, durations, distances):
+        """Ruta completa por las paradas ya ordenadas (OSRM, o tramos rectos estimados)"""
+        with seeded_route_request(tuple(points), route_type):
+            waypoints = [
+                {
+                    'name': 'Inicio' if k == 0 else 'Destino' if k == len(points) - 1 else f'Parada {k}',
+                    'location': [lng, lat]
+                }
+                for k, (lat, lng) in enumerate(points)
+            ]
+            
+            guard = upstream_guards['osrm']
+            if guard.allow():
+                try:
+                    coordinates = ';'.join(f"{lng},{lat}" for lat, lng in points)
+                    params = {
+                        'overview': 'full',
+                        'geometries': 'geojson',
+                        'steps': 'true'
+                    }
+                    if route_type == "without_tolls":
+                        params['exclude'] = 'motorway'
+                
+                    url = f"{self.osrm_base_url}/driving/{coordinates}"
+                    started = time.monotonic()
+                    response = upstream_http.get(url, params=params, timeout=guard.timeout())
+                    guard.record_response(response, started)
+                
+                    if response.status_code == 200:
+                        routes = self.parse_osrm_response(
+                            response.json(), points[0][0], points[0][1], points[-1][0], points[-1][1], route_type
+                        )
+                        if routes:
+                            routes[0]['waypoints'] = waypoints
+                            return routes[0]
+                    else:
+                        print(f"OSRM error {response.status_code}: {response.text[:200]}")
+                    
+                except Exception as e:
+                    print(f"Error OSRM: {e}")
+                    guard.record_failure(e)
+            
+            # Sin geometría real: tramos rectos con las duraciones/distancias de la matriz
+            legs = np.arange(len(points) - 1)
+            distance = float(distances[legs, legs + 1].sum()) / 1000
+            duration = float(durations[legs, legs + 1].sum()) / 60
+            return self.build_route_data(
+                0, distance, duration, False,
+                self.calculate_primary_roads(None, False),
+                [], self.format_geometry([[lng, lat] for lat, lng in points]),
+                waypoints=waypoints
+            )
+    
+    def optimize_stops(self, points, route_type="all", round_trip=False, fixed_end=False,
+                       optimize_for="duration", time_budget_ms=ROUTE_OPTIMIZE_TIME_BUDGET_MS):
+        """Ordena las paradas (la primera es el origen) y devuelve (orden, ruta, fuente de la matriz)"""
+        durations, distances, source = self.get_travel_matrix(points)
+        cost = distances if optimize_for == "distance" else durations
+        
+        end = 0 if round_trip else (len(points) - 1 if fixed_end else None)
+        order = solve_tour(cost, start=0, end=end, time_budget_ms=time_budget_ms)
+        
+        ordered_points = [points[i] for i in order]
+        route = self.get_multi_stop_route(
+            ordered_points, route_type,
+            durations[np.ix_(order, order)], distances[np.ix_(order, order)]
+        )
+        return order, route, source
+    
+    def format_geometry(self, geometry, geometry_format="geojson"):
+        """
+        Geometría de la ruta en el formato pedido. Las polilíneas que ya vienen
+        codificadas del proveedor se pasan tal cual, sin decodificar.
+        """
+        if isinstance(geometry, dict):
+            geometry = geometry.get('coordinates', [])
+        
+        if isinstance(geometry, str):
+            return {'type': 'LineString', 'encoding': geometry_format, 'polyline': geometry}
+        
+        if geometry_format == 'geojson':
+            return {'coordinates': geometry, 'type': 'LineString'}
+        
+        precision = 6 if geometry_format == 'polyline6' else 5
+        return {
+            'type': 'LineString',
+            'encoding': geometry_format,
+            'polyline': pl.encode(geometry, precision, geojson=True)
+        }
+    
+    def route_coordinates(self, route):
+        """Coordenadas [[lng, lat], ...] de la ruta, decodificando la polilínea si hace falta"""
+        geometry = route.get('geometry') or {}
+        if 'polyline' in geometry:
+            precision = 6 if geometry.get('encoding') == 'polyline6' else 5
+            return pl.decode(geometry['polyline'], precision, geojson=True)
+        return geometry.get('coordinates') or []
+    
+    def add_toll_info(self, routes):
+        """
+        Cuotas reales según el índice de casetas: reemplaza has_tolls y suma el
+        costo de las casetas cruzadas al del combustible (sin índice no cambia nada)
+        """
+        if self.toll_index is None:
+            return routes
+        
+        for route in routes:
+            tolls = self.toll_index.route_tolls(self.route_coordinates(route))
+            if tolls is None:
+                continue
+            
+            fuel_mxn = round(route['distance_km'] * 0.08 * 22, 1)
+            route['has_tolls'] = tolls['has_tolls']
+            route['tolls'] = tolls
+            route['fuel_estimate'] = dict(
+                route['fuel_estimate'],
+                fuel_mxn=fuel_mxn,
+                tolls_mxn=tolls['cost_mxn'],
+                cost_mxn=round(fuel_mxn + tolls['cost_mxn'], 1)
+            )
+        
+        return routes
+    
+    def add_geometry_levels(self, routes, geometry_format="geojson"):
+        """Precalcula la geometría simplificada de cada ruta para los zooms de ROUTE_LOD_ZOOMS"""
+        for route in routes:
+            coordinates = self.route_coordinates(route)
+            
+            if len(coordinates) < 3:
+                continue
+            
+            # Proyección plana local en metros alrededor de la latitud media
+            lnglat = np.asarray(coordinates, dtype=np.float64)
+            cos_lat = math.cos(math.radians(float(lnglat[:, 1].mean())))
+            xy = lnglat * np.array([cos_lat, 1.0]) * KM_PER_DEGREE * 1000
+            significance = douglas_peucker_significance(xy)
+            
+            levels = {}
+            for zoom in ROUTE_LOD_ZOOMS:
+                tolerance = WEB_MERCATOR_M_PER_PX * cos_lat / (2 ** zoom) * ROUTE_LOD_PIXEL_TOLERANCE
+                simplified = lnglat[significance > tolerance].tolist()
+                levels[zoom] = self.format_geometry(simplified, geometry_format)
+            route['geometry_levels'] = levels
+        
+        return routes
+    
+    def route_for_zoom(self, route, zoom=None):
+        """
+        Copia de la ruta para la respuesta: con zoom usa el nivel de detalle más
+        cercano por encima; sin zoom (o más allá del último nivel) la geometría completa
+        """
+        view = {key: value for key, value in route.items() if key != 'geometry_levels'}
+        levels = route.get('geometry_levels')
+        if zoom is not None and levels:
+            level = next((z for z in ROUTE_LOD_ZOOMS if z >= zoom and z in levels), None)
+            if level is not None:
+                view['geometry'] = levels[level]
+        return view
+    
+    def build_route_data(self, i, distance, duration, has_tolls, primary_roads, steps, geometry, waypoints=None):
+        """Arma el diccionario de ruta común a todos los proveedores (geometry ya formateada)"""
+        route_data = {
+            'id': i + 1,
+            'name': self.get_route_name(i, has_tolls, distance, duration),
+            'icon': self.get_route_icon(i, has_tolls),
+            'has_tolls': has_tolls,
+            'duration_min': int(duration),
+            'distance_km': round(distance, 1),
+            'speed_kmh': int((distance / (duration/60)) if duration > 0 else 60),
+            'fuel_estimate': {
+                'liters': round(distance * 0.08, 1),
+                'cost_mxn': round(distance * 0.08 * 22 * (1.3 if has_tolls else 1.0), 1)
+            },
+            'traffic_estimate': {
+                'level': self.get_traffic_level(i),
+                'color': self.get_traffic_color(i),
+                'delay': f"+{route_random('delay', i).randint(5, 15 + i*5)} min"
+            },
+            'primary_roads': primary_roads,
+            'description': self.get_route_description(i, has_tolls, distance, duration),
+            'steps': steps,
+            'geometry': geometry
+        }
+        
+        if waypoints is not None:
+            route_data['waypoints'] = waypoints
+        
+        route_data['duration_formatted'] = self.format_duration(route_data['duration_min'])
+        return route_data
+    
+    def parse_osrm_response(self, data, start_lat, start_lng, end_lat, end_lng, route_type, geometry_format="geojson"):
         """Parse la respuesta de OSRM"""
         routes = []
         
         for i, route in enumerate(data.get('routes', [])):
-            geometry = route.get('geometry', {}).get('coordinates', [])
+            geometry = route.get('geometry', {})
             
             # Calcular distancia y tiempo
             distance = route.get('distance', 0) / 1000  # Convertir a km
@@ -432,83 +3338,116 @@ class RealRouteSystem:
             # Obtener instrucciones paso a paso
             steps = self.extract_osrm_steps(route)
             
-            route_data = {
-                'id': i + 1,
-                'name': self.get_route_name(i, has_tolls, distance, duration),
-                'icon': self.get_route_icon(i, has_tolls),
-                'has_tolls': has_tolls,
-                'duration_min': int(duration),
-                'distance_km': round(distance, 1),
-                'speed_kmh': int((distance / (duration/60)) if duration > 0 else 60),
-                'fuel_estimate': {
-                    'liters': round(distance * 0.08, 1),
-                    'cost_mxn': round(distance * 0.08 * 22 * (1.3 if has_tolls else 1.0), 1)
-                },
-                'traffic_estimate': {
-                    'level': self.get_traffic_level(i),
-                    'color': self.get_traffic_color(i),
-                    'delay': f"+{random.randint(5, 15 + i*5)} min"
-                },
-                'primary_roads': self.calculate_primary_roads(route, has_tolls),
-                'description': self.get_route_description(i, has_tolls, distance, duration),
-                'steps': steps,
-                'geometry': {
-                    'coordinates': geometry,
-                    'type': 'LineString'
-                },
-                'waypoints': self.extract_waypoints(route, start_lat, start_lng, end_lat, end_lng)
-            }
+            route_data = self.build_route_data(
+                i, distance, duration, has_tolls,
+                self.calculate_primary_roads(route, has_tolls),
+                steps, self.format_geometry(geometry, geometry_format),
+                waypoints=self.extract_waypoints(route, start_lat, start_lng, end_lat, end_lng)
+            )
+            routes.append(route_data)
+        
+        # Ordenar rutas por duración
+        routes.sort(key=lambda x: x['duration_min'])
+        
+        return routes
+    
+    def parse_mapbox_response(self, data, start_lat, start_lng, end_lat, end_lng, route_type, geometry_format="geojson"):
+        """Parse la respuesta de Mapbox"""
+        routes = []
+        
+        for i, route in enumerate(data.get('routes', [])):
+            geometry = route.get('geometry', {})
+            
+            distance = route.get('distance', 0) / 1000
+            duration = route.get('duration', 0) / 60
+            
+            # Mapbox tiene información de cuotas
+            has_tolls = self.detect_mapbox_tolls(route)
+            
+            steps = self.extract_mapbox_steps(route)
+            
+            route_data = self.build_route_data(
+                i, distance, duration, has_tolls,
+                self.calculate_mapbox_primary_roads(route),
+                steps, self.format_geometry(geometry, geometry_format)
+            )
+            routes.append(route_data)
+        
+        routes.sort(key=lambda x: x['duration_min'])
+        return routes
+    
+    def parse_graphhopper_response(self, data, start_lat, start_lng, end_lat, end_lng, route_type, geometry_format="geojson"):
+        """Parse la respuesta de GraphHopper"""
+        routes = []
+        
+        for i, path in enumerate(data.get('paths', [])):
+            geometry = path.get('points', {})
+            
+            distance = path.get('distance', 0) / 1000
+            duration = path.get('time', 0) / 60000  # GraphHopper reporta milisegundos
+            
+            # GraphHopper marca los tramos de cuota en los detalles de la ruta
+            toll_details = path.get('details', {}).get('toll', [])
+            has_tolls = any(str(detail[2]).lower() in ('all', 'hgv') for detail in toll_details)
+            
+            steps = [
+                {
+                    'maneuver': {
+                        'instruction': instruction.get('text', ''),
+                        'type': str(instruction.get('sign', ''))
+                    },
+                    'distance': instruction.get('distance', 0),
+                    'duration': instruction.get('time', 0) / 1000
+                }
+                for instruction in path.get('instructions', [])
+            ]
             
-            route_data['duration_formatted'] = self.format_duration(route_data['duration_min'])
+            route_data = self.build_route_data(
+                i, distance, duration, has_tolls,
+                self.calculate_primary_roads(path, has_tolls),
+                steps, self.format_geometry(geometry, geometry_format),
+                waypoints=self.extract_waypoints(path, start_lat, start_lng, end_lat, end_lng)
+            )
             routes.append(route_data)
         
-        # Ordenar rutas por duración
         routes.sort(key=lambda x: x['duration_min'])
-        
         return routes
     
-    def parse_mapbox_response(self, data, start_lat, start_lng, end_lat, end_lng, route_type):
-        """Parse la respuesta de Mapbox"""
+    def parse_ors_response(self, data, start_lat, start_lng, end_lat, end_lng, route_type, geometry_format="geojson"):
+        """Parse la respuesta GeoJSON de OpenRouteService"""
         routes = []
         
-        for i, route in enumerate(data.get('routes', [])):
-            geometry = route.get('geometry', {}).get('coordinates', [])
-            
-            distance = route.get('distance', 0) / 1000
-            duration = route.get('duration', 0) / 60
+        for i, feature in enumerate(data.get('features', [])):
+            properties = feature.get('properties', {})
+            geometry = feature.get('geometry', {})
             
-            # Mapbox tiene información de cuotas
-            has_tolls = self.detect_mapbox_tolls(route)
+            summary = properties.get('summary', {})
+            distance = summary.get('distance', 0) / 1000
+            duration = summary.get('duration', 0) / 60
             
-            steps = self.extract_mapbox_steps(route)
+            # En extras.tollways el valor 1 indica tramo de cuota
+            toll_values = properties.get('extras', {}).get('tollways', {}).get('values', [])
+            has_tolls = any(value[2] == 1 for value in toll_values)
             
-            route_data = {
-                'id': i + 1,
-                'name': self.get_route_name(i, has_tolls, distance, duration),
-                'icon': self.get_route_icon(i, has_tolls),
-                'has_tolls': has_tolls,
-                'duration_min': int(duration),
-                'distance_km': round(distance, 1),
-                'speed_kmh': int((distance / (duration/60)) if duration > 0 else 60),
-                'fuel_estimate': {
-                    'liters': round(distance * 0.08, 1),
-                    'cost_mxn': round(distance * 0.08 * 22 * (1.3 if has_tolls else 1.0), 1)
-                },
-                'traffic_estimate': {
-                    'level': self.get_traffic_level(i),
-                    'color': self.get_traffic_color(i),
-                    'delay': f"+{random.randint(5, 15 + i*5)} min"
-                },
-                'primary_roads': self.calculate_mapbox_primary_roads(route),
-                'description': self.get_route_description(i, has_tolls, distance, duration),
-                'steps': steps,
-                'geometry': {
-                    'coordinates': geometry,
-                    'type': 'LineString'
+            steps = [
+                {
+                    'maneuver': {
+                        'instruction': step.get('instruction', ''),
+                        'type': str(step.get('type', ''))
+                    },
+                    'distance': step.get('distance', 0),
+                    'duration': step.get('duration', 0)
                 }
-            }
+                for segment in properties.get('segments', [])
+                for step in segment.get('steps', [])
+            ]
             
-            route_data['duration_formatted'] = self.format_duration(route_data['duration_min'])
+            route_data = self.build_route_data(
+                i, distance, duration, has_tolls,
+                self.calculate_primary_roads(feature, has_tolls),
+                steps, self.format_geometry(geometry, geometry_format),
+                waypoints=self.extract_waypoints(feature, start_lat, start_lng, end_lat, end_lng)
+            )
             routes.append(route_data)
         
         routes.sort(key=lambda x: x['duration_min'])
@@ -518,15 +3457,18 @@ class RealRouteSystem:
         """Genera rutas simuladas más realistas cuando las APIs fallan"""
         
         # Calcular distancia real
-        start_coords = (start_lat, start_lng)
-        end_coords = (end_lat, end_lng)
-        direct_distance = geodesic(start_coords, end_coords).kilometers
+        direct_distance = float(haversine_km(start_lat, start_lng, end_lat, end_lng))
         
         # Factor de desviación realista (las carreteras no son líneas rectas)
-        deviation_factor = 1.2 + random.uniform(0.1, 0.3)  # 20-50% más largo
+        deviation_factor = 1.2 + route_random('deviation').uniform(0.1, 0.3)  # 20-50% más largo
         
         # Generar puntos intermedios que simulen carreteras principales
-        route_coordinates = self.generate_realistic_highway_route(start_lat, start_lng, end_lat, end_lng, direct_distance)
+        corridor_cities = self.find_corridor_cities(start_lat, start_lng, end_lat, end_lng)
+        route_coordinates = self.generate_realistic_highway_route(start_lat, start_lng, end_lat, end_lng, corridor_cities)
+        
+        # Variaciones de las tres rutas calculadas de una vez
+        route_variants = self.vary_route_coordinates(route_coordinates)
+        route_cities = [city['name'] for city in corridor_cities] or None
         
         # Crear rutas con diferentes características
         routes = []
@@ -577,11 +3519,11 @@ class RealRouteSystem:
             route_time_hours = route_distance / config['speed_kmh']
             route_time_minutes = max(15, int(route_time_hours * 60))
             
-            # Generar variación en las coordenadas para cada ruta
-            route_coords = self.vary_route_coordinates(route_coordinates, i, config['highway_percentage'])
+            # Variación de las coordenadas para esta ruta
+            route_coords = route_variants[i].tolist()
             
             # Generar instrucciones paso a paso realistas
-            steps = self.generate_realistic_steps(start_lat, start_lng, end_lat, end_lng, i, config['has_tolls'])
+            steps = self.generate_realistic_steps(start_lat, start_lng, end_lat, end_lng, i, config['has_tolls'], route_cities)
             
             route = {
                 'id': config['id'],
@@ -598,7 +3540,7 @@ class RealRouteSystem:
                 'traffic_estimate': {
                     'level': self.get_traffic_level(i),
                     'color': self.get_traffic_color(i),
-                    'delay': f"+{random.randint(5, 15 + i*5)} min"
+                    'delay': f"+{route_random('delay', i).randint(5, 15 + i*5)} min"
                 },
                 'primary_roads': config['highway_percentage'],
                 'description': config['description'],
@@ -614,104 +3556,86 @@ class RealRouteSystem:
         
         return routes
     
-    def generate_realistic_highway_route(self, start_lat, start_lng, end_lat, end_lng, distance_km):
-        """Genera coordenadas que simulan rutas por carreteras principales"""
-        coordinates = []
-        
-        # Punto de inicio
-        coordinates.append([start_lng, start_lat])
-        
-        # Para distancias largas, usar menos puntos pero más significativos
-        num_points = max(5, int(distance_km / 25))
-        
-        # Calcular dirección general
-        lat_diff = end_lat - start_lat
-        lng_diff = end_lng - start_lng
-        
-        # Principales ciudades intermedias en México (simulación)
-        major_cities = [
-            {'name': 'Querétaro', 'lat': 20.5881, 'lng': -100.3881},
-            {'name': 'San Juan del Río', 'lat': 20.3889, 'lng': -99.9958},
-            {'name': 'Tula', 'lat': 20.0539, 'lng': -99.3436},
-            {'name': 'Pachuca', 'lat': 20.0911, 'lng': -98.7624}
-        ]
-        
-        # Encontrar ciudades que estén aproximadamente en la ruta
-        intermediate_points = []
-        for city in major_cities:
-            # Calcular si la ciudad está cerca de la línea entre inicio y fin
-            distance_to_line = self.distance_point_to_line(
-                city['lat'], city['lng'],
-                start_lat, start_lng,
-                end_lat, end_lng
-            )
+    def load_corridor_candidates(self):
+        """Coordenadas de ciudades conocidas y localidades grandes del gazetteer, en arrays"""
+        if self.corridor_candidates is None:
+            cities = self.geocoder.city_list if self.geocoder else []
+            lats = [np.array([city['lat'] for city in cities], dtype=np.float64)]
+            lngs = [np.array([city['lng'] for city in cities], dtype=np.float64)]
+            gazetteer_ids = np.empty(0, dtype=np.int64)
             
-            if distance_to_line < 50:  # Si está a menos de 50km de la ruta
-                intermediate_points.append({
-                    'lat': city['lat'],
-                    'lng': city['lng'],
-                    'name': city['name']
-                })
-        
-        # Ordenar ciudades por distancia desde el inicio
-        intermediate_points.sort(key=lambda x: 
-            geodesic((start_lat, start_lng), (x['lat'], x['lng'])).kilometers)
-        
-        # Agregar puntos intermedios reales
-        current_lat, current_lng = start_lat, start_lng
-        for point in intermediate_points[:2]:  # Tomar máximo 2 ciudades intermedias
-            # Calcular puntos en la ruta hacia esta ciudad
-            mid_points = 3
-            for j in range(1, mid_points + 1):
-                progress = j / (mid_points + 1)
-                lat = current_lat + (point['lat'] - current_lat) * progress
-                lng = current_lng + (point['lng'] - current_lng) * progress
-                
-                # Agregar curvatura de carretera
-                curve = math.sin(progress * math.pi) * 0.02
-                coordinates.append([lng + curve, lat + curve])
+            gazetteer = self.geocoder.offline_gazetteer if self.geocoder else None
+            if gazetteer is not None:
+                gazetteer_ids = np.flatnonzero(np.asarray(gazetteer.population) >= SIM_CORRIDOR_MIN_POPULATION)
+                lats.append(np.asarray(gazetteer.lats, dtype=np.float64)[gazetteer_ids])
+                lngs.append(np.asarray(gazetteer.lngs, dtype=np.float64)[gazetteer_ids])
             
-            current_lat, current_lng = point['lat'], point['lng']
+            self.corridor_candidates = (np.concatenate(lats), np.concatenate(lngs), len(cities), gazetteer_ids)
+        return self.corridor_candidates
+    
+    def find_corridor_cities(self, start_lat, start_lng, end_lat, end_lng, limit=2):
+        """Hasta `limit` ciudades cercanas al trayecto, ordenadas desde el inicio"""
+        lats, lngs, city_count, gazetteer_ids = self.load_corridor_candidates()
+        if not lats.size:
+            return []
+        
+        distance, along = segment_distance_km(lats, lngs, start_lat, start_lng, end_lat, end_lng)
+        length = float(haversine_km(start_lat, start_lng, end_lat, end_lng))
+        
+        # Solo ciudades intermedias: cerca del trayecto y lejos de los extremos
+        mask = (distance < SIM_CORRIDOR_KM) & (along > 0.05 * length) & (along < 0.95 * length)
+        candidates = np.flatnonzero(mask)
+        
+        # La más cercana al trayecto en cada uno de `limit` tramos, para repartirlas a lo largo de la ruta
+        section = np.minimum(((along[candidates] / length - 0.05) / 0.9 * limit).astype(np.int64), limit - 1)
+        order = np.lexsort((distance[candidates], section))
+        _, first = np.unique(section[order], return_index=True)
+        chosen = candidates[order[first]]
+        
+        cities = []
+        for idx in chosen:
+            if idx < city_count:
+                city = self.geocoder.city_list[idx]
+            else:
+                city = self.geocoder.offline_gazetteer.record(int(gazetteer_ids[idx - city_count]))
+            cities.append({'name': city['name'], 'lat': float(lats[idx]), 'lng': float(lngs[idx])})
+        return cities
+    
+    def generate_realistic_highway_route(self, start_lat, start_lng, end_lat, end_lng, corridor_cities):
+        """Genera coordenadas que simulan rutas por carreteras principales pasando por las ciudades del trayecto"""
+        waypoints = np.array(
+            [[start_lng, start_lat]] + [[city['lng'], city['lat']] for city in corridor_cities] + [[end_lng, end_lat]],
+            dtype=np.float64
+        )
         
-        # Puntos finales hacia el destino
-        final_points = 3
-        for j in range(1, final_points + 1):
-            progress = j / (final_points + 1)
-            lat = current_lat + (end_lat - current_lat) * progress
-            lng = current_lng + (end_lng - current_lng) * progress
-            
-            curve = math.sin(progress * math.pi) * 0.015
-            coordinates.append([lng + curve, lat + curve])
+        # Tres puntos interiores por tramo con curvatura de carretera (menor en el tramo final)
+        progress = np.arange(1, 4) / 4
+        legs = len(waypoints) - 1
+        curvature = np.full(legs, 0.02)
+        curvature[-1] = 0.015
         
-        # Punto final
-        coordinates.append([end_lng, end_lat])
+        origins = waypoints[:-1, None, :]
+        targets = waypoints[1:, None, :]
+        points = origins + (targets - origins) * progress[None, :, None]
+        points += (np.sin(progress * math.pi)[None, :] * curvature[:, None])[:, :, None]
         
-        return coordinates
+        return np.concatenate((waypoints[:1], points.reshape(-1, 2), waypoints[-1:]))
     
-    def vary_route_coordinates(self, base_coordinates, route_index, highway_percentage):
-        """Genera variaciones realistas para diferentes tipos de rutas"""
-        varied_coords = []
+    def vary_route_coordinates(self, base_coordinates):
+        """Variaciones de las tres rutas: autopistas (0 y 2) más rectas, económica (1) con más curvas"""
+        base = np.asarray(base_coordinates, dtype=np.float64)
+        progress = np.linspace(0.0, 1.0, len(base)) if len(base) > 1 else np.zeros(len(base))
         
-        for j, coord in enumerate(base_coordinates):
-            lng, lat = coord
-            progress = j / (len(base_coordinates) - 1) if len(base_coordinates) > 1 else 0
-            
-            # Para rutas con autopistas (índice 0 y 2), mantener más rectas
-            if route_index in [0, 2]:
-                variation = 0.003 * math.sin(progress * math.pi * 2)
-            else:  # Ruta económica, más curvas
-                variation = 0.008 * math.sin(progress * math.pi * 3)
-            
-            # Aplicar variación
-            lng += variation
-            lat += variation * 0.5
-            
-            varied_coords.append([lng, lat])
+        amplitude = np.array([0.003, 0.008, 0.003])[:, None]
+        frequency = np.array([2.0, 3.0, 2.0])[:, None]
+        variation = amplitude * np.sin(progress[None, :] * math.pi * frequency)
         
-        return varied_coords
+        offsets = np.stack((variation, variation * 0.5), axis=-1)
+        return base[None, :, :] + offsets
     
-    def generate_realistic_steps(self, start_lat, start_lng, end_lat, end_lng, route_index, has_tolls):
+    def generate_realistic_steps(self, start_lat, start_lng, end_lat, end_lng, route_index, has_tolls, route_cities=None):
         """Genera instrucciones paso a paso realistas para México"""
+        rng = route_random('steps', route_index)
         steps = [
             {
                 'maneuver': {
@@ -724,7 +3648,8 @@ class RealRouteSystem:
         ]
         
         # Determinar ciudades principales en la ruta (basado en coordenadas reales)
-        route_cities = self.get_cities_along_route(start_lat, start_lng, end_lat, end_lng)
+        if not route_cities:
+            route_cities = self.get_cities_along_route(start_lat, start_lng, end_lat, end_lng)
         
         # Generar pasos basados en el tipo de ruta
         if route_index == 0:  # Ruta rápida con autopistas
@@ -734,8 +3659,8 @@ class RealRouteSystem:
                         'instruction': 'Conducir hacia el norte por carretera estatal',
                         'type': 'continue'
                     },
-                    'distance': random.randint(3000, 8000),
-                    'duration': random.randint(120, 300)
+                    'distance': rng.randint(3000, 8000),
+                    'duration': rng.randint(120, 300)
                 },
                 {
                     'maneuver': {
@@ -750,8 +3675,8 @@ class RealRouteSystem:
                         'instruction': f'Mantener la izquierda en autopista hacia {route_cities[0] if route_cities else "Querétaro"}',
                         'type': 'continue'
                     },
-                    'distance': random.randint(20000, 50000),
-                    'duration': random.randint(900, 1800)
+                    'distance': rng.randint(20000, 50000),
+                    'duration': rng.randint(900, 1800)
                 },
                 {
                     'maneuver': {
@@ -769,8 +3694,8 @@ class RealRouteSystem:
                         'instruction': 'Tomar carretera libre hacia el norte',
                         'type': 'continue'
                     },
-                    'distance': random.randint(5000, 12000),
-                    'duration': random.randint(300, 600)
+                    'distance': rng.randint(5000, 12000),
+                    'duration': rng.randint(300, 600)
                 },
                 {
                     'maneuver': {
@@ -785,16 +3710,16 @@ class RealRouteSystem:
                         'instruction': 'Seguir por carretera federal',
                         'type': 'continue'
                     },
-                    'distance': random.randint(15000, 30000),
-                    'duration': random.randint(1200, 2400)
+                    'distance': rng.randint(15000, 30000),
+                    'duration': rng.randint(1200, 2400)
                 },
                 {
                     'maneuver': {
                         'instruction': 'Continuar recto por avenida principal',
                         'type': 'continue'
                     },
-                    'distance': random.randint(5000, 10000),
-                    'duration': random.randint(300, 600)
+                    'distance': rng.randint(5000, 10000),
+                    'duration': rng.randint(300, 600)
                 }
             ])
         else:  # Ruta alternativa
@@ -804,8 +3729,8 @@ class RealRouteSystem:
                         'instruction': 'Tomar carretera hacia el norte',
                         'type': 'continue'
                     },
-                    'distance': random.randint(8000, 15000),
-                    'duration': random.randint(480, 900)
+                    'distance': rng.randint(8000, 15000),
+                    'duration': rng.randint(480, 900)
                 },
                 {
                     'maneuver': {
@@ -820,8 +3745,8 @@ class RealRouteSystem:
                         'instruction': 'Continuar por tramos libres y de cuota',
                         'type': 'continue'
                     },
-                    'distance': random.randint(15000, 25000),
-                    'duration': random.randint(900, 1500)
+                    'distance': rng.randint(15000, 25000),
+                    'duration': rng.randint(900, 1500)
                 },
                 {
                     'maneuver': {
@@ -854,8 +3779,9 @@ class RealRouteSystem:
         ]
         
         # Seleccionar 1-2 ciudades que probablemente estén en la ruta
-        num_cities = random.randint(1, 2)
-        selected_cities = random.sample(all_cities, num_cities)
+        rng = route_random('cities')
+        num_cities = rng.randint(1, 2)
+        selected_cities = rng.sample(all_cities, num_cities)
         
         return selected_cities
     
@@ -867,7 +3793,7 @@ class RealRouteSystem:
         elif route_index == 1:
             return False  # Segunda ruta usualmente sin cuotas
         else:
-            return random.choice([True, False])  # Rutas alternativas mixtas
+            return route_random('tolls', route_index).choice([True, False])  # Rutas alternativas mixtas
     
     def detect_mapbox_tolls(self, route):
         """Detecta cuotas en rutas de Mapbox"""
@@ -933,15 +3859,16 @@ class RealRouteSystem:
     
     def calculate_primary_roads(self, route, has_tolls):
         """Calcula el porcentaje de carreteras principales"""
+        rng = route_random('primary_roads', has_tolls, route.get('distance') if isinstance(route, dict) else None)
         if has_tolls:
-            return random.randint(70, 95)
+            return rng.randint(70, 95)
         else:
-            return random.randint(40, 70)
+            return rng.randint(40, 70)
     
     def calculate_mapbox_primary_roads(self, route):
         """Calcula porcentaje para Mapbox"""
         # Mapbox tiene información de tipo de carretera
-        return random.randint(50, 90)
+        return route_random('primary_roads', route.get('distance')).randint(50, 90)
     
     def get_route_name(self, index, has_tolls, distance, duration):
         """Genera nombre descriptivo para la ruta"""
@@ -991,49 +3918,6 @@ class RealRouteSystem:
                 return f"{hours}h {mins}min"
             else:
                 return f"{hours}h"
-    
-    def distance_point_to_line(self, point_lat, point_lng, line_start_lat, line_start_lng, line_end_lat, line_end_lng):
-        """Calcula la distancia de un punto a una línea"""
-        # Conversión a radianes
-        lat1 = math.radians(line_start_lat)
-        lng1 = math.radians(line_start_lng)
-        lat2 = math.radians(line_end_lat)
-        lng2 = math.radians(line_end_lng)
-        latp = math.radians(point_lat)
-        lngp = math.radians(point_lng)
-        
-        # Radio de la Tierra en km
-        R = 6371.0
-        
-        # Distancia entre punto de inicio y fin de línea
-        d = 2 * math.asin(math.sqrt(
-            math.sin((lat2 - lat1) / 2) ** 2 +
-            math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
-        ))
-        
-        if d == 0:
-            # Punto de inicio y fin son iguales
-            return geodesic((line_start_lat, line_start_lng), (point_lat, point_lng)).kilometers
-        
-        # Distancia del punto al inicio de la línea
-        d13 = 2 * math.asin(math.sqrt(
-            math.sin((latp - lat1) / 2) ** 2 +
-            math.cos(lat1) * math.cos(latp) * math.sin((lngp - lng1) / 2) ** 2
-        ))
-        
-        # Distancia del punto al fin de la línea
-        d23 = 2 * math.asin(math.sqrt(
-            math.sin((latp - lat2) / 2) ** 2 +
-            math.cos(lat2) * math.cos(latp) * math.sin((lngp - lng2) / 2) ** 2
-        ))
-        
-        # Ángulo en el punto
-        angle = math.acos((d13 ** 2 + d ** 2 - d23 ** 2) / (2 * d13 * d))
-        
-        # Distancia perpendicular
-        distance = abs(d13 * math.sin(angle)) * R
-        
-        return distance
 
 # ============================================
 # SISTEMA DE RECONOCIMIENTO FACIAL CON FACE-API.JS (Local)
@@ -1063,6 +3947,12 @@ class EmailService:
             print(f"   Mensaje: {message}")
             return True, "simulado"
         
+        guard = upstream_guards['smtp']
+        if not guard.allow():
+            print(f"⏸️  SMTP no disponible (circuito abierto), email a {to_email} no enviado")
+            return False, "Servicio de email no disponible temporalmente"
+        
+        started = time.monotonic()
         try:
             # Crear el mensaje de email
             msg = MIMEMultipart()
@@ -1074,7 +3964,7 @@ class EmailService:
             msg.attach(MIMEText(message, 'plain'))
             
             # Crear conexión segura con el servidor
-            server = smtplib.SMTP(EMAIL_HOST, EMAIL_PORT)
+            server = smtplib.SMTP(EMAIL_HOST, EMAIL_PORT, timeout=guard.timeout())
             server.starttls()  # Hacer la conexión segura
             
             # Login al servidor de email
@@ -1084,6 +3974,7 @@ class EmailService:
             text = msg.as_string()
             server.sendmail(EMAIL_FROM, to_email, text)
             server.quit()
+            guard.record_success(started)
             
             print(f"✅ EMAIL REAL enviado a {to_email}")
             print(f"   Asunto: {subject}")
@@ -1093,6 +3984,12 @@ class EmailService:
             error_msg = f"Error enviando email: {str(e)}"
             print(f"❌ {error_msg}")
             
+            # Los errores de autenticación o de destinatario no indican caída del servidor
+            if isinstance(e, (smtplib.SMTPAuthenticationError, smtplib.SMTPRecipientsRefused)):
+                guard.record_success(started)
+            else:
+                guard.record_failure(e)
+            
             # En producción, no hacer fallback a simulación
             return False, f"Error enviando email: {str(e)}"
     
@@ -1332,11 +4229,255 @@ class SignedDocument(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     verified_at = db.Column(db.DateTime, nullable=True)
 
+class GeocodeCacheEntry(db.Model):
+    __tablename__ = 'geocode_cache'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    address_key = db.Column(db.String(255), unique=True, nullable=False, index=True)  # Dirección normalizada
+    result = db.Column(db.JSON, nullable=False)
+    source = db.Column(db.String(20), nullable=False)  # 'nominatim'
+    hits = db.Column(db.Integer, default=0, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+# ============================================
+# PERSISTENCIA DE LA CACHE DE GEOCODIFICACIÓN
+# ============================================
+class GeocodeCachePersistence:
+    """Segundo nivel de cache en la tabla geocode_cache con escrituras asíncronas por lotes"""
+    
+    def __init__(self, flush_interval=5, batch_size=200, max_queue=10000):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_queue = max_queue
+        self.lock = threading.Lock()
+        self.pending_hits = {}
+        self.queue = None
+        self.worker_pid = None
+        self.schema_ready = False
+        # Sin base de datos la geocodificación sigue igual: solo se omite este nivel por un rato
+        self.breaker = CircuitBreaker(
+            'geocode_cache_db',
+            failure_threshold=GEOCODE_PERSIST_FAILURE_THRESHOLD,
+            base_delay=GEOCODE_PERSIST_BACKOFF_BASE,
+            max_delay=GEOCODE_PERSIST_BACKOFF_MAX
+        )
+    
+    def available(self):
+        """Indica si se puede usar la base (circuito cerrado o prueba) y si la tabla existe"""
+        return self.breaker.allow() and self.ensure_schema()
+    
+    def ensure_schema(self):
+        """Crea la tabla geocode_cache si aún no existe (db.create_all solo corre con __main__)"""
+        if self.schema_ready:
+            return True
+        try:
+            with app.app_context():
+                GeocodeCacheEntry.__table__.create(bind=db.engine, checkfirst=True)
+        except Exception as e:
+            # Otro worker pudo crearla al mismo tiempo; comprobar antes de rendirse
+            try:
+                with app.app_context():
+                    exists = sqlalchemy.inspect(db.engine).has_table(GeocodeCacheEntry.__tablename__)
+            except Exception:
+                exists = False
+            if not exists:
+                print(f"❌ Error creando tabla de cache persistente: {e}")
+                self.breaker.record_failure(e)
+                return False
+        self.schema_ready = True
+        return True
+    
+    def _ensure_worker(self):
+        # Arrancar el hilo escritor en cada proceso (los hilos no sobreviven al fork de gunicorn)
+        if self.worker_pid == os.getpid():
+            return
+        with self.lock:
+            if self.worker_pid == os.getpid():
+                return
+            self.queue = queue.Queue(maxsize=self.max_queue)
+            self.pending_hits = {}
+            threading.Thread(target=self._run, name='geocode-cache-writer', daemon=True).start()
+            self.worker_pid = os.getpid()
+    
+    def enqueue(self, address_key, result, source, ttl):
+        """Encola una escritura sin bloquear la petición"""
+        if len(address_key) > 255:
+            return
+        self._ensure_worker()
+        try:
+            self.queue.put_nowait((address_key, result, source, ttl))
+        except queue.Full:
+            print("⚠️  Cola de persistencia de geocodificación llena, descartando escritura")
+    
+    def record_hit(self, address_key):
+        """Acumula usos en memoria; se suman a la tabla en el siguiente lote"""
+        self._ensure_worker()
+        with self.lock:
+            self.pending_hits[address_key] = self.pending_hits.get(address_key, 0) + 1
+    
+    def lookup(self, address_key):
+        """Devuelve (resultado, ttl_restante) desde la tabla o None"""
+        if len(address_key) > 255:
+            return None
+        if not self.available():
+            return None
+        try:
+            with app.app_context():
+                entry = GeocodeCacheEntry.query.filter_by(address_key=address_key).first()
+        except Exception as e:
+            print(f"❌ Error leyendo cache persistente: {e}")
+            self.breaker.record_failure(e)
+            return None
+        
+        self.breaker.record_success()
+        if not entry or entry.expires_at <= datetime.utcnow():
+            return None
+        return entry.result, (entry.expires_at - datetime.utcnow()).total_seconds()
+    
+    def most_used(self, limit):
+        """Entradas vigentes más usadas: [(clave, resultado, ttl_restante), ...]"""
+        if not self.available():
+            return []
+        try:
+            with app.app_context():
+                now = datetime.utcnow()
+                entries = GeocodeCacheEntry.query.filter(
+                    GeocodeCacheEntry.expires_at > now
+                ).order_by(GeocodeCacheEntry.hits.desc()).limit(limit).all()
+                result = [
+                    (entry.address_key, entry.result, (entry.expires_at - now).total_seconds())
+                    for entry in entries
+                ]
+        except Exception as e:
+            print(f"❌ Error precargando cache persistente: {e}")
+            self.breaker.record_failure(e)
+            return []
+        
+        self.breaker.record_success()
+        return result
+    
+    def _run(self):
+        while True:
+            items = {}
+            deadline = time.monotonic() + self.flush_interval
+            while len(items) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    address_key, result, source, ttl = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                items[address_key] = (result, source, ttl)
+            
+            with self.lock:
+                hits, self.pending_hits = self.pending_hits, {}
+            
+            if items or hits:
+                self.flush(items, hits)
+    
+    @staticmethod
+    def _upsert_statement(dialect_name):
+        """INSERT que actualiza la entrada si la clave ya existe (None si el dialecto no lo soporta)"""
+        table = GeocodeCacheEntry.__table__
+        if dialect_name == 'mysql':
+            from sqlalchemy.dialects.mysql import insert
+            stmt = insert(table)
+            return stmt.on_duplicate_key_update(
+                result=stmt.inserted.result,
+                source=stmt.inserted.source,
+                updated_at=stmt.inserted.updated_at,
+                expires_at=stmt.inserted.expires_at
+            )
+        if dialect_name in ('sqlite', 'postgresql'):
+            if dialect_name == 'sqlite':
+                from sqlalchemy.dialects.sqlite import insert
+            else:
+                from sqlalchemy.dialects.postgresql import insert
+            stmt = insert(table)
+            return stmt.on_conflict_do_update(
+                index_elements=[table.c.address_key],
+                set_={
+                    'result': stmt.excluded.result,
+                    'source': stmt.excluded.source,
+                    'updated_at': stmt.excluded.updated_at,
+                    'expires_at': stmt.excluded.expires_at
+                }
+            )
+        return None
+    
+    def flush(self, items, hits):
+        """Inserta/actualiza un lote de entradas y suma los usos acumulados"""
+        if not self.available():
+            return
+        table = GeocodeCacheEntry.__table__
+        now = datetime.utcnow()
+        rows = [
+            {
+                'address_key': address_key,
+                'result': result,
+                'source': source,
+                'hits': 0,
+                'created_at': now,
+                'updated_at': now,
+                'expires_at': now + timedelta(seconds=ttl)
+            }
+            for address_key, (result, source, ttl) in items.items()
+        ]
+        # Suma atómica en la base (sin leer antes), así no se pierden usos de otros workers
+        add_hits = sqlalchemy.update(table).where(
+            table.c.address_key == sqlalchemy.bindparam('key')
+        ).values(hits=sqlalchemy.func.coalesce(table.c.hits, 0) + sqlalchemy.bindparam('count'))
+        
+        try:
+            with app.app_context():
+                upsert = self._upsert_statement(db.engine.dialect.name)
+                if rows and upsert is not None:
+                    db.session.execute(upsert, rows)
+                else:
+                    for row in rows:
+                        self._upsert_row(table, row)
+                if hits:
+                    db.session.execute(add_hits, [
+                        {'key': address_key, 'count': count} for address_key, count in hits.items()
+                    ])
+                db.session.commit()
+        except Exception as e:
+            # La sesión se descarta (rollback) al cerrar el contexto de la app
+            print(f"❌ Error guardando cache persistente: {e}")
+            self.breaker.record_failure(e)
+            return
+        self.breaker.record_success()
+    
+    @staticmethod
+    def _upsert_row(table, row):
+        # Dialectos sin upsert: insertar y, si otro proceso ganó la clave, actualizar esa fila
+        values = {column: row[column] for column in ('result', 'source', 'updated_at', 'expires_at')}
+        updated = db.session.execute(
+            sqlalchemy.update(table).where(table.c.address_key == row['address_key']).values(**values)
+        )
+        if updated.rowcount:
+            return
+        try:
+            with db.session.begin_nested():
+                db.session.execute(sqlalchemy.insert(table), [row])
+        except sqlalchemy.exc.IntegrityError:
+            db.session.execute(
+                sqlalchemy.update(table).where(table.c.address_key == row['address_key']).values(**values)
+            )
+
 # ============================================
 # INSTANCIAS DE LOS SISTEMAS
 # ============================================
-mexico_geocoder = MexicoGeocoder()
-real_route_system = RealRouteSystem()
+geocode_persistence = GeocodeCachePersistence(
+    flush_interval=GEOCODE_PERSIST_FLUSH_SECONDS,
+    batch_size=GEOCODE_PERSIST_BATCH
+) if GEOCODE_PERSIST_ENABLED else None
+mexico_geocoder = MexicoGeocoder(persistence=geocode_persistence, warmup_entries=GEOCODE_WARMUP_ENTRIES)
+geocode_batch_executor = ThreadPoolExecutor(max_workers=GEOCODE_BATCH_WORKERS, thread_name_prefix='geocode-batch')
+real_route_system = RealRouteSystem(mexico_geocoder)
 face_system = FacialRecognitionSystem()
 email_service = EmailService()
 signature_system = DigitalSignatureSystem()
@@ -1383,15 +4524,23 @@ def verify_recaptcha_v2(token):
         print("❌ Clave secreta o token no proporcionados")
         return False
     
+    # Con el circuito abierto no se puede verificar el token: se rechaza sin esperar a Google
+    guard = upstream_guards['recaptcha']
+    if not guard.allow():
+        print("⏸️  reCAPTCHA no disponible (circuito abierto)")
+        return False
+    
     try:
-        response = requests.post(
+        started = time.monotonic()
+        response = upstream_http.post(
             'https://www.google.com/recaptcha/api/siteverify',
             data={
                 'secret': RECAPTCHA_SECRET_KEY,
                 'response': token
             },
-            timeout=10
+            timeout=guard.timeout()
         )
+        guard.record_response(response, started)
         
         result = response.json()
         print(f"📊 Respuesta reCAPTCHA v2: {result}")
@@ -1400,6 +4549,7 @@ def verify_recaptcha_v2(token):
         
     except Exception as e:
         print(f"💥 Error en verificación reCAPTCHA v2: {e}")
+        guard.record_failure(e)
         return False
 
 def log_face_attempt(user_id, action, success, confidence=None, face_id=None, request=None):
@@ -1518,9 +4668,153 @@ class AntColonyOptimization:
             for i in range(len(path) - 1):
                 self.pheromone[path[i]][path[i+1]] += 1.0 / distance
 
+# ============================================
+# OPTIMIZACIÓN DE RECORRIDOS CON VARIAS PARADAS
+# ============================================
+def tour_cost(matrix, tour):
+    """Costo total de recorrer las paradas en el orden dado"""
+    tour = np.asarray(tour)
+    return float(matrix[tour[:-1], tour[1:]].sum())
+
+def nearest_neighbor_tour(matrix, start, end):
+    """Recorrido inicial visitando siempre la parada pendiente más cercana"""
+    n = matrix.shape[0]
+    pending = np.ones(n, dtype=bool)
+    pending[start] = False
+    pending[end] = False
+    
+    tour = [start]
+    current = start
+    while pending.any():
+        candidates = np.flatnonzero(pending)
+        current = int(candidates[np.argmin(matrix[current, candidates])])
+        pending[current] = False
+        tour.append(current)
+    tour.append(end)
+    return np.array(tour, dtype=np.int64)
+
+def two_opt(matrix, tour, deadline):
+    """
+    Mejora 2-opt con extremos fijos. Admite matrices asimétricas: el costo del
+    tramo invertido se obtiene de sumas acumuladas en ambos sentidos.
+    """
+    tour = tour.copy()
+    n = len(tour)
+    improved = True
+    
+    while improved and time.monotonic() < deadline:
+        improved = False
+        forward = np.concatenate(([0.0], np.cumsum(matrix[tour[:-1], tour[1:]])))
+        backward = np.concatenate(([0.0], np.cumsum(matrix[tour[1:], tour[:-1]])))
+        
+        for i in range(1, n - 2):
+            # Invertir tour[i..j] para todos los j a la vez
+            j = np.arange(i + 1, n - 1)
+            a, first = tour[i - 1], tour[i]
+            last, b = tour[j], tour[j + 1]
+            
+            current = matrix[a, first] + (forward[j] - forward[i]) + matrix[last, b]
+            reversed_cost = matrix[a, last] + (backward[j] - backward[i]) + matrix[first, b]
+            delta = reversed_cost - current
+            
+            best = int(np.argmin(delta))
+            if delta[best] < -1e-9:
+                k = int(j[best])
+                tour[i:k + 1] = tour[i:k + 1][::-1]
+                improved = True
+                break
+    
+    return tour
+
+def solve_tour(matrix, start=0, end=None, time_budget_ms=500, seed=None):
+    """
+    Orden de visita de las paradas: vecino más cercano + 2-opt y, mientras quede
+    presupuesto de tiempo, perturbaciones double-bridge (búsqueda local iterada).
+    Sin end el recorrido termina en cualquier parada; con end == start es circular.
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    deadline = time.monotonic() + time_budget_ms / 1000
+    n = matrix.shape[0]
+    
+    # Recorrido abierto: destino ficticio de costo cero. Circular: copia del origen como destino
+    round_trip = end == start
+    if end is None or round_trip:
+        padded = np.zeros((n + 1, n + 1))
+        padded[:n, :n] = matrix
+        if round_trip:
+            padded[:n, n] = matrix[:, start]
+        matrix, end = padded, n
+    
+    best = two_opt(matrix, nearest_neighbor_tour(matrix, start, end), deadline)
+    best_cost = tour_cost(matrix, best)
+    
+    rng = np.random.default_rng(seed)
+    inner = len(best) - 2
+    while inner >= 3 and time.monotonic() < deadline:
+        # Double-bridge sobre las paradas intermedias: A B C D -> A C B D
+        p1, p2, p3 = np.sort(rng.choice(np.arange(1, inner + 2), size=3, replace=False))
+        candidate = np.concatenate((best[:1], best[1:p1], best[p2:p3], best[p1:p2], best[p3:]))
+        candidate = two_opt(matrix, candidate, deadline)
+        cost = tour_cost(matrix, candidate)
+        if cost < best_cost - 1e-9:
+            best, best_cost = candidate, cost
+    
+    # Quitar el destino ficticio; el recorrido circular vuelve al origen
+    order = [int(node) for node in best if node < n]
+    if round_trip:
+        order.append(start)
+    return order
+
 # ============================================
 # RUTAS PARA GEOCODIFICACIÓN Y MAPAS
 # ============================================
+# Respuestas binarias para clientes con Accept: application/msgpack. Solo los campos
+# numéricos conocidos van como ExtType con float64 little-endian: 1 = pares [lng, lat]
+# fila por fila (N×2) de las geometrías, 2 = lista de floats (filas de las matrices);
+# listas más cortas que MSGPACK_MIN_TYPED_ARRAY o con algún valor no numérico no se empacan
+MSGPACK_MIMETYPE = 'application/msgpack'
+MSGPACK_EXT_COORDINATES = 1
+MSGPACK_EXT_FLOATS = 2
+MSGPACK_MIN_TYPED_ARRAY = 4
+MSGPACK_COORDINATE_FIELDS = frozenset({'coordinates'})
+MSGPACK_FLOAT_FIELDS = frozenset({'durations', 'distances'})
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def _is_pair(value):
+    return isinstance(value, (list, tuple)) and len(value) == 2 and _is_number(value[0]) and _is_number(value[1])
+
+def pack_typed_arrays(value, field=None):
+    """Reemplaza las coordenadas y arrays de floats conocidos por ExtType de float64 (el resto queda igual)"""
+    if isinstance(value, dict):
+        return {key: pack_typed_arrays(item, key) for key, item in value.items()}
+    
+    if isinstance(value, (list, tuple)):
+        if len(value) >= MSGPACK_MIN_TYPED_ARRAY:
+            if field in MSGPACK_COORDINATE_FIELDS and all(map(_is_pair, value)):
+                return msgpack.ExtType(MSGPACK_EXT_COORDINATES, np.asarray(value, dtype='<f8').tobytes())
+            if field in MSGPACK_FLOAT_FIELDS and all(map(_is_number, value)):
+                return msgpack.ExtType(MSGPACK_EXT_FLOATS, np.asarray(value, dtype='<f8').tobytes())
+        # Las filas de una matriz heredan el campo; los demás elementos no
+        inherited = field if field in MSGPACK_FLOAT_FIELDS else None
+        return [pack_typed_arrays(item, inherited) for item in value]
+    
+    return value
+
+def wants_msgpack():
+    """El cliente prefiere MessagePack a JSON según Accept (JSON por defecto)"""
+    return request.accept_mimetypes.best_match(('application/json', MSGPACK_MIMETYPE)) == MSGPACK_MIMETYPE
+
+def api_response(payload):
+    """Respuesta de la API en JSON o MessagePack según Accept"""
+    if wants_msgpack():
+        response = Response(msgpack.packb(pack_typed_arrays(payload), use_bin_type=True), mimetype=MSGPACK_MIMETYPE)
+    else:
+        response = jsonify(payload)
+    response.vary.add('Accept')
+    return response
+
 @app.route('/api/geocode-mexico', methods=['POST'])
 def geocode_mexico():
     """Geocodifica una dirección en México"""
@@ -1529,7 +4823,7 @@ def geocode_mexico():
         address = data.get('address')
         
         if not address:
-            return jsonify({'success': False, 'error': 'Dirección requerida'})
+            return api_response({'success': False, 'error': 'Dirección requerida'})
         
         print(f"🔍 Geocodificando en México: {address}")
         
@@ -1537,13 +4831,128 @@ def geocode_mexico():
         
         if result['success']:
             print(f"✅ Geocodificación exitosa: {result['address']}")
-            return jsonify(result)
+            return api_response(result)
         else:
-            return jsonify({'success': False, 'error': 'Dirección no encontrada'})
+            return api_response({'success': False, 'error': 'Dirección no encontrada'})
             
     except Exception as e:
         print(f"💥 Error en geocodificación: {e}")
-        return jsonify({'success': False, 'error': f'Error del servidor: {str(e)}'})
+        return api_response({'success': False, 'error': f'Error del servidor: {str(e)}'})
+
+@app.route('/api/geocode-mexico/batch', methods=['POST'])
+def geocode_mexico_batch():
+    """Geocodifica una lista de direcciones y devuelve NDJSON (o MessagePack) en el orden de entrada"""
+    data = request.get_json(silent=True)
+    addresses = data.get('addresses') if isinstance(data, dict) else data
+    
+    if not isinstance(addresses, list) or not addresses:
+        return api_response({'success': False, 'error': 'Lista de direcciones requerida'})
+    
+    if len(addresses) > GEOCODE_BATCH_MAX:
+        return api_response({'success': False, 'error': f'Máximo {GEOCODE_BATCH_MAX} direcciones por lote'})
+    
+    print(f"🔍 Geocodificación por lote: {len(addresses)} direcciones")
+    binary = wants_msgpack()
+    
+    # Deduplicar por dirección normalizada; resolver al instante lo que no requiere red
+    keys = []
+    resolved = {}
+    pending = {}
+    for address in addresses:
+        address = str(address or '')
+        key = normalize_address(address)
+        keys.append(key)
+        
+        if not key or key in resolved or key in pending:
+            continue
+        
+        result = mexico_geocoder.geocode_local(key)
+        if result is not None:
+            resolved[key] = result
+        else:
+            # Espera acotada y prioridad baja: un lote no bloquea las búsquedas interactivas
+            pending[key] = geocode_batch_executor.submit(
+                mexico_geocoder.geocode_remote, address, key,
+                rate_wait=GEOCODE_BATCH_RATE_WAIT,
+                priority=NOMINATIM_PRIORITY_BATCH
+            )
+    
+    def generate():
+        try:
+            for index, (address, key) in enumerate(zip(addresses, keys)):
+                if not key:
+                    result = {'success': False, 'error': 'Dirección requerida'}
+                elif key in resolved:
+                    result = resolved[key]
+                else:
+                    try:
+                        result = pending[key].result()
+                    except Exception as e:
+                        result = {'success': False, 'error': str(e)}
+                    resolved[key] = result
+                
+                line = dict(result, index=index, input=address)
+                if binary:
+                    # Objetos MessagePack concatenados (el formato se delimita solo)
+                    yield msgpack.packb(pack_typed_arrays(line), use_bin_type=True)
+                else:
+                    yield json.dumps(line, ensure_ascii=False) + '\n'
+        finally:
+            # Si el cliente se desconecta, no seguir consultando Nominatim
+            for future in pending.values():
+                future.cancel()
+    
+    response = Response(
+        stream_with_context(generate()),
+        mimetype=MSGPACK_MIMETYPE if binary else 'application/x-ndjson'
+    )
+    response.vary.add('Accept')
+    return response
+
+@app.route('/api/geocode-mexico/suggest')
+def geocode_mexico_suggest():
+    """Autocompletado de lugares mientras el usuario escribe (sin llamadas de red)"""
+    query = request.args.get('q', '')
+    limit = min(max(request.args.get('limit', 5, type=int), 1), 20)
+    
+    response = api_response({
+        'success': True,
+        'query': query,
+        'suggestions': mexico_geocoder.suggest(query, limit=limit)
+    })
+    response.headers['Cache-Control'] = 'public, max-age=3600'
+    return response
+
+@app.route('/api/geocode-mexico/stats')
+def geocode_mexico_stats():
+    """Estadísticas de la cache de geocodificación para monitoreo"""
+    return api_response({
+        'success': True,
+        'cache': mexico_geocoder.cache.stats(),
+        'reverse_cache': mexico_geocoder.reverse_cache_stats(),
+        'single_flight': mexico_geocoder.flights.stats(),
+        'negative_cache': mexico_geocoder.negative_cache.stats(),
+        'persistence': geocode_persistence.breaker.state() if geocode_persistence else None,
+        'nominatim': upstream_guards['nominatim'].state()
+    })
+
+@app.route('/api/routes/stats')
+def route_stats():
+    """Estadísticas de la cache de rutas y de los proveedores para monitoreo"""
+    return api_response({
+        'success': True,
+        'cache': dict(real_route_system.route_cache.stats(), cell_m=ROUTE_CACHE_CELL_M),
+        'providers': real_route_system.provider_stats(),
+        'hedge_delay_ms': ROUTE_HEDGE_DELAY_MS
+    })
+
+@app.route('/api/upstreams/stats')
+def upstream_stats():
+    """Estado de los circuit breakers y timeouts de los servicios externos"""
+    return api_response({
+        'success': True,
+        'upstreams': {name: guard.state() for name, guard in upstream_guards.items()}
+    })
 
 @app.route('/api/simple-geocode', methods=['POST'])
 def simple_geocode():
@@ -1554,7 +4963,7 @@ def simple_geocode():
     print(f"🔍 Buscando: {address}")
     
     result = mexico_geocoder.geocode(address)
-    return jsonify(result)
+    return api_response(result)
 
 @app.route('/api/reverse-geocode', methods=['POST'])
 def reverse_geocode():
@@ -1565,20 +4974,20 @@ def reverse_geocode():
         lng = data.get('lng')
         
         if not lat or not lng:
-            return jsonify({'success': False, 'error': 'Coordenadas requeridas'})
+            return api_response({'success': False, 'error': 'Coordenadas requeridas'})
         
         result = mexico_geocoder.reverse_geocode(lat, lng)
-        return jsonify(result)
+        return api_response(result)
         
     except Exception as e:
-        return jsonify({'success': False, 'error': str(e)})
+        return api_response({'success': False, 'error': str(e)})
 
 @app.route('/api/get-current-location')
 def get_current_location():
     """Obtiene ubicación aproximada basada en IP"""
     try:
         # Para desarrollo, devolver ubicación por defecto (centro de México)
-        return jsonify({
+        return api_response({
             'success': True,
             'lat': 23.6345,  # Centro de México
             'lng': -102.5528,
@@ -1587,7 +4996,7 @@ def get_current_location():
             'region': 'Centro'
         })
     except Exception as e:
-        return jsonify({'success': False, 'error': str(e)})
+        return api_response({'success': False, 'error': str(e)})
 
 @app.route('/api/get-gps-location', methods=['POST'])
 def get_gps_location():
@@ -1598,12 +5007,12 @@ def get_gps_location():
         lng = data.get('lng')
         
         if not lat or not lng:
-            return jsonify({'success': False, 'error': 'Coordenadas no proporcionadas'})
+            return api_response({'success': False, 'error': 'Coordenadas no proporcionadas'})
         
         # Convertir a dirección
         result = mexico_geocoder.reverse_geocode(lat, lng)
         
-        return jsonify({
+        return api_response({
             'success': True,
             'lat': lat,
             'lng': lng,
@@ -1611,42 +5020,296 @@ def get_gps_location():
             'message': 'Ubicación GPS obtenida correctamente'
         })
     except Exception as e:
-        return jsonify({'success': False, 'error': str(e)})
+        return api_response({'success': False, 'error': str(e)})
 
-@app.route('/api/calculate-route-real', methods=['POST'])
+@app.route('/api/calculate-route-real', methods=['GET', 'POST'])
 def calculate_route_real():
-    """Calcula rutas reales entre dos puntos"""
+    """
+    Calcula rutas reales entre dos puntos (GET admite revalidación con If-None-Match).
+    fields= limita los campos de cada ruta; la más rápida y la más económica se
+    indican por id y los pasos se piden aparte con /api/routes/<handle>/steps.
+    """
     try:
-        data = request.get_json()
+        data = (request.get_json() if request.method == 'POST' else request.args) or {}
         start_lat = data.get('start_lat')
         start_lng = data.get('start_lng')
         end_lat = data.get('end_lat')
         end_lng = data.get('end_lng')
         route_type = data.get('route_type', 'all')
+        geometry_format = data.get('geometry_format', 'geojson')
+        fields = parse_fields(data.get('fields'))
+        
+        # Nivel de detalle según el zoom del cliente; full_detail fuerza la geometría completa
+        zoom = data.get('zoom')
+        full_detail = data.get('full_detail') not in (None, False, '', '0', 'false')
+        zoom = None if zoom is None or full_detail else float(zoom)
         
         if not all([start_lat, start_lng, end_lat, end_lng]):
-            return jsonify({'success': False, 'error': 'Coordenadas requeridas'})
+            return api_response({'success': False, 'error': 'Coordenadas requeridas'})
+        
+        # Por GET llegan como texto
+        start_lat, start_lng, end_lat, end_lng = (float(v) for v in (start_lat, start_lng, end_lat, end_lng))
+        
+        if geometry_format not in GEOMETRY_FORMATS:
+            return api_response({'success': False, 'error': f"geometry_format debe ser uno de: {', '.join(GEOMETRY_FORMATS)}"})
         
         # Obtener rutas reales
         routes = real_route_system.get_real_route(
-            start_lat, start_lng, end_lat, end_lng, route_type
+            start_lat, start_lng, end_lat, end_lng, route_type, geometry_format
         )
+        routes = [real_route_system.route_for_zoom(route, zoom) for route in routes]
         
         # Ordenar por tiempo
         routes.sort(key=lambda x: x['duration_min'])
+        cheapest = min(routes, key=lambda x: x['fuel_estimate']['cost_mxn']) if routes else None
         
-        return jsonify({
+        return conditional_response({
             'success': True,
             'route_options': {
-                'all_routes': routes,
-                'fastest_route': routes[0] if routes else None,
-                'cheapest_route': min(routes, key=lambda x: x['fuel_estimate']['cost_mxn']) if routes else None
+                'all_routes': [select_fields(route, fields) for route in routes],
+                'fastest_route_id': routes[0]['id'] if routes else None,
+                'cheapest_route_id': cheapest['id'] if cheapest else None
             }
         })
         
     except Exception as e:
         print(f"💥 Error calculando ruta: {e}")
-        return jsonify({'success': False, 'error': str(e)})
+        return api_response({'success': False, 'error': str(e)})
+
+def conditional_response(payload):
+    """Respuesta (JSON o MessagePack) con ETag fuerte; 304 Not Modified si el cliente ya tiene esa versión"""
+    response = api_response(payload)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.add_etag()
+    return response.make_conditional(request)
+
+# Campos que siempre incluye una ruta con fields= (para referenciarla y pedir sus pasos)
+ROUTE_REQUIRED_FIELDS = ('id', 'handle')
+
+def parse_fields(raw_fields):
+    """Campos pedidos con fields= ("a,b,c" o lista); None si se piden todos"""
+    if not raw_fields:
+        return None
+    if isinstance(raw_fields, str):
+        raw_fields = raw_fields.split(',')
+    return {field.strip() for field in raw_fields if field.strip()} | set(ROUTE_REQUIRED_FIELDS)
+
+def select_fields(route, fields):
+    """Copia de la ruta solo con los campos pedidos"""
+    if fields is None:
+        return route
+    return {key: value for key, value in route.items() if key in fields}
+
+def parse_points(raw_points):
+    """Convierte puntos {lat, lng} o [lat, lng] a tuplas (lat, lng)"""
+    points = []
+    for point in raw_points:
+        if isinstance(point, dict):
+            points.append((float(point['lat']), float(point['lng'])))
+        else:
+            points.append((float(point[0]), float(point[1])))
+    return points
+
+def sse_event(event, data):
+    """Formatea un evento Server-Sent Events con datos JSON"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.route('/api/calculate-route-real/stream', methods=['GET', 'POST'])
+def calculate_route_real_stream():
+    """
+    Variante en streaming (SSE) de calculate-route-real: cada alternativa sin
+    instrucciones en cuanto responde el proveedor (la más rápida primero), luego
+    el resumen y al final el detalle de cada ruta (cuotas, handle, pasos y
+    geometría completa)
+    """
+    # GET para EventSource (parámetros en la URL) o POST con JSON
+    data = request.get_json(silent=True) if request.method == 'POST' else request.args
+    data = data or {}
+    try:
+        start_lat = float(data['start_lat'])
+        start_lng = float(data['start_lng'])
+        end_lat = float(data['end_lat'])
+        end_lng = float(data['end_lng'])
+    except (KeyError, TypeError, ValueError):
+        return api_response({'success': False, 'error': 'Coordenadas requeridas'})
+    
+    route_type = data.get('route_type', 'all')
+    geometry_format = data.get('geometry_format', 'geojson')
+    if geometry_format not in GEOMETRY_FORMATS:
+        return api_response({'success': False, 'error': f"geometry_format debe ser uno de: {', '.join(GEOMETRY_FORMATS)}"})
+    
+    zoom = data.get('zoom')
+    zoom = float(zoom) if zoom not in (None, '') else None
+    include_details = str(data.get('details', 'true')).lower() != 'false'
+    
+    def summary(route):
+        """Alternativa ligera: geometría al nivel de detalle del zoom, sin instrucciones"""
+        view = real_route_system.route_for_zoom(route, zoom)
+        view.pop('steps', None)
+        return view
+    
+    def generate():
+        yield sse_event('status', {'message': 'Calculando rutas por carreteras de México...'})
+        
+        # Cada alternativa sale en cuanto el proveedor ganador responde (la más rápida primero)
+        sent = set()
+        routes = []
+        try:
+            for stage, value in real_route_system.iter_real_route(
+                start_lat, start_lng, end_lat, end_lng, route_type, geometry_format
+            ):
+                if stage == 'route':
+                    sent.add(value['id'])
+                    yield sse_event('route', summary(value))
+                else:
+                    routes = value
+        except Exception as e:
+            print(f"💥 Error calculando ruta: {e}")
+            yield sse_event('error', {'success': False, 'error': str(e)})
+            return
+        
+        routes = sorted(routes, key=lambda x: x['duration_min'])
+        
+        # Desde la cache o la simulación las rutas llegan todas juntas
+        for route in routes:
+            if route['id'] not in sent:
+                yield sse_event('route', summary(route))
+        
+        yield sse_event('summary', {
+            'success': True,
+            'count': len(routes),
+            'fastest_route_id': routes[0]['id'] if routes else None,
+            'cheapest_route_id': min(routes, key=lambda x: x['fuel_estimate']['cost_mxn'])['id'] if routes else None
+        })
+        
+        # Cuotas reales, handle y pasos de cada ruta; con details=false solo lo que cambió
+        for route in routes:
+            detail = {
+                'id': route['id'],
+                'handle': route.get('handle'),
+                'has_tolls': route['has_tolls'],
+                'fuel_estimate': route['fuel_estimate']
+            }
+            if 'tolls' in route:
+                detail['tolls'] = route['tolls']
+            if include_details:
+                detail['steps'] = route.get('steps', [])
+                detail['geometry'] = route.get('geometry')
+            yield sse_event('detail', detail)
+        
+        yield sse_event('done', {'success': True})
+    
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # evitar buffering en nginx
+    return response
+
+@app.route('/api/routes/<handle>/steps')
+def route_steps(handle):
+    """Instrucciones paso a paso de una ruta ya entregada, por su handle"""
+    route = real_route_system.route_handles.get(handle)
+    if route is None:
+        return api_response({'success': False, 'error': 'Ruta no encontrada o expirada'}), 404
+    
+    return conditional_response({'success': True, 'handle': handle, 'steps': route.get('steps', [])})
+
+@app.route('/api/optimize-route', methods=['POST'])
+def optimize_route():
+    """Ordena y calcula una ruta con varias paradas (la primera parada es el origen)"""
+    try:
+        data = request.get_json() or {}
+        raw_waypoints = data.get('waypoints') or []
+        
+        if not 2 <= len(raw_waypoints) <= ROUTE_OPTIMIZE_MAX_STOPS:
+            return api_response({'success': False, 'error': f'Se requieren entre 2 y {ROUTE_OPTIMIZE_MAX_STOPS} paradas'})
+        
+        points = parse_points(raw_waypoints)
+        
+        time_budget_ms = min(float(data.get('time_budget_ms', ROUTE_OPTIMIZE_TIME_BUDGET_MS)), 5 * ROUTE_OPTIMIZE_TIME_BUDGET_MS)
+        
+        order, route, source = real_route_system.optimize_stops(
+            points,
+            route_type=data.get('route_type', 'all'),
+            round_trip=bool(data.get('round_trip', False)),
+            fixed_end=bool(data.get('fixed_end', False)),
+            optimize_for=data.get('optimize_for', 'duration'),
+            time_budget_ms=max(time_budget_ms, 0)
+        )
+        
+        return api_response({
+            'success': True,
+            'order': order,
+            'matrix_source': source,
+            'route': route
+        })
+        
+    except (KeyError, IndexError, TypeError, ValueError):
+        return api_response({'success': False, 'error': 'Paradas inválidas: se esperan objetos {lat, lng}'})
+    except Exception as e:
+        print(f"💥 Error optimizando ruta: {e}")
+        return api_response({'success': False, 'error': str(e)})
+
+@app.route('/api/distance-matrix', methods=['POST'])
+def distance_matrix():
+    """Matriz N×M de tiempos y distancias entre orígenes y destinos (JSON o .npy/.npz)"""
+    try:
+        data = request.get_json() or {}
+        sources = parse_points(data.get('sources') or [])
+        destinations = parse_points(data['destinations']) if data.get('destinations') else sources
+        annotations = data.get('annotations') or ['duration']
+        
+        if not sources or len(sources) > ROUTE_MATRIX_MAX or len(destinations) > ROUTE_MATRIX_MAX:
+            return api_response({'success': False, 'error': f'Se requieren entre 1 y {ROUTE_MATRIX_MAX} orígenes y destinos'})
+        if not set(annotations) <= {'duration', 'distance'}:
+            return api_response({'success': False, 'error': "annotations admite 'duration' y 'distance'"})
+        
+        # Con el OSRM público, una matriz grande se volvería cientos de consultas /table
+        tiles = real_route_system.matrix_tile_count(len(sources), len(destinations))
+        if ROUTE_MATRIX_MAX_TILES and tiles > ROUTE_MATRIX_MAX_TILES:
+            return api_response({
+                'success': False,
+                'error': f'La matriz requiere {tiles} consultas al servidor de rutas (máximo {ROUTE_MATRIX_MAX_TILES})',
+                'tiles': tiles,
+                'max_tiles': ROUTE_MATRIX_MAX_TILES
+            }), 400
+        
+        durations, distances, estimated_tiles = real_route_system.get_distance_matrix(
+            sources, destinations, use_cache=bool(data.get('cache', True))
+        )
+        matrices = {'duration': durations, 'distance': distances}
+        
+        # Formato binario: .npy con una sola matriz, .npz con varias (float32)
+        wants_binary = data.get('format') == 'npy' or request.accept_mimetypes.best == 'application/octet-stream'
+        if wants_binary:
+            buffer = io.BytesIO()
+            if len(annotations) == 1:
+                np.save(buffer, matrices[annotations[0]])
+                filename = f"{annotations[0]}.npy"
+            else:
+                np.savez(buffer, **{name: matrices[name] for name in annotations})
+                filename = "matrix.npz"
+            
+            response = make_response(buffer.getvalue())
+            response.headers['Content-Type'] = 'application/octet-stream'
+            response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+            response.headers['X-Matrix-Shape'] = f"{len(sources)}x{len(destinations)}"
+            response.headers['X-Matrix-Estimated-Tiles'] = str(estimated_tiles)
+            return response
+        
+        result = {
+            'success': True,
+            'shape': [len(sources), len(destinations)],
+            'estimated_tiles': estimated_tiles
+        }
+        for name in annotations:
+            result[f'{name}s'] = np.round(matrices[name].astype(np.float64), 1).tolist()
+        return api_response(result)
+        
+    except (KeyError, IndexError, TypeError, ValueError):
+        return api_response({'success': False, 'error': 'Puntos inválidos: se esperan objetos {lat, lng}'})
+    except Exception as e:
+        print(f"💥 Error calculando matriz: {e}")
+        return api_response({'success': False, 'error': str(e)})
 
 @app.route('/api/calculate-route', methods=['POST'])
 def calculate_route():
@@ -1659,15 +5322,16 @@ def calculate_route():
         end_lng = data.get('end_lng')
         
         if not all([start_lat, start_lng, end_lat, end_lng]):
-            return jsonify({'success': False, 'error': 'Coordenadas requeridas'})
+            return api_response({'success': False, 'error': 'Coordenadas requeridas'})
         
         # Usar el sistema real
         routes = real_route_system.get_real_route(start_lat, start_lng, end_lat, end_lng)
+        routes = [real_route_system.route_for_zoom(route) for route in routes]
         
         # Ordenar por tiempo
         routes.sort(key=lambda x: x['duration_min'])
         
-        return jsonify({
+        return conditional_response({
             'success': True,
             'route_options': {
                 'all_routes': routes,
@@ -1678,7 +5342,32 @@ def calculate_route():
         
     except Exception as e:
         print(f"💥 Error calculando ruta: {e}")
-        return jsonify({'success': False, 'error': str(e)})
+        return api_response({'success': False, 'error': str(e)})
+
+@app.cli.command('compile-gazetteer')
+@click.argument('csv_path')
+@click.argument('output_path', default=GAZETTEER_PATH)
+def compile_gazetteer_command(csv_path, output_path):
+    """Compila un CSV de localidades (INEGI u OSM) al gazetteer binario offline"""
+    count = OfflineGazetteer.compile_csv(csv_path, output_path)
+    print(f"✅ Gazetteer compilado: {count} localidades en {output_path}")
+
+@app.cli.command('compile-road-graph')
+@click.argument('osm_path')
+@click.argument('output_path', default=ROAD_GRAPH_PATH)
+def compile_road_graph_command(osm_path, output_path):
+    """Compila un extracto OSM (XML) a la red vial offline con contraction hierarchies"""
+    nodes, edges = RoadGraphRouter.compile_osm(osm_path, output_path)
+    print(f"✅ Red vial compilada: {nodes} nodos, {edges} aristas de la jerarquía en {output_path}")
+
+@app.cli.command('compile-toll-index')
+@click.argument('csv_path')
+@click.argument('output_path', default=TOLL_INDEX_PATH)
+@click.option('--osm', 'osm_path', default=None, help='Extracto OSM (XML) con las vías de cuota (toll=yes)')
+def compile_toll_index_command(csv_path, output_path, osm_path):
+    """Compila el índice de casetas (CSV con tarifas) y tramos de cuota"""
+    plazas, segment_points = TollIndex.compile(csv_path, output_path, osm_path)
+    print(f"✅ Índice de cuotas compilado: {plazas} casetas, {segment_points} puntos de tramos en {output_path}")
 
 # ============================================
 # RUTAS PRINCIPALES